@@ -0,0 +1,67 @@
+"""
+Secondary sources of tweets, used to backfill the gaps which the timeline
+and retweets endpoints leave in the data.
+"""
+
+# Number of tweets requested per search/tweets call (the maximum allowed by
+# the endpoint).
+SEARCH_PAGE_SIZE = 100
+
+
+class BackfillSource:
+    """
+    A source of the tweets which the user_timeline and retweets endpoints
+    could not return. Subclasses implement the fetches they support, and
+    the others yield no tweets.
+
+    The methods are called by the workers with their API object, and the
+    endpoint is the rate limited endpoint they call, named as in the
+    response of application/rate_limit_status.
+    """
+    endpoint = '/search/tweets'
+
+    def fetch_timeline(self, api, screen_name, since_id, max_id):
+        """
+        Yields the JSON of the tweets of a user with ids from since_id to
+        max_id, both inclusive.
+        """
+        return iter(())
+
+    def fetch_retweets(self, api, screen_name, tweet_id, max_id):
+        """
+        Yields the JSON of the retweets of a tweet of the user screen_name,
+        with ids up to max_id.
+        """
+        return iter(())
+
+
+class SearchBackfillSource(BackfillSource):
+    """
+    Backfills from the standard search/tweets endpoint, which only reaches
+    the tweets of the last 7 days or so: timelines with a from: query, and
+    retweets with an "RT @" query filtered on the id of the retweeted
+    tweet.
+    """
+
+    def _search(self, api, query, since_id, max_id):
+        # since_id is exclusive and max_id inclusive in search/tweets
+        since_id = int(since_id) - 1
+        max_id = int(max_id)
+        while max_id > since_id:
+            tweets = api.search(q=query, count=SEARCH_PAGE_SIZE,
+                                since_id=since_id, max_id=max_id,
+                                result_type='recent', tweet_mode='extended')
+            if len(tweets) == 0:
+                return
+            for tweet in tweets:
+                yield tweet._json
+            max_id = tweets[-1].id - 1
+
+    def fetch_timeline(self, api, screen_name, since_id, max_id):
+        return self._search(api, 'from:' + screen_name, since_id, max_id)
+
+    def fetch_retweets(self, api, screen_name, tweet_id, max_id):
+        for tweet in self._search(api, 'RT @' + screen_name, int(tweet_id),
+                                  max_id):
+            if tweet.get('retweeted_status', {}).get('id') == int(tweet_id):
+                yield tweet
@@ -0,0 +1,204 @@
+"""
+Benchmarks the TaskManager pipeline offline, against a FakeTwitter.
+
+Usage (from the repository root):
+    python -m benchmarks.bench --scenario tweets --keys 4 --tweets 1000
+    python -m benchmarks.bench --scenario users --users 200 --window 30
+"""
+from benchmarks.fake_api import FakeTwitter, TWEET_ID_BASE
+from task_manager import PIPELINE_FOLLOW_UPS, TaskManager
+import argparse
+import contextlib
+import json
+import main
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+
+class CountingTaskManager(TaskManager):
+    """
+    A TaskManager which counts the tasks dispatched by run_tasks, including
+    the follow-up tasks enqueued by the workers.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.num_tasks = 0
+
+    def run_tasks(self, apis):
+        # Follow-up tasks are registered by the workers during the run
+        num_registered = sum(self.task_registry.counts().values())
+        self.num_tasks += len(self.tasks_staged)
+        super().run_tasks(apis)
+        self.num_tasks += sum(self.task_registry.counts().values()) - \
+            num_registered
+
+
+@contextlib.contextmanager
+def silenced(enabled=True):
+    """
+    Redirects stdout and stderr at the file descriptor level, so that the
+    output of the worker processes is silenced as well.
+    """
+    if not enabled:
+        yield
+        return
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved_fds = [os.dup(1), os.dup(2)]
+    with open(os.devnull, 'w') as devnull:
+        os.dup2(devnull.fileno(), 1)
+        os.dup2(devnull.fileno(), 2)
+        try:
+            yield
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(saved_fds[0], 1)
+            os.dup2(saved_fds[1], 2)
+            for fd in saved_fds:
+                os.close(fd)
+
+
+def make_ids(args):
+    rng = random.Random(args.seed)
+    user_ids = [str(rng.randint(1, 10 ** 6)) for _ in range(args.users)]
+    tweet_ids = [str(rng.randint(1, 10 ** 6) * TWEET_ID_BASE +
+                     rng.randint(1, 3200)) for _ in range(args.tweets)]
+    return user_ids, tweet_ids
+
+
+def run_scenario(args):
+    twitter = FakeTwitter(args.keys, latency=args.latency, window=args.window,
+                          ids_page_size=args.ids_page_size,
+                          max_followers=args.max_followers,
+                          error_rate=args.error_rate,
+                          missing_rate=args.missing_rate, seed=args.seed)
+    apis = twitter.apis(wait_on_rate_limit=True)
+    for key_idx in range(args.keys - args.revoked_keys, args.keys):
+        twitter.revoke(key_idx)
+    user_ids, tweet_ids = make_ids(args)
+
+    root_dir = tempfile.mkdtemp(prefix='paralleltweepy-bench-') + '/'
+    twitter_folder_path = root_dir + '20200101000000/twitter/'
+    os.makedirs(twitter_folder_path)
+
+    start_time = time.time()
+    with silenced(not args.verbose):
+        task_manager = CountingTaskManager(
+            root_dir, twitter_folder_path, max_follow_count=args.max_followers,
+            compact_ids=args.compact_ids, tweet_format=args.tweet_format,
+            tweet_compression=args.tweet_compression, engine=args.engine,
+            engine_shards=args.shards, shard_output=args.shard_output,
+            quiet=not args.verbose,
+            follow_ups=PIPELINE_FOLLOW_UPS if args.scenario == 'pipeline'
+            else None)
+        with task_manager:
+            if args.scenario == 'tweets':
+                main.process_tweets(tweet_ids, set(), task_manager, apis)
+            elif args.scenario == 'pipeline':
+                main.process_pipelined(tweet_ids, [], set(), task_manager,
+                                       apis)
+            else:
+                main.process_users(user_ids, set(), task_manager, apis)
+            key_stats = task_manager.key_stats()
+    elapsed = time.time() - start_time
+
+    stats = twitter.stats()
+    num_tasks = task_manager.num_tasks
+    idle_time = stats['idle_time_per_key']
+    report = {
+        'scenario': args.scenario,
+        'keys': args.keys,
+        'engine': args.engine,
+        'tasks': num_tasks,
+        'elapsed_sec': round(elapsed, 3),
+        'tasks_per_sec': round(num_tasks / elapsed, 2) if elapsed else None,
+        'api_calls': stats['total_calls'],
+        'api_calls_per_task': round(stats['total_calls'] / num_tasks, 3)
+        if num_tasks else None,
+        'api_calls_per_endpoint': stats['calls'],
+        'injected_errors': stats['errors'],
+        'quarantined_keys': sorted(
+            key_idx for key_idx, stats_of_key in key_stats.items()
+            if stats_of_key['status'] == 'quarantined'),
+        'rate_limit_idle_sec_per_key': [round(t, 2) for t in idle_time],
+        'rate_limit_idle_sec_total': round(sum(idle_time), 2),
+        # ru_maxrss is in kilobytes on Linux. For children it is the peak
+        # RSS of the largest child process which has been waited for.
+        'peak_rss_mb': round(resource.getrusage(
+            resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'peak_child_rss_mb': round(resource.getrusage(
+            resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+    }
+
+    if not args.keep_output:
+        shutil.rmtree(root_dir)
+    return report
+
+
+def print_report(report):
+    for key, value in report.items():
+        if isinstance(value, dict):
+            print("{:<30}".format(key))
+            for sub_key, sub_value in sorted(value.items()):
+                print("    {:<26} {}".format(sub_key, sub_value))
+        else:
+            print("{:<30} {}".format(key, value))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split(
+        '\n')[0])
+    parser.add_argument('--scenario', choices=['tweets', 'pipeline', 'users'],
+                        default='tweets')
+    parser.add_argument('--keys', type=int, default=4)
+    parser.add_argument('--engine', choices=['process', 'thread'],
+                        default='process')
+    parser.add_argument('--shards', type=int, default=1,
+                        help="Number of processes of the thread engine")
+    parser.add_argument('--tweets', type=int, default=500,
+                        help="Number of tweet ids in the tweets and "
+                        "pipeline scenarios")
+    parser.add_argument('--users', type=int, default=100,
+                        help="Number of user ids in the users scenario")
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help="Seconds each API call takes")
+    parser.add_argument('--window', type=float, default=15 * 60,
+                        help="Length of a rate limit window in seconds")
+    parser.add_argument('--ids-page-size', type=int, default=5000)
+    parser.add_argument('--max-followers', type=int, default=20000)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--missing-rate', type=float, default=0.0)
+    parser.add_argument('--revoked-keys', type=int, default=0,
+                        help="Number of keys whose calls are rejected")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--compact-ids', action='store_true')
+    parser.add_argument('--shard-output', action='store_true',
+                        help="Store output files in hashed subfolders")
+    parser.add_argument('--tweet-format', choices=['json', 'jsonl'],
+                        default='json')
+    parser.add_argument('--tweet-compression', choices=['gzip', 'zstd'],
+                        default=None)
+    parser.add_argument('--json', metavar='PATH',
+                        help="Also write the report as JSON to PATH")
+    parser.add_argument('--keep-output', action='store_true',
+                        help="Keep the collected data in the temp folder")
+    parser.add_argument('--verbose', action='store_true',
+                        help="Show the output of the TaskManager")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    report = run_scenario(args)
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as fw:
+            json.dump(report, fw, indent=2)
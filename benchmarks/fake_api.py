@@ -0,0 +1,429 @@
+from multiprocessing import Array, Lock
+from tweepy.error import RateLimitError, TweepError
+from tweepy.models import ResultSet, Status, User
+from tweepy.parsers import ModelParser
+import random
+import time
+
+# The endpoints implemented by FakeAPI and their per-window call limits,
+# which match the user-auth limits of the Twitter v1.1 API.
+ENDPOINT_LIMITS = {
+    '/statuses/show/:id': 900,
+    '/statuses/lookup': 900,
+    '/statuses/retweets/:id': 75,
+    '/statuses/user_timeline': 900,
+    '/users/show/:id': 900,
+    '/users/lookup': 900,
+    '/followers/ids': 15,
+    '/friends/ids': 15,
+    '/search/tweets': 180,
+    '/application/rate_limit_status': 180,
+    '/account/verify_credentials': 75,
+}
+ENDPOINTS = list(ENDPOINT_LIMITS)
+
+# Tweet ids of user u are u * TWEET_ID_BASE + k, for k in 1..statuses_count,
+# so that the author of any tweet id can be derived from it.
+TWEET_ID_BASE = 10 ** 7
+
+
+API_URL = 'https://api.twitter.com/1.1'
+
+
+def endpoint_url(endpoint):
+    """
+    Returns a URL of the form tweepy calls for an endpoint's resource name.
+    """
+    path = endpoint.replace('/retweets/:id', '/retweets/1')
+    return API_URL + path.replace('/:id', '') + '.json'
+
+
+class FakeResponse:
+    def __init__(self, status_code, headers, url=None):
+        self.status_code = status_code
+        self.headers = headers
+        self.url = url
+
+
+class FakeTwitter:
+    """
+    A deterministic synthetic Twitter, and the call statistics and rate
+    limit windows of the API keys using it.
+
+    The statistics live in shared memory, so that they are aggregated
+    across all the worker processes of a TaskManager. A FakeTwitter must
+    be created before the workers are started.
+
+    Parameters:
+        - num_keys: The number of API keys whose statistics are tracked.
+        - latency (float): Seconds each API call takes.
+        - window (float): Length of a rate limit window in seconds. Twitter
+          uses 15 minutes; shorter windows keep benchmarks fast while still
+          exercising rate limit waits.
+        - ids_page_size / timeline_max: The page size of followers/ids and
+          friends/ids, and the number of tweets reachable on a timeline.
+        - max_followers: The upper bound of the (log-uniform) follower and
+          followee counts of the users.
+        - error_rate: The probability of a call failing with a 503 error.
+        - missing_rate: The probability of a user or tweet not existing.
+
+    Keys can be revoked with revoke, after which every call they make fails
+    with a 401 error, as it does on Twitter.
+    """
+
+    def __init__(self, num_keys, latency=0.0, window=15 * 60,
+                 ids_page_size=5000, timeline_max=3200, max_followers=50000,
+                 error_rate=0.0, missing_rate=0.0, seed=0):
+        self.num_keys = num_keys
+        self.latency = latency
+        self.window = window
+        self.ids_page_size = ids_page_size
+        self.timeline_max = timeline_max
+        self.max_followers = max_followers
+        self.error_rate = error_rate
+        self.missing_rate = missing_rate
+        self.seed = seed
+
+        num_slots = num_keys * len(ENDPOINTS)
+        self.lock = Lock()
+        self.calls = Array('l', num_slots, lock=False)
+        self.errors = Array('l', num_slots, lock=False)
+        self.window_calls = Array('l', num_slots, lock=False)
+        self.window_start = Array('d', num_slots, lock=False)
+        self.idle_time = Array('d', num_keys, lock=False)
+        self.revoked = Array('b', num_keys, lock=False)
+
+    def apis(self, wait_on_rate_limit=True):
+        """
+        Returns one FakeAPI object per API key.
+        """
+        return [FakeAPI(self, key_idx, wait_on_rate_limit)
+                for key_idx in range(self.num_keys)]
+
+    def revoke(self, key_idx):
+        self.revoked[key_idx] = 1
+
+    def _rng(self, *args):
+        # Seeding with a string keeps the data identical across processes
+        # and runs, unlike hash() of a tuple containing strings.
+        return random.Random(repr((self.seed,) + args))
+
+    def exists(self, object_id):
+        return self._rng('exists', int(object_id)).random() >= \
+            self.missing_rate
+
+    def user_json(self, user_id):
+        user_id = int(user_id)
+        rng = self._rng('user', user_id)
+        followers_count = int(self.max_followers ** rng.random())
+        friends_count = int(self.max_followers ** rng.random())
+        return {
+            'id': user_id,
+            'id_str': str(user_id),
+            'screen_name': 'user' + str(user_id),
+            'name': 'User ' + str(user_id),
+            'description': 'x' * rng.randint(0, 160),
+            'followers_count': followers_count,
+            'friends_count': friends_count,
+            'statuses_count': rng.randint(0, 2 * self.timeline_max),
+            'favourites_count': rng.randint(0, 10000),
+            'protected': False,
+            'verified': False,
+            'created_at': 'Mon Jan 01 00:00:00 +0000 2018',
+        }
+
+    def tweet_json(self, tweet_id):
+        tweet_id = int(tweet_id)
+        rng = self._rng('tweet', tweet_id)
+        return {
+            'id': tweet_id,
+            'id_str': str(tweet_id),
+            'full_text': 'x' * rng.randint(20, 280),
+            'created_at': 'Mon Jan 01 00:00:00 +0000 2018',
+            'retweet_count': rng.randint(0, 1000),
+            'favorite_count': rng.randint(0, 1000),
+            'user': self.user_json(max(tweet_id // TWEET_ID_BASE, 1)),
+        }
+
+    def timeline_ids(self, user_id):
+        """
+        Returns the ids of the tweets reachable on a user's timeline, newest
+        first.
+        """
+        user_id = int(user_id)
+        count = min(self.user_json(user_id)['statuses_count'],
+                    self.timeline_max)
+        newest = self.user_json(user_id)['statuses_count']
+        return range(user_id * TWEET_ID_BASE + newest,
+                     user_id * TWEET_ID_BASE + newest - count, -1)
+
+    def ids_page(self, kind, user_id, page):
+        """
+        Returns a page of the follower or followee ids of a user, and the
+        cursor of the next page (0 on the last page).
+        """
+        user = self.user_json(user_id)
+        total = user[kind + '_count']
+        start = page * self.ids_page_size
+        num_ids = max(min(self.ids_page_size, total - start), 0)
+        rng = self._rng(kind, int(user_id), page)
+        ids = [rng.randint(1, 10 ** 9) for _ in range(num_ids)]
+        next_cursor = page + 1 if start + num_ids < total else 0
+        return ids, next_cursor
+
+    def call(self, key_idx, endpoint, wait_on_rate_limit):
+        """
+        Accounts for one call of an endpoint by a key, waiting for or
+        raising on an exhausted rate limit window and injecting errors.
+        Returns the rate limit headers of the response.
+        """
+        if self.revoked[key_idx]:
+            raise TweepError('Invalid or expired token',
+                             FakeResponse(401, {}, endpoint_url(endpoint)),
+                             api_code=89)
+        slot = key_idx * len(ENDPOINTS) + ENDPOINTS.index(endpoint)
+        limit = ENDPOINT_LIMITS[endpoint]
+        while True:
+            with self.lock:
+                now = time.time()
+                if now - self.window_start[slot] >= self.window:
+                    self.window_start[slot] = now
+                    self.window_calls[slot] = 0
+                reset = self.window_start[slot] + self.window
+                if self.window_calls[slot] < limit:
+                    self.window_calls[slot] += 1
+                    self.calls[slot] += 1
+                    remaining = limit - self.window_calls[slot]
+                    break
+
+            headers = {'x-rate-limit-remaining': '0',
+                       'x-rate-limit-reset': str(int(reset) + 1)}
+            if not wait_on_rate_limit:
+                raise RateLimitError('Rate limit exceeded',
+                                     FakeResponse(429, headers,
+                                                  endpoint_url(endpoint)))
+            with self.lock:
+                self.idle_time[key_idx] += max(reset - now, 0)
+            time.sleep(max(reset - now, 0))
+
+        headers = {'x-rate-limit-remaining': str(remaining),
+                   'x-rate-limit-reset': str(int(reset) + 1)}
+        if self.latency:
+            time.sleep(self.latency)
+        if self.error_rate and random.random() < self.error_rate:
+            with self.lock:
+                self.errors[slot] += 1
+            raise TweepError('Internal error',
+                             FakeResponse(503, headers,
+                                          endpoint_url(endpoint)),
+                             api_code=131)
+        return headers
+
+    def stats(self):
+        """
+        Returns the call counts per endpoint, the number of injected errors
+        and the rate limit idle time per key.
+        """
+        calls = {}
+        for key_idx in range(self.num_keys):
+            for idx, endpoint in enumerate(ENDPOINTS):
+                slot = key_idx * len(ENDPOINTS) + idx
+                calls[endpoint] = calls.get(endpoint, 0) + self.calls[slot]
+        return {
+            'calls': {endpoint: count for endpoint, count in calls.items()
+                      if count},
+            'total_calls': sum(self.calls),
+            'errors': sum(self.errors),
+            'idle_time_per_key': list(self.idle_time),
+        }
+
+
+class FakeAPI:
+    """
+    A local stand-in for tweepy.API, backed by a FakeTwitter.
+
+    It implements the methods used by the TaskManager, returns the same
+    tweepy models as tweepy.API, and sets last_response with the rate limit
+    headers of each call.
+    """
+
+    def __init__(self, twitter, key_idx, wait_on_rate_limit=True):
+        self.twitter = twitter
+        self.key_idx = key_idx
+        self.wait_on_rate_limit = wait_on_rate_limit
+        self.parser = ModelParser()
+        self.last_response = None
+
+    def _call(self, endpoint):
+        try:
+            headers = self.twitter.call(self.key_idx, endpoint,
+                                        self.wait_on_rate_limit)
+        except TweepError as e:
+            self.last_response = e.response
+            raise
+        self.last_response = FakeResponse(200, headers,
+                                          endpoint_url(endpoint))
+
+    def _not_found(self, api_code=50):
+        self.last_response = FakeResponse(404, self.last_response.headers,
+                                          self.last_response.url)
+        raise TweepError('Not found', self.last_response, api_code=api_code)
+
+    def _user_id(self, user_id):
+        user_id = str(user_id)
+        if user_id.startswith('user'):
+            user_id = user_id[4:]
+        return int(user_id) if user_id.isdigit() else None
+
+    def get_status(self, id, **kwargs):
+        self._call('/statuses/show/:id')
+        if not self.twitter.exists(id):
+            self._not_found(144)
+        return Status.parse(self, self.twitter.tweet_json(id))
+
+    def statuses_lookup(self, id_, **kwargs):
+        self._call('/statuses/lookup')
+        tweets = ResultSet()
+        for tweet_id in id_:
+            if self.twitter.exists(tweet_id):
+                tweets.append(Status.parse(self,
+                                           self.twitter.tweet_json(tweet_id)))
+        return tweets
+
+    def retweets(self, id, count=100, **kwargs):
+        self._call('/statuses/retweets/:id')
+        if not self.twitter.exists(id):
+            self._not_found(144)
+        retweet_count = self.twitter.tweet_json(id)['retweet_count']
+        num_retweets = min(retweet_count, 100, count)
+        retweets = ResultSet()
+        for idx in range(retweet_count - 1, retweet_count - num_retweets - 1,
+                         -1):
+            retweets.append(self._retweet(id, idx))
+        return retweets
+
+    def _retweet(self, tweet_id, idx):
+        retweet = self.twitter.tweet_json(int(tweet_id) + (idx + 1) *
+                                          TWEET_ID_BASE * 1000)
+        retweet['retweeted_status'] = self.twitter.tweet_json(tweet_id)
+        return Status.parse(self, retweet)
+
+    def search(self, q, count=15, since_id=None, max_id=None, **kwargs):
+        """
+        Supports the queries of SearchBackfillSource: "from:<screen name>"
+        returns the tweets of a user, including the ones older than its
+        timeline reaches, and "RT @<screen name>" the retweets of the tweet
+        since_id + 1, which is the since_id SearchBackfillSource passes.
+        """
+        self._call('/search/tweets')
+        count = min(int(count), 100)
+        since_id = int(since_id) if since_id is not None else 0
+        max_id = int(max_id) if max_id is not None else None
+        tweets = ResultSet()
+        if q.startswith('from:'):
+            user_id = self._user_id(q[len('from:'):])
+            statuses_count = self.twitter.user_json(user_id)[
+                'statuses_count']
+            for k in range(statuses_count, 0, -1):
+                tweet_id = user_id * TWEET_ID_BASE + k
+                if max_id is not None and tweet_id > max_id:
+                    continue
+                if tweet_id <= since_id or len(tweets) >= count:
+                    break
+                tweets.append(Status.parse(
+                    self, self.twitter.tweet_json(tweet_id)))
+        elif q.startswith('RT @'):
+            tweet_id = since_id + 1
+            retweet_count = self.twitter.tweet_json(tweet_id)['retweet_count']
+            for idx in range(retweet_count - 1, -1, -1):
+                retweet = self._retweet(tweet_id, idx)
+                if max_id is not None and retweet.id > max_id:
+                    continue
+                if len(tweets) >= count:
+                    break
+                tweets.append(retweet)
+        return tweets
+
+    def get_user(self, id=None, user_id=None, screen_name=None, **kwargs):
+        self._call('/users/show/:id')
+        user_id = self._user_id(id or user_id or screen_name)
+        if user_id is None or not self.twitter.exists(user_id):
+            self._not_found()
+        return User.parse(self, self.twitter.user_json(user_id))
+
+    def lookup_users(self, user_ids=None, screen_names=None, **kwargs):
+        self._call('/users/lookup')
+        users = ResultSet()
+        for user_id in list(user_ids or []) + list(screen_names or []):
+            user_id = self._user_id(user_id)
+            if user_id is not None and self.twitter.exists(user_id):
+                users.append(User.parse(self,
+                                        self.twitter.user_json(user_id)))
+        return users
+
+    def _ids(self, endpoint, kind, id=None, user_id=None, screen_name=None,
+             cursor=-1, **kwargs):
+        self._call(endpoint)
+        user_id = self._user_id(id or user_id or screen_name)
+        if user_id is None or not self.twitter.exists(user_id):
+            self._not_found()
+        page = 0 if cursor == -1 else int(cursor)
+        ids, next_cursor = self.twitter.ids_page(kind, user_id, page)
+        return ids, (page - 1 if page else 0, next_cursor)
+
+    def followers_ids(self, **kwargs):
+        return self._ids('/followers/ids', 'followers', **kwargs)
+    followers_ids.pagination_mode = 'cursor'
+
+    def friends_ids(self, **kwargs):
+        return self._ids('/friends/ids', 'friends', **kwargs)
+    friends_ids.pagination_mode = 'cursor'
+
+    def user_timeline(self, id=None, user_id=None, screen_name=None,
+                      count=20, since_id=None, max_id=None, **kwargs):
+        self._call('/statuses/user_timeline')
+        user_id = self._user_id(id or user_id or screen_name)
+        if user_id is None or not self.twitter.exists(user_id):
+            self._not_found()
+
+        tweets = ResultSet()
+        for tweet_id in self.twitter.timeline_ids(user_id):
+            if max_id is not None and tweet_id > int(max_id):
+                continue
+            if since_id is not None and tweet_id <= int(since_id):
+                break
+            tweets.append(Status.parse(self,
+                                       self.twitter.tweet_json(tweet_id)))
+            if len(tweets) >= min(int(count), 200):
+                break
+        return tweets
+
+    def verify_credentials(self, **kwargs):
+        try:
+            self._call('/account/verify_credentials')
+        except TweepError as e:
+            # tweepy.API returns False instead of raising on a 401
+            if e.response.status_code == 401:
+                return False
+            raise
+        return User.parse(self, self.twitter.user_json(self.key_idx + 1))
+
+    def rate_limit_status(self, **kwargs):
+        self._call('/application/rate_limit_status')
+        twitter = self.twitter
+        resources = {}
+        now = time.time()
+        with twitter.lock:
+            for idx, endpoint in enumerate(ENDPOINTS):
+                slot = self.key_idx * len(ENDPOINTS) + idx
+                limit = ENDPOINT_LIMITS[endpoint]
+                if now - twitter.window_start[slot] >= twitter.window:
+                    remaining, reset = limit, now + twitter.window
+                else:
+                    remaining = limit - twitter.window_calls[slot]
+                    reset = twitter.window_start[slot] + twitter.window
+                family = endpoint.split('/')[1]
+                resources.setdefault(family, {})[endpoint] = {
+                    'limit': limit, 'remaining': remaining,
+                    'reset': int(reset) + 1}
+        return {'resources': resources}
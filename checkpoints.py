@@ -0,0 +1,55 @@
+from storage import write_json_atomic
+import json
+import os
+import time
+
+
+class CheckpointStore:
+    """
+    Stores the pagination state of long running tasks on disk, so that a
+    retried or restarted task can resume from where it stopped instead of
+    starting over from the first page.
+
+    Each checkpoint is a JSON file named after the task and the user id. It
+    is written to a temporary file first and then renamed over the previous
+    checkpoint, so that a crash never leaves a partially written checkpoint
+    behind. Checkpoints older than max_age seconds are ignored, as the
+    cursors they store may no longer be valid.
+    """
+
+    def __init__(self, folder_path, max_age=24 * 60 * 60):
+        self.folder_path = folder_path
+        self.max_age = max_age
+        if not os.path.exists(self.folder_path):
+            os.makedirs(self.folder_path)
+
+    def _path(self, task_name, object_id):
+        return self.folder_path + task_name + '_' + str(object_id) + '.json'
+
+    def load(self, task_name, object_id):
+        """
+        Returns the state saved for a task, or None if there is no recent
+        checkpoint for it.
+        """
+        path = self._path(task_name, object_id)
+        if not os.path.exists(path):
+            return None
+
+        try:
+            with open(path) as f:
+                checkpoint = json.load(f)
+        except ValueError:
+            return None
+
+        if time.time() - checkpoint['updated_at'] > self.max_age:
+            return None
+        return checkpoint['state']
+
+    def save(self, task_name, object_id, state):
+        write_json_atomic(self._path(task_name, object_id),
+                          {'updated_at': time.time(), 'state': state})
+
+    def remove(self, task_name, object_id):
+        path = self._path(task_name, object_id)
+        if os.path.exists(path):
+            os.remove(path)
@@ -0,0 +1,254 @@
+"""
+Compacts the old timestamp folders of a base folder into a baseline.
+
+Usage (from the repository root, while no collection is running):
+    python compaction.py <root_dir> --keep-runs 7 --archive
+"""
+from id_sets import IDS_FILE_EXT, apply_delta
+from snapshots import DETAILS_DELTA_EXT, LastTweetIndex, SnapshotStore, \
+    apply_details_delta, load_delta
+from storage import TWEET_FILE_EXTS, OutputFolder, lock_folder, \
+    merge_tweets, read_tweets, write_bytes_atomic, write_json_atomic
+import argparse
+import gzip
+import json
+import os
+import shutil
+import tarfile
+
+BASELINE_FOLDER = 'baseline/'
+ARCHIVE_FOLDER = 'archive/'
+PACKED_EXT = '.jsonl.gz'
+
+
+def load_manifest(base_folder_path):
+    """
+    Returns the manifest of the baseline of a base folder, which lists the
+    runs compacted into it.
+    """
+    path = base_folder_path + BASELINE_FOLDER + 'manifest.json'
+    if not os.path.exists(path):
+        return {'compacted_through': None, 'runs': []}
+    with open(path) as f:
+        return json.load(f)
+
+
+def load_packed_objects(path):
+    """
+    Returns the JSON lines of a packed object file keyed by object id, or
+    an empty dict if there is no such file.
+    """
+    objects = {}
+    if os.path.exists(path):
+        with gzip.open(path, 'rt') as f:
+            for line in f:
+                objects[json.loads(line)['id_str']] = line.rstrip('\n')
+    return objects
+
+
+class Compactor:
+    """
+    Merges the timestamp folders of a base folder, except the newest
+    keep_runs, into the baseline folder of the base folder, so that the
+    cost of reading the history of a user does not grow with the number of
+    runs:
+    - The follower and followee snapshots of every user with a delta in the
+    compacted runs are brought up to the last compacted run.
+    - The last_tweet_index is brought up to the last compacted run.
+    - The timelines and retweets of the compacted runs are merged into one
+    gzip JSONL file per user and tweet, deduplicated by tweet id, in the
+    hashed subfolders of baseline/timelines/ and baseline/retweets/.
+    - The latest tweet_details and user_details of each tweet and user are
+    packed into baseline/tweet_details.jsonl.gz and user_details.jsonl.gz,
+    one JSON object per line, ordered by id. The deltas written with
+    change detection are applied to the previous version of their object.
+    - The dead letters are merged into baseline/dead_letters.txt.
+
+    The compacted runs are then recorded in baseline/manifest.json, and the
+    TaskManager no longer reads their folders. With archive set, each
+    compacted folder is packed into archive/<run>.tar.gz and removed, so
+    its per-run deltas can still be extracted. Otherwise it is left as is.
+
+    Every step can be repeated, so a compaction which was interrupted is
+    completed by running it again. Compaction takes an exclusive lock on
+    the base folder, and refuses to run while a TaskManager holds it.
+    """
+
+    def __init__(self, base_folder_path, keep_runs=1, compact_ids=False,
+                 archive=False):
+        if keep_runs < 1:
+            raise ValueError("At least the newest run must be kept")
+        self.base_folder_path = base_folder_path
+        self.baseline_folder_path = base_folder_path + BASELINE_FOLDER
+        self.keep_runs = keep_runs
+        self.archive = archive
+        self.snapshots = SnapshotStore(base_folder_path + 'snapshots/',
+                                       compact=compact_ids)
+        self.last_tweet_index = LastTweetIndex(
+            base_folder_path + 'snapshots/last_tweet/')
+
+    def runs_to_compact(self):
+        """
+        Returns the runs which are not compacted yet, except the newest
+        keep_runs, oldest first.
+        """
+        compacted_through = load_manifest(
+            self.base_folder_path)['compacted_through']
+        runs = sorted(
+            folder for folder in os.listdir(self.base_folder_path)
+            if os.path.isdir(self.base_folder_path + folder + '/twitter'))
+        return [run for run in runs[:-self.keep_runs]
+                if compacted_through is None or run > compacted_through]
+
+    def _run_folder(self, run, kind):
+        return OutputFolder(self.base_folder_path + run + '/twitter/' +
+                            kind + '/')
+
+    def _compact_ids(self, kind, runs):
+        user_ids = set()
+        for run in runs:
+            user_ids.update(user_id for user_id, _ in self._run_folder(
+                run, kind).files(('.json', IDS_FILE_EXT)))
+
+        for user_id in user_ids:
+            snapshot_run, all_ids = self.snapshots.load(kind, user_id)
+            if snapshot_run is not None and snapshot_run >= runs[-1]:
+                continue
+            for run in runs:
+                if snapshot_run is not None and run <= snapshot_run:
+                    continue
+                data = load_delta(self.base_folder_path + run + '/twitter/' +
+                                  kind + '/', user_id)
+                if data is not None:
+                    all_ids = apply_delta(all_ids, data[kind + '_added'],
+                                          data[kind + '_subtracted'])
+            self.snapshots.save(kind, user_id, runs[-1], all_ids)
+        return len(user_ids)
+
+    def _compact_tweets(self, kind, runs):
+        paths = {}
+        for run in runs:
+            for object_id, path in self._run_folder(run, kind).files(
+                    tuple(TWEET_FILE_EXTS.values())):
+                paths.setdefault(object_id, []).append((run, path))
+
+        baseline = OutputFolder(self.baseline_folder_path + kind + '/',
+                                sharded=True)
+        for object_id, run_paths in paths.items():
+            path = baseline.path(object_id, PACKED_EXT)
+            merge_tweets(path, (tweet for _, run_path in run_paths
+                                for tweet in read_tweets(run_path)),
+                         'gzip', path if os.path.exists(path) else None)
+
+            if kind == 'timelines':
+                newest_run = run_paths[-1][0]
+                indexed_run, _ = self.last_tweet_index.load(object_id)
+                if indexed_run is None or indexed_run < newest_run:
+                    newest_tweet = next(read_tweets(run_paths[-1][1]))
+                    self.last_tweet_index.save(object_id, newest_run,
+                                               newest_tweet['id'])
+        return len(paths)
+
+    def _compact_objects(self, kind, runs):
+        path = self.baseline_folder_path + kind + PACKED_EXT
+        objects = load_packed_objects(path)
+        for run in runs:
+            for object_id, object_path in self._run_folder(run, kind).files(
+                    ('.json', DETAILS_DELTA_EXT)):
+                with open(object_path) as f:
+                    obj = json.load(f)
+                if object_path.endswith(DETAILS_DELTA_EXT):
+                    if object_id not in objects:
+                        continue
+                    obj = apply_details_delta(
+                        json.loads(objects[object_id]), obj)
+                objects[object_id] = json.dumps(obj)
+        write_bytes_atomic(path, gzip.compress(''.join(
+            objects[object_id] + '\n' for object_id in
+            sorted(objects, key=int)).encode('utf-8')))
+        return len(objects)
+
+    def _compact_dead_letters(self, runs):
+        path = self.baseline_folder_path + 'dead_letters.txt'
+        lines = {}
+        for dead_letters_path in [path] + [
+                self.base_folder_path + run + '/twitter/dead_letters.txt'
+                for run in runs]:
+            if os.path.exists(dead_letters_path):
+                with open(dead_letters_path) as f:
+                    lines.update(dict.fromkeys(f.read().splitlines()))
+        write_bytes_atomic(path, ''.join(
+            line + '\n' for line in lines).encode('utf-8'))
+
+    def _archive_run(self, run):
+        archive_path = self.base_folder_path + ARCHIVE_FOLDER + run + \
+            '.tar.gz'
+        os.makedirs(self.base_folder_path + ARCHIVE_FOLDER, exist_ok=True)
+        with tarfile.open(archive_path + '.tmp', 'w:gz') as tar:
+            tar.add(self.base_folder_path + run, arcname=run)
+        os.replace(archive_path + '.tmp', archive_path)
+        shutil.rmtree(self.base_folder_path + run)
+
+    def run(self):
+        """
+        Compacts the runs returned by runs_to_compact, and returns them.
+        """
+        try:
+            lock_file = lock_folder(self.base_folder_path, exclusive=True)
+        except BlockingIOError:
+            raise RuntimeError("A collection is running in " +
+                               self.base_folder_path)
+
+        try:
+            runs = self.runs_to_compact()
+            if not runs:
+                print("Nothing to compact")
+                return runs
+
+            print("Compacting {} runs, {} to {}".format(len(runs), runs[0],
+                                                        runs[-1]))
+            os.makedirs(self.baseline_folder_path, exist_ok=True)
+            for kind in ('followers', 'followees'):
+                print("Snapshotted the {} of {} users".format(
+                    kind, self._compact_ids(kind, runs)))
+            for kind in ('timelines', 'retweets'):
+                print("Merged the {} of {} objects".format(
+                    kind, self._compact_tweets(kind, runs)))
+            for kind in ('tweet_details', 'user_details'):
+                print("Packed {} {}".format(
+                    self._compact_objects(kind, runs), kind))
+            self._compact_dead_letters(runs)
+
+            manifest = load_manifest(self.base_folder_path)
+            manifest['compacted_through'] = runs[-1]
+            manifest['runs'] = manifest['runs'] + runs
+            write_json_atomic(self.baseline_folder_path + 'manifest.json',
+                              manifest)
+
+            if self.archive:
+                for run in runs:
+                    self._archive_run(run)
+                print("Archived {} runs".format(len(runs)))
+            return runs
+        finally:
+            lock_file.close()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split(
+        '\n')[0])
+    parser.add_argument('root_dir')
+    parser.add_argument('--keep-runs', type=int, default=1,
+                        help="Number of newest runs left uncompacted")
+    parser.add_argument('--compact-ids', action='store_true',
+                        help="Store the snapshots as .ids files")
+    parser.add_argument('--archive', action='store_true',
+                        help="Pack the compacted runs into tar.gz files and "
+                        "remove their folders")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    Compactor(os.path.join(args.root_dir, ''), keep_runs=args.keep_runs,
+              compact_ids=args.compact_ids, archive=args.archive).run()
@@ -0,0 +1,163 @@
+"""
+Multi-hop crawl of the follower network of a set of users.
+"""
+from id_sets import IDS_FILE_EXT, compact_ids, diff_ids, load_ids, \
+    save_ids, union_ids
+import os
+
+
+class FollowerCrawl:
+    """
+    Fetches the followers of a set of seed users, then the followers of
+    those followers, and so on up to depth hops away from the seeds.
+
+    The users of each hop (the frontier) and all the users reached so far
+    are kept as compact id sets, so that a frontier of millions of users
+    takes 8 bytes per user, and users reached through several paths or in
+    an earlier hop are only crawled once. Users in the ignore list are
+    dropped from the frontier.
+
+    Each hop is processed in chunks of chunk_size users. The users of a
+    chunk are first fetched in bulk through users/lookup, and the ones above
+    the ignore thresholds of the followers tasks (task_type) are skipped,
+    along with protected and missing users, before any followers/ids call is
+    made for them. The followers of the remaining users are then fetched in
+    parallel by the TaskManager, and added to the next frontier.
+
+    The state of the crawl is checkpointed after every chunk, so that an
+    interrupted crawl of the same run resumes from the last chunk.
+    """
+
+    def __init__(self, task_manager, task_type, seed_ids, depth=2,
+                 chunk_size=10000, name='followers'):
+        self.task_manager = task_manager
+        self.task_type = task_type
+        self.seed_ids = [str(seed_id) for seed_id in seed_ids]
+        self.depth = depth
+        # Chunks must fit in the user cache, or the users prefetched for a
+        # chunk would be evicted before their tasks run.
+        self.chunk_size = min(chunk_size,
+                              int(task_manager.user_cache_size * 0.9))
+        self.checkpoint_path = task_manager.checkpoints.folder_path + \
+            'crawl_' + name + IDS_FILE_EXT
+
+    def _meta(self, hop, chunk_idx):
+        return {'run': self.task_manager.current_run, 'depth': self.depth,
+                'seeds': self.seed_ids, 'hop': hop, 'chunk_idx': chunk_idx}
+
+    def _load_checkpoint(self):
+        """
+        Returns the state saved by an interrupted crawl of the same run with
+        the same seeds and depth, or None.
+        """
+        if not os.path.exists(self.checkpoint_path):
+            return None
+        try:
+            meta, arrays = load_ids(self.checkpoint_path)
+        except (ValueError, OSError):
+            return None
+        if any(meta.get(key) != value
+               for key, value in self._meta(None, None).items()
+               if key not in ('hop', 'chunk_idx')):
+            return None
+        return meta, arrays
+
+    def _save_checkpoint(self, hop, chunk_idx, frontier, visited,
+                         next_frontier):
+        save_ids(self.checkpoint_path,
+                 {'frontier': frontier, 'visited': visited,
+                  'next_frontier': next_frontier},
+                 self._meta(hop, chunk_idx))
+
+    def _resolve_seeds(self, apis):
+        """
+        Returns the numeric ids of the seed users, looking up the ones given
+        as screen names.
+        """
+        task_manager = self.task_manager
+        task_manager.prefetch_users(self.seed_ids, apis)
+        seed_ids = []
+        for seed_id in self.seed_ids:
+            if seed_id.isdigit():
+                seed_ids.append(int(seed_id))
+                continue
+            user_json = task_manager.user_cache.get(seed_id)
+            if user_json is None:
+                print("Crawl: User {} not found, skipping".format(seed_id))
+            else:
+                seed_ids.append(int(user_json['id_str']))
+        return compact_ids(seed_ids)
+
+    def _filter_chunk(self, user_ids, apis):
+        """
+        Looks up the users of a chunk in bulk, and returns the ids of the
+        ones whose followers can and should be fetched.
+        """
+        task_manager = self.task_manager
+        user_ids = task_manager.user_ignore_list.filter(user_ids)
+        task_manager.prefetch_users(user_ids, apis)
+
+        return [user_json['id_str'] for user_json
+                in task_manager.user_cache.get_many(user_ids)
+                if not task_manager.should_skip_user(user_json,
+                                                     self.task_type) and
+                (not user_json.get('protected') or
+                 user_json.get('following'))]
+
+    def _exclude_ignored(self, ids):
+        return self.task_manager.user_ignore_list.exclude(ids)
+
+    def run(self, apis):
+        """
+        Crawls the follower network and returns the compact id set of all
+        the users reached, seeds included.
+        """
+        task_manager = self.task_manager
+        checkpoint = self._load_checkpoint()
+        if checkpoint is not None:
+            meta, arrays = checkpoint
+            hop, start_chunk = meta['hop'], meta['chunk_idx']
+            frontier = arrays['frontier']
+            visited = arrays['visited']
+            next_frontier = arrays['next_frontier']
+            task_manager._log("Crawl: Resuming hop {} at chunk {}".format(
+                hop + 1, start_chunk))
+        else:
+            hop, start_chunk = 0, 0
+            frontier = self._exclude_ignored(self._resolve_seeds(apis))
+            visited = frontier
+            next_frontier = compact_ids(())
+
+        while hop < self.depth and len(frontier):
+            num_chunks = (len(frontier) - 1) // self.chunk_size + 1
+            task_manager._log("Crawl: Hop {} of {}, {} users in {} "
+                              "chunks".format(hop + 1, self.depth,
+                                              len(frontier), num_chunks))
+            for chunk_idx in range(start_chunk, num_chunks):
+                chunk = [str(user_id) for user_id in frontier[
+                    chunk_idx * self.chunk_size:
+                    (chunk_idx + 1) * self.chunk_size]]
+                user_ids = self._filter_chunk(chunk, apis)
+                task_manager.get_followers(user_ids)
+                task_manager.run_tasks(apis)
+
+                # The followers of each user are made compact as soon as
+                # they are loaded, so that only one Python set of ids is
+                # held at a time
+                followers = [next_frontier]
+                for user_id in user_ids:
+                    followers.append(compact_ids(
+                        task_manager.get_all_followers(user_id)))
+                next_frontier = union_ids(followers)
+                self._save_checkpoint(hop, chunk_idx + 1, frontier, visited,
+                                      next_frontier)
+
+            frontier = self._exclude_ignored(
+                diff_ids(next_frontier, visited)[0])
+            visited = union_ids([visited, frontier])
+            next_frontier = compact_ids(())
+            hop += 1
+            start_chunk = 0
+            self._save_checkpoint(hop, 0, frontier, visited, next_frontier)
+
+        return visited
@@ -0,0 +1,148 @@
+from multiprocessing import Process, current_process
+import threading
+
+
+def worker_name():
+    """
+    Returns the name of the current worker: the name of the thread for the
+    workers of a ThreadEngine, and the name of the process otherwise.
+    """
+    thread = threading.current_thread()
+    if thread is threading.main_thread():
+        return current_process().name
+    return thread.name
+
+
+class ExecutionEngine:
+    """
+    Runs one worker per API key, each of which calls target(api, key_idx)
+    and returns once it receives a shutdown sentinel from the task queue, or
+    once its key is no longer active.
+
+    start is given the (key_idx, api) of the keys to start workers for, and
+    can be called again to start the workers of keys added later on.
+
+    Subclasses define where the workers run, and record the key indices
+    run by each of them in worker_keys. All the state shared between
+    workers lives in the manager process, so a worker behaves the same
+    whether it runs in a process or in a thread.
+    """
+
+    def __init__(self):
+        self.workers = []
+        self.worker_keys = []
+        self.num_workers = 0
+
+    def start(self, target, keyed_apis):
+        raise NotImplementedError
+
+    def is_running(self):
+        return bool(self.workers)
+
+    def _add_worker(self, worker, key_idxs):
+        self.workers.append(worker)
+        self.worker_keys.append(key_idxs)
+        self.num_workers += len(key_idxs)
+
+    def exited_keys(self):
+        """
+        Returns the key indices of the workers which have exited since the
+        last call, and stops tracking those workers.
+        """
+        key_idxs = []
+        workers = []
+        worker_keys = []
+        for worker, worker_key_idxs in zip(self.workers, self.worker_keys):
+            if worker.is_alive():
+                workers.append(worker)
+                worker_keys.append(worker_key_idxs)
+            else:
+                key_idxs.extend(worker_key_idxs)
+        self.workers = workers
+        self.worker_keys = worker_keys
+        self.num_workers -= len(key_idxs)
+        return key_idxs
+
+    def join(self):
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+        self.worker_keys = []
+        self.num_workers = 0
+
+
+class ProcessEngine(ExecutionEngine):
+    """
+    Runs each worker in its own process. This was the only engine before
+    execution engines were pluggable, and remains the default.
+    """
+
+    def start(self, target, keyed_apis):
+        for key_idx, api in keyed_apis:
+            p = Process(target=target, args=(api, key_idx), daemon=True)
+            p.start()
+            self._add_worker(p, [key_idx])
+
+
+def _run_threads(target, keyed_apis):
+    threads = []
+    for key_idx, api in keyed_apis:
+        t = threading.Thread(target=target, args=(api, key_idx),
+                             name='Worker-' + str(key_idx), daemon=True)
+        threads.append(t)
+        t.start()
+    for t in threads:
+        t.join()
+
+
+class ThreadEngine(ExecutionEngine):
+    """
+    Runs each worker in a thread, so that a single process can drive many
+    API keys. The workers spend most of their time waiting on HTTP
+    responses and rate limit windows, during which they release the GIL.
+
+    With shards greater than 1, the keys are split across that many
+    processes, each of which runs the threads of its keys. This spreads
+    the CPU bound work, such as parsing and encoding JSON, over several
+    cores.
+    """
+
+    def __init__(self, shards=1):
+        super().__init__()
+        self.shards = shards
+
+    def start(self, target, keyed_apis):
+        if self.shards <= 1:
+            for key_idx, api in keyed_apis:
+                t = threading.Thread(target=target, args=(api, key_idx),
+                                     name='Worker-' + str(key_idx),
+                                     daemon=True)
+                t.start()
+                self._add_worker(t, [key_idx])
+        else:
+            for shard_idx in range(min(self.shards, len(keyed_apis))):
+                shard_keyed_apis = keyed_apis[shard_idx::self.shards]
+                p = Process(target=_run_threads,
+                            args=(target, shard_keyed_apis),
+                            name='Shard-' + str(shard_idx), daemon=True)
+                p.start()
+                self._add_worker(p, [key_idx for key_idx, _
+                                     in shard_keyed_apis])
+
+
+ENGINES = {
+    'process': ProcessEngine,
+    'thread': ThreadEngine,
+}
+
+
+def create_engine(engine='process', **kwargs):
+    """
+    Returns the execution engine with the given name, or the engine itself
+    if an ExecutionEngine instance is passed.
+    """
+    if isinstance(engine, ExecutionEngine):
+        return engine
+    if engine not in ENGINES:
+        raise ValueError("Unknown execution engine: " + str(engine))
+    return ENGINES[engine](**kwargs)
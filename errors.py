@@ -0,0 +1,106 @@
+from enum import Enum
+import random
+import requests
+import tweepy
+
+# Twitter API error codes, see
+# https://developer.twitter.com/en/support/twitter-api/error-troubleshooting
+RATE_LIMIT_CODES = {88}
+# Over capacity, internal error
+TRANSIENT_CODES = {130, 131}
+# No such page, no such user, suspended account, no such status, not
+# authorized to see the status, blocked by the user
+PERMANENT_CODES = {34, 50, 63, 144, 179, 136}
+# Could not authenticate, account of the key suspended, invalid or expired
+# token, bad authentication data, account of the key locked
+KEY_CODES = {32, 64, 89, 215, 326}
+# Unauthorized (protected accounts), forbidden, not found, gone
+PERMANENT_STATUS_CODES = {401, 403, 404, 410}
+
+
+class ErrorKind(Enum):
+    """
+    The kinds of errors a task can fail with, which determine how the
+    TaskManager handles the task.
+    - rate_limit: the task is handed over to a key with budget left.
+    - transient: the task is retried with backoff, preferably by another
+    key.
+    - permanent: the object cannot be fetched, the task is dead-lettered.
+    - other: any other error, the task is marked as failed.
+    - key: the API key was rejected (revoked, suspended or locked), the key
+    is quarantined and the task is handed over to another key.
+    """
+    rate_limit = 0
+    transient = 1
+    permanent = 2
+    other = 3
+    key = 4
+
+
+class PermanentTaskError(Exception):
+    """
+    Raised by a task for an object which cannot be fetched, such as a
+    protected account.
+    """
+    pass
+
+
+def classify_error(e):
+    """
+    Returns the ErrorKind of an exception raised while executing a task.
+    """
+    if isinstance(e, tweepy.RateLimitError):
+        return ErrorKind.rate_limit
+    if isinstance(e, PermanentTaskError):
+        return ErrorKind.permanent
+    if isinstance(e, (requests.ConnectionError, requests.Timeout,
+                      ConnectionError, TimeoutError)):
+        return ErrorKind.transient
+    if not isinstance(e, tweepy.TweepError):
+        return ErrorKind.other
+
+    api_code = getattr(e, 'api_code', None)
+    if api_code in RATE_LIMIT_CODES:
+        return ErrorKind.rate_limit
+    if api_code in KEY_CODES:
+        return ErrorKind.key
+    if api_code in TRANSIENT_CODES:
+        return ErrorKind.transient
+    if api_code in PERMANENT_CODES:
+        return ErrorKind.permanent
+
+    if e.response is None:
+        # tweepy raises a TweepError without a response when the request
+        # could not be sent at all, e.g. on connection errors and timeouts.
+        return ErrorKind.transient
+    status_code = e.response.status_code
+    if status_code == 429:
+        return ErrorKind.rate_limit
+    if status_code >= 500:
+        return ErrorKind.transient
+    if status_code in PERMANENT_STATUS_CODES:
+        return ErrorKind.permanent
+    return ErrorKind.other
+
+
+def backoff_delay(num_retries, base=2.0, cap=300.0):
+    """
+    Returns the number of seconds to wait before the given retry of a task:
+    an exponential backoff with equal jitter, capped at cap seconds.
+    """
+    delay = min(cap, base * 2 ** max(num_retries - 1, 0))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def error_description(e):
+    """
+    Returns a single line description of an exception.
+    """
+    api_code = getattr(e, 'api_code', None)
+    response = getattr(e, 'response', None)
+    description = ' '.join(str(e).split())
+    if api_code is not None:
+        description = 'code {}: {}'.format(api_code, description)
+    elif response is not None:
+        description = 'HTTP {}: {}'.format(response.status_code, description)
+    return description
@@ -0,0 +1,156 @@
+"""
+Compact storage and set operations for large sets of Twitter ids.
+
+A compact id set is a sorted array of unique int64 ids: a NumPy array when
+NumPy is installed, and an array('q') otherwise. It takes 8 bytes per id,
+instead of the ~60 bytes per id of a Python set of ints, and the difference
+of two id sets is computed with a sorted merge instead of hash lookups.
+
+Compact id sets are stored in .ids files, which hold a small JSON header
+followed by one or more named int64 arrays.
+"""
+from array import array
+from storage import write_bytes_atomic
+import json
+import struct
+import sys
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+IDS_MAGIC = b'PTI1'
+IDS_FILE_EXT = '.ids'
+
+
+def compact_ids(ids):
+    """
+    Returns the given ids as a compact id set.
+    """
+    if np is not None:
+        if not isinstance(ids, (list, array, np.ndarray)):
+            ids = np.fromiter(ids, dtype=np.int64)
+        return np.unique(np.asarray(ids, dtype=np.int64))
+    return array('q', sorted(set(ids)))
+
+
+def union_ids(id_sets):
+    """
+    Returns the union of the given Python sets, compact id sets or lists of
+    ids as a compact id set.
+    """
+    if np is not None:
+        arrays = [np.fromiter(ids, dtype=np.int64) if isinstance(ids, set)
+                  else np.asarray(ids, dtype=np.int64) for ids in id_sets]
+        if not arrays:
+            return compact_ids(())
+        return np.unique(np.concatenate(arrays))
+
+    merged = array('q')
+    for ids in id_sets:
+        merged.extend(ids)
+    return compact_ids(merged)
+
+
+def empty_ids(compact):
+    return compact_ids(()) if compact else set()
+
+
+def diff_ids(current_ids, previous_ids):
+    """
+    Returns the lists of ids added to and subtracted from previous_ids to
+    obtain current_ids. Both must either be Python sets or compact id sets.
+    """
+    if isinstance(current_ids, set):
+        return ([item for item in current_ids if item not in previous_ids],
+                [item for item in previous_ids if item not in current_ids])
+
+    if np is not None:
+        return (np.setdiff1d(current_ids, previous_ids, assume_unique=True),
+                np.setdiff1d(previous_ids, current_ids, assume_unique=True))
+
+    added = array('q')
+    subtracted = array('q')
+    i = j = 0
+    while i < len(current_ids) and j < len(previous_ids):
+        if current_ids[i] == previous_ids[j]:
+            i += 1
+            j += 1
+        elif current_ids[i] < previous_ids[j]:
+            added.append(current_ids[i])
+            i += 1
+        else:
+            subtracted.append(previous_ids[j])
+            j += 1
+    added.extend(current_ids[i:])
+    subtracted.extend(previous_ids[j:])
+    return added, subtracted
+
+
+def apply_delta(ids, added, subtracted):
+    """
+    Returns the id set obtained by adding and subtracting the given ids.
+    Python sets are updated in place.
+    """
+    if isinstance(ids, set):
+        ids.update(int(item) for item in added)
+        ids.difference_update(int(item) for item in subtracted)
+        return ids
+
+    added = compact_ids(added)
+    subtracted = compact_ids(subtracted)
+    if np is not None:
+        return np.setdiff1d(np.union1d(ids, added), subtracted,
+                            assume_unique=True)
+    merged, _ = diff_ids(compact_ids(list(ids) + list(added)), subtracted)
+    return merged
+
+
+def _to_bytes(ids):
+    if np is not None:
+        return np.asarray(ids, dtype='<i8').tobytes()
+    ids = array('q', ids)
+    if sys.byteorder != 'little':
+        ids.byteswap()
+    return ids.tobytes()
+
+
+def _from_bytes(data):
+    if np is not None:
+        return np.frombuffer(data, dtype='<i8').astype(np.int64)
+    ids = array('q')
+    ids.frombytes(data)
+    if sys.byteorder != 'little':
+        ids.byteswap()
+    return ids
+
+
+def save_ids(path, arrays, meta=None):
+    """
+    Atomically writes a dict of named id arrays, and an optional dict of
+    JSON metadata, to an .ids file.
+    """
+    names = list(arrays)
+    header = json.dumps({'meta': meta or {},
+                         'arrays': [[name, len(arrays[name])]
+                                    for name in names]}).encode('utf-8')
+    chunks = [IDS_MAGIC, struct.pack('<I', len(header)), header]
+    chunks.extend(_to_bytes(arrays[name]) for name in names)
+    write_bytes_atomic(path, b''.join(chunks))
+
+
+def load_ids(path):
+    """
+    Reads an .ids file, returning its metadata and a dict of the compact id
+    arrays it contains.
+    """
+    with open(path, 'rb') as f:
+        if f.read(4) != IDS_MAGIC:
+            raise ValueError("Not an ids file: " + path)
+        header_len, = struct.unpack('<I', f.read(4))
+        header = json.loads(f.read(header_len).decode('utf-8'))
+        arrays = {}
+        for name, length in header['arrays']:
+            arrays[name] = _from_bytes(f.read(length * 8))
+    return header['meta'], arrays
@@ -0,0 +1,120 @@
+from id_sets import compact_ids, diff_ids
+import hashlib
+import math
+import os
+import threading
+
+
+class BloomFilter:
+    """
+    A Bloom filter of strings, sized for capacity items with a false
+    positive rate of error_rate. At the default error rate it takes about
+    1.8 bytes per item, instead of the ~70 bytes per item of a set of id
+    strings.
+    """
+
+    def __init__(self, capacity, error_rate=0.001):
+        self.num_bits = max(8, int(math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.num_hashes = max(1, int(round(
+            self.num_bits / capacity * math.log(2))))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+
+    def _positions(self, item):
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, item):
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item):
+        return all(self.bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(item))
+
+
+class IgnoreList:
+    """
+    The user ignore list of a base folder, shared by the TaskManager and all
+    its workers.
+
+    It lives in the manager process, which is the only one writing to the
+    user_ignore_list.txt file, under a lock, so that the users ignored by
+    concurrent workers are appended once each and never interleaved. Users
+    ignored during a run are seen by every later lookup of the same run.
+
+    The ids are kept in a set of strings. With bloom_capacity set, they are
+    kept in a BloomFilter sized for that many users instead, which is much
+    smaller for very large lists, at the cost of wrongly ignoring a
+    fraction error_rate of the other users.
+    """
+
+    def __init__(self, path, bloom_capacity=None, error_rate=0.001):
+        self.path = path
+        self.lock = threading.Lock()
+        self.num_ids = 0
+        if bloom_capacity:
+            self.ids = BloomFilter(bloom_capacity, error_rate)
+        else:
+            self.ids = set()
+        self.compact = None
+
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    user_id = line.strip()
+                    if user_id and user_id not in self.ids:
+                        self.ids.add(user_id)
+                        self.num_ids += 1
+
+    def __contains__(self, user_id):
+        return str(user_id) in self.ids
+
+    def __len__(self):
+        return self.num_ids
+
+    def filter(self, user_ids):
+        """
+        Returns the given user ids which are not in the ignore list.
+        """
+        return [user_id for user_id in user_ids
+                if str(user_id) not in self.ids]
+
+    def exclude(self, ids):
+        """
+        Returns the compact id set of the given compact ids which are not in
+        the ignore list.
+        """
+        if isinstance(self.ids, BloomFilter):
+            return compact_ids([user_id for user_id in ids
+                                if str(user_id) not in self.ids])
+        with self.lock:
+            if self.compact is None:
+                self.compact = compact_ids(
+                    int(user_id) for user_id in self.ids
+                    if user_id.isdigit())
+            ignored = self.compact
+        return diff_ids(ids, ignored)[0]
+
+    def add(self, user_ids):
+        """
+        Adds the given user ids to the ignore list and appends the ones
+        which were not in it yet to its file. Returns the ids added.
+        """
+        with self.lock:
+            added = []
+            for user_id in dict.fromkeys(str(user_id)
+                                         for user_id in user_ids):
+                if user_id not in self.ids:
+                    self.ids.add(user_id)
+                    added.append(user_id)
+            if not added:
+                return added
+
+            self.num_ids += len(added)
+            self.compact = None
+            with open(self.path, 'a') as fw:
+                fw.write(''.join(user_id + '\n' for user_id in added))
+        return added
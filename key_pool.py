@@ -0,0 +1,302 @@
+"""
+The pool of API keys used by the workers of a TaskManager, and the health of
+each key.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from errors import error_description
+import configparser
+import os
+import threading
+import tweepy
+
+# Prefix of the sections of the settings file holding the API keys
+KEY_SECTION_PREFIX = 'API Keys'
+KEY_FIELDS = ('API_KEY', 'API_SECRET', 'ACCESS_TOKEN', 'ACCESS_TOKEN_SECRET')
+
+# Number of keys verified at once
+VERIFY_THREADS = 16
+
+ACTIVE = 'active'
+QUARANTINED = 'quarantined'
+REMOVED = 'removed'
+
+# Task outcomes which count as successes and failures of the key that ran
+# the task in its success rate. Only the key errors count as failures: the
+# transient errors (such as Twitter outages) and the other errors are not
+# caused by the key, and rate limited tasks count as neither.
+SUCCESS_OUTCOMES = ('done', 'dead_letter')
+FAILURE_OUTCOMES = ('key_error',)
+
+
+def load_key_config(settings_file):
+    """
+    Returns the credentials of every API key section of a settings file,
+    keyed by section name, in the order of the file.
+    """
+    config = configparser.ConfigParser()
+    with open(settings_file) as f:
+        config.read_file(f)
+    return {section: tuple(config.get(section, field) for field in KEY_FIELDS)
+            for section in config.sections()
+            if section.startswith(KEY_SECTION_PREFIX)}
+
+
+def create_api(credentials, **api_kwargs):
+    consumer_key, consumer_secret, access_token_key, access_token_secret = \
+        credentials
+    auth = tweepy.OAuthHandler(consumer_key, consumer_secret)
+    auth.set_access_token(access_token_key, access_token_secret)
+    return tweepy.API(auth, **api_kwargs)
+
+
+def verify_api(api):
+    """
+    Checks that the API key of an API object is accepted by Twitter. Returns
+    None if it is, or a description of the error otherwise.
+    """
+    try:
+        if api.verify_credentials() is False:
+            return "invalid or revoked credentials"
+    except Exception as e:
+        return error_description(e)
+    return None
+
+
+class KeyHealth:
+    """
+    The health of every API key used by the workers of a TaskManager. It
+    lives in the manager process and is shared by all the workers.
+
+    Each key is active, quarantined or removed, and only active keys take
+    tasks. A key is quarantined as soon as a call is rejected because of the
+    key itself (ErrorKind.key), and reinstated once it is accepted again.
+    Keys which are not registered are active, so that plain lists of API
+    objects work without a KeyPool.
+
+    The number of tasks per outcome, the number of API calls and the time
+    spent in them are kept for each key.
+    """
+
+    def __init__(self):
+        self.keys = {}
+        self.lock = threading.Lock()
+
+    def _key(self, key_idx):
+        if key_idx not in self.keys:
+            self.keys[key_idx] = {
+                'name': 'key ' + str(key_idx), 'status': ACTIVE,
+                'reason': None, 'outcomes': {}, 'num_calls': 0,
+                'api_seconds': 0.0}
+        return self.keys[key_idx]
+
+    def register(self, key_idx, name):
+        with self.lock:
+            self._key(key_idx)['name'] = name
+
+    def record(self, key_idx, outcome, num_calls=0, api_seconds=0.0):
+        """
+        Records the outcome of a task run with a key, and the number of API
+        calls it made and the time they took.
+        """
+        with self.lock:
+            key = self._key(key_idx)
+            key['outcomes'][outcome] = key['outcomes'].get(outcome, 0) + 1
+            key['num_calls'] += num_calls
+            key['api_seconds'] += api_seconds
+
+    def quarantine(self, key_idx, reason):
+        """
+        Quarantines an active key. Returns whether it was active.
+        """
+        with self.lock:
+            key = self._key(key_idx)
+            if key['status'] != ACTIVE:
+                return False
+            key['status'] = QUARANTINED
+            key['reason'] = reason
+            return True
+
+    def reinstate(self, key_idx):
+        """
+        Makes a quarantined key active again. Returns whether it was
+        quarantined.
+        """
+        with self.lock:
+            key = self._key(key_idx)
+            if key['status'] != QUARANTINED:
+                return False
+            key['status'] = ACTIVE
+            key['reason'] = None
+            return True
+
+    def remove(self, key_idx):
+        with self.lock:
+            key = self._key(key_idx)
+            key['status'] = REMOVED
+            key['reason'] = "removed from the pool"
+
+    def status(self, key_idx):
+        with self.lock:
+            key = self.keys.get(key_idx)
+            return ACTIVE if key is None else key['status']
+
+    def is_active(self, key_idx):
+        return self.status(key_idx) == ACTIVE
+
+    def statuses(self):
+        """
+        Returns the status of every registered key, keyed by key index.
+        """
+        with self.lock:
+            return {key_idx: key['status']
+                    for key_idx, key in self.keys.items()}
+
+    def stats(self):
+        """
+        Returns the name, status, reason, task outcomes, success rate and
+        mean API call latency of every registered key, keyed by key index.
+        """
+        stats = {}
+        with self.lock:
+            for key_idx, key in self.keys.items():
+                num_successes = sum(key['outcomes'].get(outcome, 0)
+                                    for outcome in SUCCESS_OUTCOMES)
+                num_failures = sum(key['outcomes'].get(outcome, 0)
+                                   for outcome in FAILURE_OUTCOMES)
+                num_tasks = num_successes + num_failures
+                stats[key_idx] = {
+                    'name': key['name'],
+                    'status': key['status'],
+                    'reason': key['reason'],
+                    'outcomes': dict(key['outcomes']),
+                    'success_rate': num_successes / num_tasks
+                    if num_tasks else None,
+                    'mean_call_seconds': key['api_seconds'] / key['num_calls']
+                    if key['num_calls'] else None,
+                }
+        return stats
+
+
+class KeyPool:
+    """
+    The API keys of every 'API Keys <n>' section of a settings file (see
+    apikeys/apikeys.txt), as API objects created with api_kwargs.
+
+    The keys are verified in parallel before they are added to the pool,
+    and keys which Twitter rejects are left out. Every key keeps the index
+    it was added with, which is the key_idx of its worker.
+
+    The settings file is read again by refresh whenever it changes: the
+    keys of new sections (and of sections left out earlier) are verified
+    and added, and the keys of the sections which were removed or whose
+    credentials changed are removed. A TaskManager given a KeyPool calls
+    refresh while its tasks run, so keys can be added and removed without
+    restarting the run. Keys can also be added and removed with add and
+    remove.
+
+    A KeyPool can be passed to the TaskManager wherever a list of API
+    objects is expected. Without a settings_file, it only holds the keys
+    added with add.
+    """
+
+    def __init__(self, settings_file, api_kwargs=None, verify=True):
+        self.settings_file = settings_file
+        self.api_kwargs = api_kwargs or {}
+        self.verify = verify
+        # (name, credentials, api) of every key added, None once removed
+        self.keys = []
+        self.mtime = None
+        self.lock = threading.Lock()
+        self.refresh()
+
+    def __len__(self):
+        return len(self.keyed_apis())
+
+    def keyed_apis(self):
+        """
+        Returns the (key_idx, api) of the keys in the pool.
+        """
+        return [(key_idx, key[2]) for key_idx, key in enumerate(self.keys)
+                if key is not None]
+
+    def name(self, key_idx):
+        key = self.keys[key_idx] if key_idx < len(self.keys) else None
+        return key[0] if key is not None else 'key ' + str(key_idx)
+
+    def _verify_all(self, apis):
+        if not self.verify:
+            return [None] * len(apis)
+        with ThreadPoolExecutor(min(VERIFY_THREADS, len(apis))) as executor:
+            return list(executor.map(verify_api, apis))
+
+    def add(self, name, api, credentials=None):
+        """
+        Adds an API object to the pool, and returns its key index.
+        """
+        with self.lock:
+            self.keys.append((name, credentials, api))
+            return len(self.keys) - 1
+
+    def remove(self, name):
+        """
+        Removes the keys with the given name from the pool, and returns their
+        key indices.
+        """
+        with self.lock:
+            removed = [key_idx for key_idx, key in enumerate(self.keys)
+                       if key is not None and key[0] == name]
+            for key_idx in removed:
+                self.keys[key_idx] = None
+        return removed
+
+    def refresh(self):
+        """
+        Reads the settings file again if it changed since it was last read,
+        and adds and removes keys accordingly. Returns the indices of the keys
+        added and removed.
+        """
+        if self.settings_file is None:
+            return [], []
+        try:
+            mtime = os.path.getmtime(self.settings_file)
+        except OSError as e:
+            print("Error while reading API keys: " + str(e))
+            return [], []
+        if mtime == self.mtime:
+            return [], []
+        self.mtime = mtime
+        config = load_key_config(self.settings_file)
+
+        removed = []
+        current = set()
+        for key in self.keys:
+            if key is None or key[1] is None:
+                continue
+            if config.get(key[0]) == key[1]:
+                current.add(key[0])
+            else:
+                removed.extend(self.remove(key[0]))
+
+        new_keys = []
+        for name, credentials in config.items():
+            if name in current:
+                continue
+            try:
+                new_keys.append((name, credentials,
+                                 create_api(credentials, **self.api_kwargs)))
+            except Exception as e:
+                print("Error while creating API object: " + str(e))
+        if not new_keys:
+            return [], removed
+
+        print("Verifying {} API keys".format(len(new_keys)))
+        added = []
+        for (name, credentials, api), error in zip(
+                new_keys, self._verify_all([key[2] for key in new_keys])):
+            if error is not None:
+                print("Error: API key {} was rejected ({}), leaving it out "
+                      "until {} changes".format(name, error,
+                                                self.settings_file))
+                continue
+            added.append(self.add(name, api, credentials))
+        return added, removed
@@ -1,8 +1,7 @@
-import configparser
-import tweepy
 import os
 import json
-from task_manager import TaskManager
+from key_pool import KeyPool
+from task_manager import PIPELINE_FOLLOW_UPS, TaskManager, TaskType
 import datetime
 
 
@@ -11,19 +10,9 @@ def get_twohop_followers(user_ids, task_manager, apis):
     Fetches the two-hop follower network of the given users.
     Two-hop follower network referes to the entire network of the
     followers of a user as well as the followers of those followers.
+    Returns the ids of all the users in the network.
     """
-    task_manager.get_followers(user_ids)
-    task_manager.run_tasks(apis)
-
-    all_followers = set()
-    for followers_file in os.listdir(task_manager.follower_folder_path):
-        if '.json' not in followers_file:
-            continue
-        all_followers.update(
-            task_manager.get_all_followers(followers_file[:-5]))
-
-    task_manager.get_followers(user_ids)
-    task_manager.run_tasks(apis)
+    return task_manager.crawl_followers(user_ids, apis, depth=2)
 
 
 def get_authors(tweet_objects):
@@ -51,12 +40,11 @@ def process_users(user_ids, user_ignore_list, task_manager, apis):
     filtered_user_ids = [user_id for user_id in user_ids
                          if user_id not in user_ignore_list]
 
+    # The three task types call different endpoints, so they are run in a
+    # single phase to let the workers interleave them as their rate limits
+    # allow.
     task_manager.get_followers(filtered_user_ids)
-    task_manager.run_tasks(apis)
-
     task_manager.get_followees(filtered_user_ids)
-    task_manager.run_tasks(apis)
-
     task_manager.get_timelines(filtered_user_ids)
     task_manager.run_tasks(apis)
 
@@ -73,18 +61,7 @@ def process_tweets(tweet_ids, user_ignore_list, task_manager, apis):
     task_manager.get_tweet_details(tweet_ids)
     task_manager.run_tasks(apis)
 
-    tweet_objects = []
-    tweet_details = []
-    for tweet_details_file in os.listdir(
-            task_manager.tweet_details_folder_path):
-        if '.json' not in tweet_details_file:
-            continue
-        with open(task_manager.tweet_details_folder_path +
-                  tweet_details_file) as f:
-            obj = json.load(f)
-            tweet_objects.append(obj)
-            tweet_details.append((tweet_details_file[:-5],
-                                 obj['user']['id_str']))
+    tweet_details = task_manager.get_tweet_authors(tweet_ids)
 
     filtered_user_ids = []
     filtered_tweet_ids = []
@@ -100,47 +77,48 @@ def process_tweets(tweet_ids, user_ignore_list, task_manager, apis):
     process_users(filtered_user_ids, user_ignore_list, task_manager, apis)
 
 
-def create_api_objects():
+def process_pipelined(tweet_ids, user_ids, user_ignore_list, task_manager,
+                      apis):
     """
-    Creates the api objects from the config file.
+    Fetches the same data as process_tweets followed by process_users, in a
+    single phase. The task_manager must have been created with the
+    PIPELINE_FOLLOW_UPS, so that the retweets and the user tasks of the
+    author of a tweet are enqueued as soon as the tweet is fetched.
     """
-    settings_file = "apikeys/apikeys.txt"
-    # Read config settings
-    config = configparser.ConfigParser()
-    config.readfp(open(settings_file))
-
-    # Create API objects for each of the API keys
-    # 1-based indexing of config file
-    start_idx = 1
-    end_idx = 2
-    num_api_keys = end_idx - start_idx + 1
-
-    apis = []
-
-    print("Creating api objects for {} API keys".format(num_api_keys))
-    for api_idx in range(start_idx, end_idx + 1):
-        consumer_key = config.get('API Keys ' + str(api_idx), 'API_KEY')
-        consumer_secret = config.get('API Keys ' + str(api_idx), 'API_SECRET')
-        access_token_key = config.get('API Keys ' + str(api_idx),
-                                      'ACCESS_TOKEN')
-        access_token_secret = config.get('API Keys ' + str(api_idx),
-                                         'ACCESS_TOKEN_SECRET')
-
-        # Connect to Twitter API
-        try:
-            auth = tweepy.OAuthHandler(consumer_key, consumer_secret)
-            auth.set_access_token(access_token_key, access_token_secret)
-            api = tweepy.API(auth, wait_on_rate_limit=True)
-        except Exception as e:
-            print("Error while creating API object: " + str(e))
-            continue
-        else:
-            apis.append(api)
+    # Tweets fetched by an earlier session of the same run are not fetched
+    # again, so their follow-up tasks are staged from their files.
+    tweet_details_folder = task_manager.output_folders[TaskType.tweet_details]
+    fetched_tweets = []
+    for tweet_id in tweet_ids:
+        if tweet_details_folder.contains(tweet_id, ('.json',)):
+            with open(tweet_details_folder.find(tweet_id, ('.json',))) as f:
+                fetched_tweets.append(json.load(f))
+    task_manager.stage_follow_ups(TaskType.tweet_details, fetched_tweets)
+
+    task_manager.get_tweet_details(tweet_ids)
+
+    filtered_user_ids = [user_id for user_id in user_ids
+                         if user_id not in user_ignore_list]
+    task_manager.get_followers(filtered_user_ids)
+    task_manager.get_followees(filtered_user_ids)
+    task_manager.get_timelines(filtered_user_ids)
+    task_manager.run_tasks(apis)
 
+
+def create_api_objects(settings_file="apikeys/apikeys.txt"):
+    """
+    Creates the api objects of all the API keys in the config file, and
+    verifies them. The keys are reloaded from the file while the tasks run,
+    see KeyPool.
+    """
+    apis = KeyPool(settings_file, api_kwargs={
+        'wait_on_rate_limit': True, 'wait_on_rate_limit_notify': True})
+    print("Created api objects for {} API keys".format(len(apis)))
     return apis
 
 
-def run(user_ids, tweet_ids, curr_datetime, root_dir):
+def run(user_ids, tweet_ids, curr_datetime, root_dir, durable=False,
+        pipelined=True):
     """
     This run method assumes that data is periodically collected from Twitter
     and stored in folders ordered by timestamp of data collection.
@@ -159,6 +137,12 @@ def run(user_ids, tweet_ids, curr_datetime, root_dir):
           corresponding directory to store the Twitter data.
         - root_dir (str): The root directory path where all the timestamp
           folders are created.
+        - durable (bool): Whether to store the state of the tasks in the
+          timestamp folder. Calling run again with the curr_datetime of an
+          interrupted run then continues it where it stopped.
+        - pipelined (bool): Whether to enqueue the tasks which depend on a
+          tweet as soon as it is fetched, instead of running the tweet and
+          user tasks in consecutive phases.
     """
     print(" --- Collecting twitter data for {} tweets and {} users ---"
           .format(len(tweet_ids), len(user_ids)))
@@ -167,22 +151,26 @@ def run(user_ids, tweet_ids, curr_datetime, root_dir):
 
     base_folder_path = root_dir + '/'
 
-    # Load list of users to ignore
-    user_ignore_list = set()
-    if os.path.exists(base_folder_path + 'user_ignore_list.txt'):
-        with open(base_folder_path + 'user_ignore_list.txt') as f:
-            for line in f:
-                user_ignore_list.add(line.strip())
-
     twitter_folder_path = base_folder_path + curr_datetime + '/' + 'twitter/'
 
     if not os.path.exists(twitter_folder_path):
         os.makedirs(twitter_folder_path)
 
-    task_manager = TaskManager(base_folder_path, twitter_folder_path)
-
-    process_tweets(tweet_ids, user_ignore_list, task_manager, apis)
-    process_users(user_ids, user_ignore_list, task_manager, apis)
+    follow_ups = PIPELINE_FOLLOW_UPS if pipelined else None
+    with TaskManager(base_folder_path, twitter_folder_path, durable=durable,
+                     follow_ups=follow_ups) as task_manager:
+        # The ignore list is shared with the workers, so the users they
+        # ignore are skipped by the later phases of the run.
+        user_ignore_list = task_manager.user_ignore_list
+        if durable:
+            task_manager.resume()
+            task_manager.run_tasks(apis)
+        if pipelined:
+            process_pipelined(tweet_ids, user_ids, user_ignore_list,
+                              task_manager, apis)
+        else:
+            process_tweets(tweet_ids, user_ignore_list, task_manager, apis)
+            process_users(user_ids, user_ignore_list, task_manager, apis)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,236 @@
+"""
+Instrumentation of the TaskManager.
+
+Every worker records the metrics of the tasks it executes in a local
+MetricsRecorder, which is merged into the MetricsStore hosted by the manager
+process after each task, so that the metrics of all the workers are
+aggregated in one place. Metrics are either counters, which are summed, or
+summaries of durations, which keep their count, sum and maximum.
+"""
+from collections import defaultdict
+from storage import write_json_atomic
+import functools
+import logging
+import os
+import re
+import threading
+import time
+
+METRIC_PREFIX = 'paralleltweepy_'
+
+# The message logged by tweepy before it sleeps until a rate limit window
+# resets, which it does for 5 more seconds than the logged time.
+RATE_LIMIT_SLEEP_RE = re.compile(r'Rate limit reached\. Sleeping for: (\d+)')
+RATE_LIMIT_SLEEP_MARGIN = 5
+
+_local = threading.local()
+
+
+class MetricsStore:
+    """
+    Aggregates the counters and summaries recorded by all the workers. It
+    lives in a manager process and is shared through a proxy.
+    """
+
+    def __init__(self):
+        self.counters = defaultdict(float)
+        self.summaries = {}
+        self.lock = threading.Lock()
+
+    def record(self, counters, observations):
+        """
+        Adds a list of (name, labels, value) counter increments and a list
+        of (name, labels, value) observations of summaries.
+        """
+        with self.lock:
+            for name, labels, value in counters:
+                self.counters[(name, labels)] += value
+            for name, labels, value in observations:
+                summary = self.summaries.setdefault((name, labels),
+                                                    [0, 0.0, 0.0])
+                summary[0] += 1
+                summary[1] += value
+                summary[2] = max(summary[2], value)
+
+    def snapshot(self):
+        """
+        Returns the counters as (name, labels, value) tuples and the
+        summaries as (name, labels, count, sum, max) tuples.
+        """
+        with self.lock:
+            return ([(name, labels, value) for (name, labels), value
+                     in self.counters.items()],
+                    [(name, labels) + tuple(summary) for (name, labels),
+                     summary in self.summaries.items()])
+
+
+class MetricsRecorder:
+    """
+    Collects the metrics of a worker until they are flushed to the
+    MetricsStore. Labels are given as keyword arguments.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.counters = []
+        self.observations = []
+
+    def count(self, name, value=1, **labels):
+        self.counters.append((name, tuple(sorted(labels.items())), value))
+
+    def observe(self, name, value, **labels):
+        self.observations.append((name, tuple(sorted(labels.items())),
+                                  value))
+
+    def flush(self):
+        if self.counters or self.observations:
+            self.store.record(self.counters, self.observations)
+        self.counters = []
+        self.observations = []
+
+
+def set_recorder(recorder):
+    """
+    Sets the MetricsRecorder of the current thread, which the
+    InstrumentedAPI and the RateLimitSleepHandler record to.
+    """
+    _local.recorder = recorder
+
+
+def current_recorder():
+    return getattr(_local, 'recorder', None)
+
+
+class InstrumentedAPI:
+    """
+    Wraps a tweepy API object, counting and timing its method calls in the
+    MetricsRecorder of the current thread. Everything else is passed
+    through to the wrapped object.
+    """
+
+    def __init__(self, api, key_idx):
+        self._api = api
+        self._key_idx = key_idx
+        self.api_time = 0.0
+        self.num_calls = 0
+
+    def __getattr__(self, name):
+        attr = getattr(self._api, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+
+        # functools.wraps also copies the pagination_mode attribute that
+        # tweepy.Cursor looks for.
+        @functools.wraps(attr)
+        def timed_call(*args, **kwargs):
+            start_time = time.time()
+            try:
+                return attr(*args, **kwargs)
+            finally:
+                elapsed = time.time() - start_time
+                self.api_time += elapsed
+                self.num_calls += 1
+                recorder = current_recorder()
+                if recorder is not None:
+                    recorder.count('api_calls_total', method=name,
+                                   key=str(self._key_idx))
+                    recorder.observe('api_call_seconds', elapsed,
+                                     method=name)
+        return timed_call
+
+
+class RateLimitSleepHandler(logging.Handler):
+    """
+    Records the time tweepy sleeps waiting for rate limit windows to reset
+    (with wait_on_rate_limit and wait_on_rate_limit_notify set) in the
+    MetricsRecorder of the current thread.
+    """
+
+    def emit(self, record):
+        match = RATE_LIMIT_SLEEP_RE.search(record.getMessage())
+        recorder = current_recorder()
+        if match is None or recorder is None:
+            return
+        recorder.count('rate_limit_sleep_seconds_total',
+                       int(match.group(1)) + RATE_LIMIT_SLEEP_MARGIN,
+                       key=str(getattr(_local, 'key_idx', '')))
+
+
+def install_rate_limit_handler(key_idx):
+    """
+    Installs the RateLimitSleepHandler on the tweepy logger of the current
+    process, once, and sets the key of the current thread.
+    """
+    _local.key_idx = key_idx
+    logger = logging.getLogger('tweepy.binder')
+    if not any(isinstance(handler, RateLimitSleepHandler)
+               for handler in logger.handlers):
+        logger.addHandler(RateLimitSleepHandler())
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(
+        name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for name, value in labels) + '}'
+
+
+def to_prometheus(counters, summaries):
+    """
+    Formats a snapshot of a MetricsStore in the Prometheus text format.
+    The maximum of each summary is exported as a separate gauge.
+    """
+    lines = []
+    for name in sorted({counter[0] for counter in counters}):
+        lines.append('# TYPE {}{} counter'.format(METRIC_PREFIX, name))
+        for _, labels, value in sorted(c for c in counters if c[0] == name):
+            lines.append('{}{}{} {}'.format(METRIC_PREFIX, name,
+                                            _format_labels(labels), value))
+
+    for name in sorted({summary[0] for summary in summaries}):
+        metric = METRIC_PREFIX + name
+        entries = sorted(s for s in summaries if s[0] == name)
+        lines.append('# TYPE {} summary'.format(metric))
+        for _, labels, count, total, _ in entries:
+            lines.append('{}_count{} {}'.format(metric,
+                                                _format_labels(labels),
+                                                count))
+            lines.append('{}_sum{} {}'.format(metric, _format_labels(labels),
+                                              total))
+        lines.append('# TYPE {}_max gauge'.format(metric))
+        for _, labels, _, _, maximum in entries:
+            lines.append('{}_max{} {}'.format(metric, _format_labels(labels),
+                                              maximum))
+    return '\n'.join(lines) + '\n'
+
+
+def to_dict(counters, summaries):
+    """
+    Converts a snapshot of a MetricsStore to a JSON serializable dict.
+    """
+    metrics = {'counters': defaultdict(list), 'summaries': defaultdict(list)}
+    for name, labels, value in counters:
+        metrics['counters'][name].append({'labels': dict(labels),
+                                          'value': value})
+    for name, labels, count, total, maximum in summaries:
+        metrics['summaries'][name].append({'labels': dict(labels),
+                                           'count': count, 'sum': total,
+                                           'max': maximum})
+    return metrics
+
+
+def write_metrics(path, counters, summaries, metrics_format='prometheus'):
+    """
+    Atomically writes a snapshot of a MetricsStore to path, in the
+    Prometheus text format or as JSON.
+    """
+    if metrics_format == 'json':
+        write_json_atomic(path, to_dict(counters, summaries))
+    elif metrics_format == 'prometheus':
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as fw:
+            fw.write(to_prometheus(counters, summaries))
+        os.replace(tmp_path, path)
+    else:
+        raise ValueError("Unsupported metrics format: " + str(metrics_format))
@@ -0,0 +1,96 @@
+import re
+import time
+from urllib.parse import urlsplit
+
+# API paths whose resource names in rate_limit_status carry an :id
+# placeholder which the path itself does not have, or has as a number
+ID_RESOURCES = [
+    (re.compile(r'^/statuses/show(/\d+)?$'), '/statuses/show/:id'),
+    (re.compile(r'^/statuses/retweets/\d+$'), '/statuses/retweets/:id'),
+    (re.compile(r'^/users/show(/\d+)?$'), '/users/show/:id'),
+]
+
+
+def response_endpoint(response):
+    """
+    Returns the resource name of the endpoint that served a response (e.g.
+    '/followers/ids' for https://api.twitter.com/1.1/followers/ids.json),
+    or None if the response has no URL.
+    """
+    url = getattr(response, 'url', None)
+    if not url:
+        return None
+
+    path = urlsplit(url).path
+    if path.startswith('/1.1/'):
+        path = path[len('/1.1'):]
+    if path.endswith('.json'):
+        path = path[:-len('.json')]
+    for pattern, resource in ID_RESOURCES:
+        if pattern.match(path):
+            return resource
+    return path
+
+
+class RateLimitTracker:
+    """
+    Tracks the remaining call budget and the reset time of every API key for
+    each Twitter API endpoint, shared by all the worker processes.
+
+    Endpoints are identified by their resource names in the response of
+    application/rate_limit_status (e.g. '/followers/ids'). The budget is
+    updated from the x-rate-limit-* headers of the last response of an API
+    object, or in bulk from rate_limit_status.
+    """
+
+    def __init__(self, manager, endpoints):
+        self.endpoints = set(endpoints)
+        self.limits = manager.dict()
+
+    def update_from_response(self, key_idx, response):
+        """
+        Records the budget left for the endpoint that served a response from
+        its rate limit headers. Responses without the headers or a URL are
+        ignored.
+        """
+        endpoint = response_endpoint(response)
+        if endpoint is None:
+            return
+
+        remaining = response.headers.get('x-rate-limit-remaining')
+        reset = response.headers.get('x-rate-limit-reset')
+        if remaining is None or reset is None:
+            return
+        self.limits[(key_idx, endpoint)] = (int(remaining), int(reset))
+
+    def update_from_status(self, key_idx, rate_limit_status):
+        """
+        Records the budget left for all the tracked endpoints from the
+        response of api.rate_limit_status().
+        """
+        limits = {}
+        for family in rate_limit_status.get('resources', {}).values():
+            for endpoint, limit in family.items():
+                if endpoint in self.endpoints:
+                    limits[(key_idx, endpoint)] = (int(limit['remaining']),
+                                                   int(limit['reset']))
+        self.limits.update(limits)
+
+    def mark_exhausted(self, key_idx, endpoint, reset=None):
+        """
+        Marks an endpoint as exhausted for a key, e.g. after a rate limit
+        error. Without a reset time, a full 15 minute window is assumed.
+        """
+        if reset is None:
+            reset = int(time.time()) + 15 * 60
+        self.limits[(key_idx, endpoint)] = (0, int(reset))
+
+    def exhausted_endpoints(self, key_idx):
+        """
+        Returns the endpoints which the given key cannot call until their
+        rate limit window resets.
+        """
+        now = time.time()
+        return [endpoint for (idx, endpoint), (remaining, reset)
+                in self.limits.items()
+                if idx == key_idx and remaining <= 0 and reset > now]
@@ -0,0 +1,245 @@
+"""
+Streams the records collected in the run folders of a base folder, for
+analytics jobs which only need a few fields of many tweets and users.
+"""
+from compaction import BASELINE_FOLDER, PACKED_EXT, load_manifest
+from snapshots import DETAILS_DELTA_EXT
+from storage import TWEET_FILE_EXTS, OutputFolder, read_tweets
+import json
+import multiprocessing
+import os
+
+try:
+    import orjson
+    loads = orjson.loads
+except ImportError:
+    orjson = None
+    loads = json.loads
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# The output folder of each kind of record, whether its files hold a single
+# object (tweet_details, user_details and their deltas) or a list of tweets,
+# and the extensions of its files.
+KINDS = {
+    'tweet_details': ('tweet_details/', True, ('.json',)),
+    'user_details': ('user_details/', True, ('.json',)),
+    'tweet_details_deltas': ('tweet_details/', True, (DETAILS_DELTA_EXT,)),
+    'user_details_deltas': ('user_details/', True, (DETAILS_DELTA_EXT,)),
+    'timelines': ('timelines/', False, tuple(TWEET_FILE_EXTS.values())),
+    'retweets': ('retweets/', False, tuple(TWEET_FILE_EXTS.values())),
+}
+
+# Number of files parsed per task of the process pool
+FILES_PER_TASK = 256
+
+# Value of the missing fields in the integer columns of .npy exports
+MISSING_INT = -1
+
+
+def project(obj, fields):
+    """
+    Returns a dict of the given fields of a JSON object, where each field is
+    a list of the keys on the path to it. Fields which are missing are None.
+    """
+    record = {}
+    for name, keys in fields:
+        value = obj
+        for key in keys:
+            if not isinstance(value, dict):
+                value = None
+                break
+            value = value.get(key)
+        record[name] = value
+    return record
+
+
+def _read_file(path, single_object):
+    if single_object and path.endswith('.json'):
+        with open(path, 'rb') as f:
+            yield loads(f.read())
+    else:
+        yield from read_tweets(path, loads)
+
+
+def _parse_files(args):
+    """
+    Parses a batch of files in a worker process of the pool, and returns the
+    records found in them, projected on fields unless fields is None.
+    """
+    paths, single_object, fields = args
+    records = []
+    for path in paths:
+        for obj in _read_file(path, single_object):
+            records.append(obj if fields is None else project(obj, fields))
+    return records
+
+
+class OutputReader:
+    """
+    Lazily reads the records of a kind (tweet_details, user_details,
+    timelines or retweets) from a range of runs of a base folder. The
+    tweet_details_deltas and user_details_deltas kinds are the deltas
+    written by a TaskManager with change_detection set.
+
+    The runs read are the given runs, or all the runs from since to until
+    (both inclusive, as timestamp folder names). With include_baseline set,
+    the baseline written by compaction is read as well, and the compacted
+    runs are skipped as their data is in the baseline. A record fetched in
+    several runs is read once per run.
+
+    Records can be projected on a few fields given as dotted paths, e.g.
+    ['id_str', 'user.id_str'], so that only small dicts are kept, and the
+    files can be parsed by a pool of processes. JSON is decoded with orjson
+    when it is installed.
+
+    For repeated scans, export_columns writes the projected records to a
+    columnar file once, which load_columns maps into memory without parsing
+    anything.
+    """
+
+    def __init__(self, base_folder_path, runs=None, since=None, until=None,
+                 include_baseline=False):
+        self.base_folder_path = base_folder_path
+        self.include_baseline = include_baseline
+        compacted_through = load_manifest(base_folder_path)[
+            'compacted_through'] if include_baseline else None
+
+        if runs is None:
+            runs = sorted(
+                folder for folder in os.listdir(base_folder_path)
+                if os.path.isdir(base_folder_path + folder + '/twitter'))
+        self.runs = [run for run in runs
+                     if (since is None or run >= since) and
+                     (until is None or run <= until) and
+                     (compacted_through is None or run > compacted_through)]
+
+    def files(self, kind):
+        """
+        Returns the paths of the files holding the records of a kind, the
+        baseline first and then the runs, oldest first.
+        """
+        folder_name, single_object, exts = KINDS[kind]
+        paths = []
+        if self.include_baseline and DETAILS_DELTA_EXT not in exts:
+            baseline_folder_path = self.base_folder_path + BASELINE_FOLDER
+            if single_object:
+                path = baseline_folder_path + kind + PACKED_EXT
+                if os.path.exists(path):
+                    paths.append(path)
+            else:
+                paths.extend(path for _, path in OutputFolder(
+                    baseline_folder_path + folder_name).files((PACKED_EXT,)))
+
+        for run in self.runs:
+            paths.extend(path for _, path in OutputFolder(
+                self.base_folder_path + run + '/twitter/' +
+                folder_name).files(exts))
+        return paths
+
+    def records(self, kind, fields=None, processes=None):
+        """
+        Lazily yields the records of a kind, as dicts of the given fields if
+        fields is set, or as the whole JSON objects otherwise. With processes
+        set, the files are parsed by a pool of that many processes, and the
+        records are yielded in the same order.
+        """
+        _, single_object, _ = KINDS[kind]
+        if fields is not None:
+            fields = [(field, field.split('.')) for field in fields]
+        paths = self.files(kind)
+
+        if not processes:
+            for path in paths:
+                for obj in _read_file(path, single_object):
+                    yield obj if fields is None else project(obj, fields)
+            return
+
+        batches = [(paths[i:i + FILES_PER_TASK], single_object, fields)
+                   for i in range(0, len(paths), FILES_PER_TASK)]
+        with multiprocessing.Pool(processes) as pool:
+            for records in pool.imap(_parse_files, batches):
+                yield from records
+
+    def export_columns(self, kind, fields, path, processes=None):
+        """
+        Writes the given fields of the records of a kind to a columnar file
+        at path, and returns the number of records written:
+        - A path ending in .arrow is written as an Arrow IPC file, and one
+        ending in .parquet as a Parquet file. Both require pyarrow.
+        - Any other path is written as a folder of one .npy file per field,
+        which requires numpy. The fields must be integers or strings of
+        digits, such as ids and counts, and missing values are stored as
+        MISSING_INT.
+        """
+        columns = {field: [] for field in fields}
+        for record in self.records(kind, fields, processes):
+            for field in fields:
+                columns[field].append(record[field])
+        num_records = len(next(iter(columns.values()), []))
+
+        if path.endswith(('.arrow', '.parquet')):
+            if pyarrow is None:
+                raise ValueError("Exporting to {} requires the pyarrow "
+                                 "package".format(path))
+            table = pyarrow.table(columns)
+            if path.endswith('.arrow'):
+                with pyarrow.OSFile(path + '.tmp', 'wb') as sink:
+                    with pyarrow.ipc.new_file(sink, table.schema) as writer:
+                        writer.write_table(table)
+            else:
+                pyarrow.parquet.write_table(table, path + '.tmp')
+            os.replace(path + '.tmp', path)
+            return num_records
+
+        if numpy is None:
+            raise ValueError("Exporting to {} requires the numpy package"
+                             .format(path))
+        os.makedirs(path, exist_ok=True)
+        for field, values in columns.items():
+            try:
+                column = numpy.array(
+                    [MISSING_INT if value is None else int(value)
+                     for value in values], dtype=numpy.int64)
+            except (TypeError, ValueError):
+                raise ValueError("Field {} is not an integer field, export it "
+                                 "to an .arrow or .parquet file".format(field))
+            column_path = os.path.join(path, field + '.npy')
+            with open(column_path + '.tmp', 'wb') as fw:
+                numpy.save(fw, column)
+            os.replace(column_path + '.tmp', column_path)
+        return num_records
+
+
+def load_columns(path):
+    """
+    Maps a columnar file written by OutputReader.export_columns into memory.
+    Returns a pyarrow Table for .arrow and .parquet files, and a dict of
+    read-only numpy memmaps keyed by field for .npy folders.
+    """
+    if path.endswith('.arrow'):
+        if pyarrow is None:
+            raise ValueError("Reading {} requires the pyarrow package"
+                             .format(path))
+        return pyarrow.ipc.open_file(pyarrow.memory_map(path)).read_all()
+    if path.endswith('.parquet'):
+        if pyarrow is None:
+            raise ValueError("Reading {} requires the pyarrow package"
+                             .format(path))
+        return pyarrow.parquet.read_table(path, memory_map=True)
+
+    if numpy is None:
+        raise ValueError("Reading {} requires the numpy package".format(path))
+    return {name[:-len('.npy')]: numpy.load(os.path.join(path, name),
+                                            mmap_mode='r')
+            for name in sorted(os.listdir(path)) if name.endswith('.npy')}
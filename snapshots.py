@@ -0,0 +1,379 @@
+from id_sets import IDS_FILE_EXT, compact_ids, empty_ids, load_ids, \
+    save_ids
+from storage import OutputFolder, write_json_atomic
+import hashlib
+import json
+import os
+
+# The file extension of the tweet_details and user_details files which only
+# hold the fields that changed since the previous version of the object.
+DETAILS_DELTA_EXT = '.delta.json'
+
+# The fields whose values are kept in the FingerprintIndex along with the
+# fingerprints, for the objects which are not written when they are
+# unchanged.
+KEPT_FIELDS = {
+    'tweet_details': ('user.id_str',),
+    'user_details': (),
+}
+
+# The fields which are left out of the fingerprints, along with the fields
+# they contain: the users embedded in tweets, whose counts change on nearly
+# every fetch. Their changes are tracked by their own user_details.
+UNTRACKED_FIELDS = {
+    'tweet_details': ('user', 'retweeted_status.user', 'quoted_status.user'),
+    'user_details': (),
+}
+
+
+def load_delta(folder_path, user_id, sharded=False):
+    """
+    Returns the follower or followee delta of a user from the output folder
+    of a run, in either file format and folder layout, or None if the user
+    has no delta in it.
+    """
+    path = OutputFolder(folder_path, sharded).find(user_id,
+                                                   ('.json', IDS_FILE_EXT))
+    if path is None:
+        return None
+    if path.endswith('.json'):
+        with open(path) as f:
+            return json.load(f)
+    _, data = load_ids(path)
+    return data
+
+
+class SnapshotStore:
+    """
+    A persistent store of the current follower and followee sets of each
+    user, as of the latest run in which they were fetched.
+
+    Every snapshot records the run it was taken in, so that the deltas of
+    any later run (e.g. one which crashed after writing its delta, but
+    before updating the snapshot) can be replayed on top of it. Snapshots
+    are replaced atomically, so a crash never leaves a partial snapshot.
+
+    With compact set to True, snapshots are stored as .ids files and loaded
+    as compact id sets instead of JSON files and Python sets. Snapshots in
+    either format can be read in both modes.
+    """
+
+    def __init__(self, folder_path, compact=False):
+        self.folder_path = folder_path
+        self.compact = compact
+        for kind in ('followers', 'followees'):
+            if not os.path.exists(self.folder_path + kind):
+                os.makedirs(self.folder_path + kind)
+
+    def _path(self, kind, user_id, ext):
+        return self.folder_path + kind + '/' + str(user_id) + ext
+
+    def load(self, kind, user_id):
+        """
+        Returns the run and the set of ids of the latest snapshot of a user,
+        or (None, empty set) if the user has no snapshot yet.
+        """
+        path = self._path(kind, user_id, IDS_FILE_EXT)
+        if os.path.exists(path):
+            meta, arrays = load_ids(path)
+            run, ids = meta['run'], arrays['ids']
+        else:
+            path = self._path(kind, user_id, '.json')
+            if not os.path.exists(path):
+                return None, empty_ids(self.compact)
+            with open(path) as f:
+                snapshot = json.load(f)
+            run, ids = snapshot['run'], snapshot['ids']
+
+        if self.compact:
+            return run, compact_ids(ids)
+        return run, set(int(item) for item in ids)
+
+    def save(self, kind, user_id, run, ids):
+        if self.compact:
+            save_ids(self._path(kind, user_id, IDS_FILE_EXT),
+                     {'ids': compact_ids(ids)}, {'run': run})
+            stale_path = self._path(kind, user_id, '.json')
+        else:
+            write_json_atomic(self._path(kind, user_id, '.json'),
+                              {'run': run, 'ids': sorted(ids)})
+            stale_path = self._path(kind, user_id, IDS_FILE_EXT)
+
+        if os.path.exists(stale_path):
+            os.remove(stale_path)
+
+
+class LastTweetIndex:
+    """
+    A persistent index from each user to the newest tweet id fetched from
+    their timeline, and the run it was fetched in.
+
+    The entry of a user is a small JSON file which is replaced atomically
+    after the user's timeline file is written. If a run crashes in between,
+    the timeline file of that run is newer than the run recorded in the
+    index, and the reader falls back to it.
+    """
+
+    def __init__(self, folder_path):
+        self.folder_path = folder_path
+        if not os.path.exists(self.folder_path):
+            os.makedirs(self.folder_path)
+
+    def _path(self, user_id):
+        return self.folder_path + str(user_id) + '.json'
+
+    def load(self, user_id):
+        """
+        Returns the run and the newest tweet id fetched for a user, or
+        (None, -1) if the user is not in the index.
+        """
+        path = self._path(user_id)
+        if not os.path.exists(path):
+            return None, -1
+
+        with open(path) as f:
+            entry = json.load(f)
+        return entry['run'], entry['last_tweet_id']
+
+    def save(self, user_id, run, last_tweet_id):
+        write_json_atomic(self._path(user_id),
+                          {'run': run, 'last_tweet_id': int(last_tweet_id)})
+
+
+def _merge_ranges(ranges):
+    merged = []
+    for low, high in sorted(ranges):
+        if merged and low <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], high)
+        else:
+            merged.append([low, high])
+    return merged
+
+
+def _subtract_ranges(low, high, ranges):
+    pieces = []
+    for range_low, range_high in sorted(ranges):
+        if range_high < low or range_low > high:
+            continue
+        if range_low > low:
+            pieces.append([low, range_low - 1])
+        low = max(low, range_high + 1)
+    if low <= high:
+        pieces.append([low, high])
+    return pieces
+
+
+class CoverageIndex:
+    """
+    A persistent index of the ranges of tweet ids fetched for each user
+    timeline and each tweet's retweets, and of the gaps detected in them.
+
+    A gap is a range of tweet ids which a fetch could not reach, e.g. the
+    tweets between the since_id of a timeline fetch and the oldest tweet it
+    returned, when the 3200 tweet cap of the timeline was hit first. The
+    entry of an object also stores the tweet count of the object at its
+    last fetch (statuses_count or retweet_count), to tell how many tweets
+    the next fetch should return, and the screen name to search for when
+    backfilling its gaps. The parts of gaps which a backfill could not
+    reach are moved to the unreachable ranges, and are not recorded as
+    gaps again, as the sources only reach back a fixed window of time.
+
+    Ranges and gaps are [low, high] pairs of tweet ids, both inclusive.
+    Entries are small JSON files which are replaced atomically, one per
+    object and kind.
+    """
+
+    def __init__(self, folder_path):
+        self.folder_path = folder_path
+        for kind in ('timelines', 'retweets'):
+            if not os.path.exists(self.folder_path + kind):
+                os.makedirs(self.folder_path + kind)
+
+    def _path(self, kind, object_id):
+        return self.folder_path + kind + '/' + str(object_id) + '.json'
+
+    def load(self, kind, object_id):
+        """
+        Returns the entry of an object, with empty ranges and gaps if it is
+        not in the index.
+        """
+        path = self._path(kind, object_id)
+        if not os.path.exists(path):
+            return {'ranges': [], 'gaps': [], 'unreachable': [],
+                    'count': None, 'screen_name': None}
+        with open(path) as f:
+            entry = json.load(f)
+        entry.setdefault('unreachable', [])
+        return entry
+
+    def record(self, kind, object_id, low, high, gap=None, count=None,
+               screen_name=None):
+        """
+        Records a fetch of the tweet ids from low to high (None if it
+        returned no tweets), and the gap it left, if any. The parts of the
+        gap which are already covered or unreachable are left out, e.g. the
+        older retweets of a tweet, which every fetch of its retweets misses.
+        Returns the updated entry.
+        """
+        entry = self.load(kind, object_id)
+        if low is not None:
+            entry['ranges'] = _merge_ranges(entry['ranges'] +
+                                            [[int(low), int(high)]])
+        if gap is not None:
+            entry['gaps'] = _merge_ranges(entry['gaps'] + _subtract_ranges(
+                int(gap[0]), int(gap[1]),
+                entry['ranges'] + entry['unreachable']))
+        if count is not None:
+            entry['count'] = count
+        if screen_name is not None:
+            entry['screen_name'] = screen_name
+        write_json_atomic(self._path(kind, object_id), entry)
+        return entry
+
+    def fill(self, kind, object_id, gap, low):
+        """
+        Records that a gap was backfilled from its end down to low, the
+        oldest tweet id the backfill source returned (None if it returned no
+        tweets), as the source pages back from the end of the gap. The part
+        of the gap below low, which the source could not reach, is recorded
+        as unreachable, so that it is not backfilled again. Returns the
+        updated entry.
+        """
+        entry = self.load(kind, object_id)
+        gap = [int(gap[0]), int(gap[1])]
+        entry['gaps'] = [g for g in entry['gaps'] if g != gap]
+        if low is None:
+            low = gap[1] + 1
+        else:
+            low = max(int(low), gap[0])
+            entry['ranges'] = _merge_ranges(entry['ranges'] +
+                                            [[low, gap[1]]])
+        if low > gap[0]:
+            entry['unreachable'] = _merge_ranges(entry['unreachable'] +
+                                                 [[gap[0], low - 1]])
+        write_json_atomic(self._path(kind, object_id), entry)
+        return entry
+
+
+def flatten_fields(obj):
+    """
+    Returns the fields of a JSON object keyed by their dotted path, down to
+    the fields of the objects it contains, e.g. 'user.followers_count' for a
+    tweet. Empty objects and any deeper values are fields of their own.
+    """
+    fields = {}
+    for key, value in obj.items():
+        if isinstance(value, dict) and value:
+            for sub_key, sub_value in value.items():
+                fields[key + '.' + sub_key] = sub_value
+        else:
+            fields[key] = value
+    return fields
+
+
+def _is_tracked(kind, path):
+    return not any(path == field or path.startswith(field + '.')
+                   for field in UNTRACKED_FIELDS[kind])
+
+
+def fingerprint(value):
+    return hashlib.blake2b(json.dumps(value, sort_keys=True).encode('utf-8'),
+                           digest_size=8).hexdigest()
+
+
+def apply_details_delta(obj, delta):
+    """
+    Returns the JSON object obtained by applying a tweet_details or
+    user_details delta to the previous version of the object.
+    """
+    obj = json.loads(json.dumps(obj))
+    for path in delta['removed']:
+        key, _, sub_key = path.partition('.')
+        if not sub_key:
+            obj.pop(key, None)
+        elif isinstance(obj.get(key), dict):
+            obj[key].pop(sub_key, None)
+            if not obj[key]:
+                del obj[key]
+    for path, value in delta['changed'].items():
+        key, _, sub_key = path.partition('.')
+        if not sub_key:
+            obj[key] = value
+        else:
+            if not isinstance(obj.get(key), dict):
+                obj[key] = {}
+            obj[key][sub_key] = value
+    return obj
+
+
+class FingerprintIndex:
+    """
+    A persistent index of the latest version of each user_details and
+    tweet_details object, as a fingerprint of each of its fields (see
+    flatten_fields) but the UNTRACKED_FIELDS, and the run in which it last
+    changed.
+
+    The fingerprints tell which fields of a fetched object changed since its
+    previous version, without storing that version: an 8 byte hash of every
+    field is kept instead of the whole profile or tweet, along with the
+    values of the KEPT_FIELDS, such as the author of a tweet. Entries are
+    small JSON files which are replaced atomically, one per object and kind.
+    """
+
+    def __init__(self, folder_path):
+        self.folder_path = folder_path
+        for kind in ('user_details', 'tweet_details'):
+            if not os.path.exists(self.folder_path + kind):
+                os.makedirs(self.folder_path + kind)
+
+    def _path(self, kind, object_id):
+        return self.folder_path + kind + '/' + str(object_id) + '.json'
+
+    def load(self, kind, object_id):
+        """
+        Returns the entry of an object, or None if it is not in the index.
+        """
+        path = self._path(kind, object_id)
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def diff(self, kind, object_id, obj):
+        """
+        Compares a JSON object to its latest version in the index, leaving
+        out the UNTRACKED_FIELDS. Returns the entry of that version (None if
+        there is none), the fields which are new or changed with their
+        values, the paths of the fields which were removed, and the
+        fingerprints of the object.
+        """
+        entry = self.load(kind, object_id)
+        fields = {path: value for path, value in flatten_fields(obj).items()
+                  if _is_tracked(kind, path)}
+        fingerprints = {path: fingerprint(value)
+                        for path, value in fields.items()}
+        previous = entry['fields'] if entry is not None else {}
+        changed = {path: fields[path] for path, value in fingerprints.items()
+                   if previous.get(path) != value}
+        removed = sorted(path for path in previous if path not in fields and
+                         _is_tracked(kind, path))
+        return entry, changed, removed, fingerprints
+
+    def save(self, kind, object_id, run, obj, fingerprints):
+        fields = flatten_fields(obj)
+        write_json_atomic(self._path(kind, object_id), {
+            'run': run, 'fields': fingerprints,
+            'values': {path: fields.get(path) for path in KEPT_FIELDS[kind]}})
+
+    def changed_since(self, kind, run):
+        """
+        Returns the ids of the objects whose latest version is from a run
+        after the given run, reading every entry of the index.
+        """
+        object_ids = set()
+        for entry in os.scandir(self.folder_path + kind):
+            if entry.name.endswith('.json'):
+                with open(entry.path) as f:
+                    if json.load(f)['run'] > run:
+                        object_ids.add(entry.name[:-len('.json')])
+        return object_ids
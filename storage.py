@@ -0,0 +1,341 @@
+import gzip
+import hashlib
+import io
+import json
+import os
+import threading
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# The file extension of each supported tweet file format. 'json' is the
+# original format: a JSON array of JSON-encoded tweets.
+TWEET_FILE_EXTS = {
+    ('json', None): '.json',
+    ('jsonl', None): '.jsonl',
+    ('jsonl', 'gzip'): '.jsonl.gz',
+    ('jsonl', 'zstd'): '.jsonl.zst',
+}
+
+
+def write_json_atomic(path, obj):
+    """
+    Writes obj as JSON to a temporary file next to path and renames it over
+    path, so that readers never see a partially written file.
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as fw:
+        json.dump(obj, fw)
+    os.replace(tmp_path, path)
+
+
+def lock_folder(folder_path, exclusive=False):
+    """
+    Takes a shared or exclusive lock on the .lock file of a folder without
+    blocking, and returns the open lock file, which holds the lock until it
+    is closed. Raises BlockingIOError if the folder is locked in the other
+    mode. Without fcntl (e.g. on Windows) no lock is taken.
+    """
+    lock_file = open(folder_path + '.lock', 'a')
+    if fcntl is not None:
+        try:
+            fcntl.flock(lock_file, (fcntl.LOCK_EX if exclusive
+                                    else fcntl.LOCK_SH) | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            raise
+    return lock_file
+
+
+def write_bytes_atomic(path, data):
+    """
+    Writes data to a temporary file next to path and renames it over path.
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as fw:
+        fw.write(data)
+    os.replace(tmp_path, path)
+
+
+def tweet_file_ext(tweet_format, compression=None):
+    if (tweet_format, compression) not in TWEET_FILE_EXTS:
+        raise ValueError("Unsupported tweet file format: {} ({})".format(
+            tweet_format, compression))
+    if compression == 'zstd' and zstandard is None:
+        raise ValueError("zstd compression requires the zstandard package")
+    return TWEET_FILE_EXTS[(tweet_format, compression)]
+
+
+class OutputFolder:
+    """
+    A folder holding one output file per object, named after the object id.
+
+    With sharded set, the files are stored in 256 subfolders named after the
+    first two hex digits of the MD5 of the object id, so that no folder
+    holds millions of files. Files are found in either layout, so a folder
+    can be read whichever layout it was written with.
+
+    Whether an object has an output file is answered from an index of the
+    file names in the folder, built the first time it is needed with a
+    single os.scandir pass over the folder and its subfolders, instead of
+    one stat call per id and extension. The index is not updated with the
+    files written afterwards, as the tasks done during a run are tracked by
+    the TaskRegistry.
+    """
+
+    def __init__(self, folder_path, sharded=False):
+        self.folder_path = folder_path
+        self.sharded = sharded
+        self.index = None
+        self.subfolders = set()
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        # Worker processes build their own index when they need one
+        state = self.__dict__.copy()
+        state['index'] = None
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def _subfolder(self, object_id):
+        return hashlib.md5(str(object_id).encode('utf-8')).hexdigest()[:2] + \
+            '/'
+
+    def path(self, object_id, ext):
+        """
+        Returns the path to write the output file of an object to, creating
+        its subfolder if needed.
+        """
+        if not self.sharded:
+            return self.folder_path + str(object_id) + ext
+        subfolder = self._subfolder(object_id)
+        if subfolder not in self.subfolders:
+            os.makedirs(self.folder_path + subfolder, exist_ok=True)
+            self.subfolders.add(subfolder)
+        return self.folder_path + subfolder + str(object_id) + ext
+
+    def find(self, object_id, exts):
+        """
+        Returns the path of the output file of an object with any of the
+        given extensions, or None if there is none.
+        """
+        prefixes = ['', self._subfolder(object_id)]
+        if self.sharded:
+            prefixes.reverse()
+        for prefix in prefixes:
+            for ext in exts:
+                path = self.folder_path + prefix + str(object_id) + ext
+                if os.path.exists(path):
+                    return path
+        return None
+
+    def _scan(self):
+        """
+        Yields the name and path of every complete file in the folder.
+        """
+        folder_paths = [self.folder_path]
+        while folder_paths:
+            folder_path = folder_paths.pop()
+            try:
+                entries = list(os.scandir(folder_path))
+            except FileNotFoundError:
+                continue
+            for entry in entries:
+                if entry.is_dir():
+                    if folder_path == self.folder_path and \
+                            len(entry.name) == 2:
+                        folder_paths.append(entry.path + '/')
+                elif not entry.name.endswith(('.tmp', '.part')):
+                    yield entry.name, entry.path
+
+    def contains(self, object_id, exts):
+        """
+        Returns whether the object has an output file with any of the given
+        extensions, according to the index.
+        """
+        with self.lock:
+            if self.index is None:
+                self.index = {name for name, _ in self._scan()}
+            return any(str(object_id) + ext in self.index for ext in exts)
+
+    def files(self, exts):
+        """
+        Returns the (object id, path) of the output files in the folder with
+        any of the given extensions, from a fresh listing of the folder.
+        """
+        files = []
+        for name, path in self._scan():
+            object_id, dot, ext = name.partition('.')
+            if dot and '.' + ext in exts:
+                files.append((object_id, path))
+        return files
+
+
+def find_tweet_file(folder_path, object_id):
+    """
+    Returns the path of the tweet file of an object in any of the supported
+    formats and folder layouts, or None if there is none.
+    """
+    return OutputFolder(folder_path).find(object_id, TWEET_FILE_EXTS.values())
+
+
+def _open_compressed(path, mode, compression):
+    if compression == 'gzip':
+        return gzip.open(path, mode)
+    if compression == 'zstd':
+        if zstandard is None:
+            raise ValueError("Reading {} requires the zstandard package"
+                             .format(path))
+        if 'r' in mode:
+            return io.BufferedReader(
+                zstandard.ZstdDecompressor().stream_reader(
+                    open(path, mode), read_across_frames=True,
+                    closefd=True))
+        return zstandard.ZstdCompressor().stream_writer(
+            open(path, mode), closefd=True)
+    return open(path, mode)
+
+
+def _read_jsonl(path, compression, loads=json.loads):
+    with _open_compressed(path, 'rb', compression) as f:
+        for line in f:
+            if line.strip():
+                yield loads(line)
+
+
+def read_tweets(path, loads=json.loads):
+    """
+    Lazily yields the tweets stored in a tweet file of any supported format,
+    decoding each tweet with loads.
+    """
+    if path.endswith('.json'):
+        with open(path, 'rb') as f:
+            for tweet in loads(f.read()):
+                yield loads(tweet)
+    elif path.endswith('.gz'):
+        yield from _read_jsonl(path, 'gzip', loads)
+    elif path.endswith('.zst'):
+        yield from _read_jsonl(path, 'zstd', loads)
+    else:
+        yield from _read_jsonl(path, None, loads)
+
+
+def merge_tweets(path, tweets, compression=None, existing_path=None):
+    """
+    Merges the given tweet JSONs into the tweets of existing_path, which may
+    be in another format, deduplicated by tweet id and ordered newest first,
+    and writes them to the tweet file at path. Returns the number of tweets
+    which were not stored yet.
+    """
+    merged = {}
+    if existing_path is not None:
+        for tweet in read_tweets(existing_path):
+            merged[int(tweet['id'])] = tweet
+    num_stored = len(merged)
+    for tweet in tweets:
+        merged.setdefault(int(tweet['id']), tweet)
+    if len(merged) == num_stored:
+        return 0
+
+    writer = TweetWriter(path, compression)
+    try:
+        for tweet_id in sorted(merged, reverse=True):
+            writer.write(merged[tweet_id])
+    except Exception:
+        writer.abort(keep_part=False)
+        raise
+    writer.commit()
+    if existing_path is not None and existing_path != path:
+        os.remove(existing_path)
+    return len(merged) - num_stored
+
+
+class TweetWriter:
+    """
+    Streams tweets to a tweet file as they are fetched, so that they are
+    encoded only once and do not need to be held in memory.
+
+    The tweets are written as JSONL (optionally gzip or zstd compressed) to
+    a .part file, which is renamed to its final path on commit. In the
+    'json' format the .part file is converted to a JSON array of encoded
+    tweets on commit instead, for readers of the original format.
+
+    A .part file can be reopened to resume writing after a checkpoint: it is
+    truncated back to the size recorded at the checkpoint, which drops any
+    tweets written after it. Every checkpoint closes the compressed stream,
+    so the truncated file is always a valid sequence of gzip members or
+    zstd frames.
+    """
+
+    def __init__(self, path, compression=None, part_path=None,
+                 resume_size=None):
+        self.path = path
+        self.compression = compression
+        self.part_path = part_path or path + '.part'
+        self.num_tweets = 0
+
+        if resume_size is not None and os.path.exists(self.part_path):
+            with open(self.part_path, 'r+b') as f:
+                f.truncate(resume_size)
+            self._open('ab')
+        else:
+            self._open('wb')
+
+    def _open(self, mode):
+        self.file = _open_compressed(self.part_path, mode, self.compression)
+
+    def write(self, tweet_json):
+        self.file.write(json.dumps(tweet_json).encode('utf-8') + b'\n')
+        self.num_tweets += 1
+
+    def checkpoint(self):
+        """
+        Flushes the tweets written so far, and returns the size of the .part
+        file to resume from.
+        """
+        self.file.close()
+        self._open('ab')
+        return os.path.getsize(self.part_path)
+
+    def commit(self):
+        self.file.close()
+        if self.path.endswith('.json'):
+            self._write_json_array()
+            os.remove(self.part_path)
+        else:
+            os.replace(self.part_path, self.path)
+
+    def _write_json_array(self):
+        """
+        Streams the lines of the .part file into a JSON array of encoded
+        tweets at path, as json.dump writes it, without decoding the tweets
+        or holding them in memory.
+        """
+        tmp_path = self.path + '.tmp'
+        with _open_compressed(self.part_path, 'rb', self.compression) as f, \
+                open(tmp_path, 'w') as fw:
+            fw.write('[')
+            separator = ''
+            for line in f:
+                line = line.rstrip(b'\n')
+                if line:
+                    fw.write(separator + json.dumps(line.decode('utf-8')))
+                    separator = ', '
+            fw.write(']')
+        os.replace(tmp_path, self.path)
+
+    def abort(self, keep_part=True):
+        self.file.close()
+        if not keep_part and os.path.exists(self.part_path):
+            os.remove(self.part_path)
@@ -1,11 +1,64 @@
-from multiprocessing import Process, Queue, current_process
+from multiprocessing import parent_process
 from enum import Enum
 from tqdm import tqdm
 from collections import defaultdict
+from array import array
+from backfill import BackfillSource
+from checkpoints import CheckpointStore
+from compaction import BASELINE_FOLDER, load_manifest
+from crawl import FollowerCrawl
+from engines import create_engine, worker_name
+from errors import ErrorKind, PermanentTaskError, backoff_delay, \
+    classify_error, error_description
+from metrics import InstrumentedAPI, MetricsRecorder, current_recorder, \
+    install_rate_limit_handler, set_recorder, write_metrics
+from key_pool import ACTIVE, QUARANTINED, KeyPool, verify_api
+from id_sets import IDS_FILE_EXT, apply_delta, compact_ids, diff_ids, \
+    load_ids, save_ids
+from snapshots import DETAILS_DELTA_EXT, CoverageIndex, FingerprintIndex, \
+    LastTweetIndex, SnapshotStore, load_delta
+from rate_limits import RateLimitTracker
+from reader import OutputReader
+from task_queue import TaskQueueManager
+from task_registry import TaskState
+from storage import TWEET_FILE_EXTS, OutputFolder, TweetWriter, \
+    find_tweet_file, lock_folder, merge_tweets, read_tweets, \
+    tweet_file_ext, write_json_atomic
 import json
 import tweepy
 import os
 import queue
+import time
+
+# Maximum number of IDs accepted by the statuses/lookup and users/lookup
+# endpoints in a single request.
+LOOKUP_BATCH_SIZE = 100
+
+# Seconds an idle worker blocks on the tasks_pending queue before checking
+# that its parent process is still alive.
+WORKER_GET_TIMEOUT = 5
+
+# Seconds run_tasks waits for its tasks between checks of the API keys.
+KEY_POLL_INTERVAL = 5
+
+# Seconds between two verifications of the quarantined API keys.
+KEY_RECHECK_INTERVAL = 60
+
+# Number of times the worker of an API key is restarted after exiting
+# unexpectedly, before run_tasks gives up.
+MAX_WORKER_RESTARTS = 3
+
+# Number of tweets requested per statuses/user_timeline call (the maximum
+# allowed by the endpoint).
+TIMELINE_PAGE_SIZE = 200
+
+# Number of ids returned per followers/ids and friends/ids call, and the
+# maximum number of tweets of a timeline that can be fetched.
+IDS_PAGE_SIZE = 5000
+MAX_TIMELINE_TWEETS = 3200
+
+# Maximum number of retweets returned by statuses/retweets.
+RETWEETS_PAGE_SIZE = 100
 
 
 class TaskType(Enum):
@@ -19,426 +72,1880 @@ class TaskType(Enum):
     followees = 4
     timeline = 5
     user_details = 6
+    timeline_backfill = 7
+    retweets_backfill = 8
+
+
+# The rate limited endpoint called by each type of task, named as in the
+# response of application/rate_limit_status.
+TASK_ENDPOINTS = {
+    TaskType.tweet_details: '/statuses/show/:id',
+    TaskType.retweets: '/statuses/retweets/:id',
+    TaskType.followers: '/followers/ids',
+    TaskType.twohup_followers: '/followers/ids',
+    TaskType.followees: '/friends/ids',
+    TaskType.timeline: '/statuses/user_timeline',
+    TaskType.user_details: '/users/show/:id',
+    TaskType.timeline_backfill: BackfillSource.endpoint,
+    TaskType.retweets_backfill: BackfillSource.endpoint,
+}
+
+# The endpoints called by batched tweet_details and user_details tasks.
+LOOKUP_ENDPOINTS = {
+    TaskType.tweet_details: '/statuses/lookup',
+    TaskType.user_details: '/users/lookup',
+}
+
+# Task types whose object is a tweet. The object of the other task types is
+# a user.
+TWEET_TASK_TYPES = (TaskType.tweet_details, TaskType.retweets,
+                    TaskType.retweets_backfill)
+
+# The backfill task type of each task type whose fetches can leave gaps, and
+# the kind of their entries in the coverage index.
+BACKFILL_TASK_TYPES = {
+    TaskType.timeline: (TaskType.timeline_backfill, 'timelines'),
+    TaskType.retweets: (TaskType.retweets_backfill, 'retweets'),
+}
+
+# The output folder of each task type in the twitter folder of a run, and
+# the extensions of its output files.
+OUTPUT_FOLDERS = {
+    TaskType.tweet_details: ('tweet_details/', ('.json', DETAILS_DELTA_EXT)),
+    TaskType.retweets: ('retweets/', tuple(TWEET_FILE_EXTS.values())),
+    TaskType.followers: ('followers/', ('.json', IDS_FILE_EXT)),
+    TaskType.followees: ('followees/', ('.json', IDS_FILE_EXT)),
+    TaskType.timeline: ('timelines/', tuple(TWEET_FILE_EXTS.values())),
+    TaskType.user_details: ('user_details/', ('.json', DETAILS_DELTA_EXT)),
+}
+
+# Task types which are skipped for the users in the user ignore list, and
+# for the users above their ignore_thresholds.
+USER_TASK_TYPES = (TaskType.followers, TaskType.followees, TaskType.timeline)
+
+# The follow-up tasks of a pipelined run: the retweets of every tweet
+# fetched, and the followers, followees and timeline of its author.
+PIPELINE_FOLLOW_UPS = {
+    TaskType.tweet_details: (TaskType.retweets, TaskType.followers,
+                             TaskType.followees, TaskType.timeline),
+}
+
+# The number of calls per 15 minute rate limit window allowed to a user key
+# by each endpoint, used to estimate the cost of a task.
+ENDPOINT_WINDOW_CALLS = {
+    '/statuses/show/:id': 900,
+    '/statuses/retweets/:id': 75,
+    '/followers/ids': 15,
+    '/friends/ids': 15,
+    '/statuses/user_timeline': 900,
+    '/users/show/:id': 900,
+    '/statuses/lookup': 900,
+    '/users/lookup': 900,
+    '/search/tweets': 180,
+}
 
 
 class TaskManager:
     """
     The TaskManager allows scheduling of different type of Twitter data
-    tasks in a queue, which are executed in parallel by multiple processes.
+    tasks in a queue, which are executed in parallel by one worker per API
+    key.
 
     Instance Variables:
-    - The tasks_pending queue stores all the pending tasks in a FIFO queue.
-    - The tasks_pending_dict is a dictionary that stores the set of tasks
-    pending corresponding to each task type.
+    - The tasks_staged list stores the tasks enqueued since the last call to
+    run_tasks, which dispatches them to the tasks_pending queue.
+    - The tasks_pending queue stores all the pending tasks in a priority
+    queue partitioned by endpoint, which is consumed by one long-lived
+    worker per API key. Tasks are ordered by the priority given to the get_*
+    methods, and then by their estimated cost, longest first, so that a
+    phase does not end with a single key working through a large account.
+    The cost is estimated in rate limit windows from the follower, followee
+    and tweet counts of the cached user objects.
+    - The engine runs the workers: in one process per key ('process', the
+    default), or in one thread per key ('thread'), optionally sharded over
+    a few processes with engine_shards.
+    - The rate_limits tracker stores the remaining budget of every API key
+    for each endpoint, so that a worker is only handed tasks whose endpoint
+    its key can still call.
+    - The task_registry stores the state (queued, in flight, done or
+    failed) of every task enqueued during the run, and is shared by all the
+    workers. The get_* methods use it to skip the tasks which are already
+    queued, in flight or done.
+    - With durable set, the task_registry is stored in the tasks.db SQLite
+    database of the run folder, along with the retry count of each task.
+    A TaskManager created on the folder of an interrupted run continues it
+    with resume, and skips the tasks done before the interruption without
+    checking for their output files.
+    - Failed tasks are handled according to the kind of error: tasks which
+    hit a rate limit are handed over to another key, tasks which failed
+    with a transient error are retried with exponential backoff, preferably
+    by another key, up to max_retries times, and tasks for objects which
+    cannot be fetched (deleted, suspended or protected) are recorded in the
+    dead_letters.txt file of the run. The get_* methods skip the tasks
+    dead-lettered in any run.
+    - The output_folders hold the output files of each task type. The get_*
+    methods check whether an output file exists against an index of each
+    folder built with a single listing, instead of a stat call per id. With
+    shard_output set, the files are stored in 256 hashed subfolders of each
+    output folder.
+    - Pending tweet_details and user_details tasks are grouped into batches
+    of up to LOOKUP_BATCH_SIZE ids before execution, so that each batch is
+    fetched with a single lookup call.
+    - The user_cache stores the user objects fetched during the run, and is
+    shared by all the worker processes. It is filled in bulk through
+    users/lookup before the tasks of a phase are executed, and the tasks of
+    a phase are filtered, costed and queued with a few batched calls to the
+    manager rather than a few calls per task.
+    - The checkpoints store keeps the pagination state of followers,
+    followees and timeline tasks in the base folder, so that they resume
+    from their last checkpoint when retried, even in a later run.
+    - The snapshots store keeps the current follower and followee set of
+    each user, which is updated whenever a new delta is written, so that the
+    history of deltas does not need to be replayed.
+    - With compact_ids set, follower and followee sets are held in memory as
+    sorted int64 arrays and stored in .ids files instead of JSON, which
+    uses a fraction of the memory for accounts with many followers.
+    - Timelines and retweets are streamed to disk as they are fetched. With
+    tweet_format set to 'jsonl' they are stored as JSONL files (optionally
+    gzip or zstd compressed) instead of a JSON array of encoded tweets.
+    - The coverage index stores the range of tweet ids fetched for the
+    timeline of each user and the retweets of each tweet, and the gaps
+    detected in them: timeline fetches which hit the 3200 tweet cap, or
+    returned fewer tweets than the user posted since the last fetch, before
+    reaching the since_id, and tweets with more retweets than
+    statuses/retweets returns. With a backfill_source set (see backfill),
+    a backfill task is enqueued for each object with gaps, which fetches
+    the missing tweets from the source and merges them into the output
+    file of the run by tweet id.
+    - The runs compacted into the baseline of the base folder (see
+    compaction) are not read: the snapshots and the last_tweet_index are
+    up to date as of the last compacted run. The base folder is locked
+    while the TaskManager is open, so that it is not compacted meanwhile.
+    - The last_tweet_index stores the newest tweet id fetched from the
+    timeline of each user, which is used as the since_id of the next fetch.
+    - With change_detection set, the fingerprints index keeps a hash of
+    every field of the latest version of each user_details and
+    tweet_details object (see FingerprintIndex). An object is only written
+    in full the first time it is fetched. Afterwards only its fields which
+    changed are written, to a <id>.delta.json file, and nothing is written
+    when none did. This covers profile changes and the engagement counts of
+    tweets. changed_since returns the objects which changed after a given
+    run. The users are still fetched in bulk, through users/lookup and the
+    user_cache.
+    - The follow_ups map a task type to the types of the tasks a worker
+    enqueues as soon as a task of that type is done, so that dependent
+    tasks start without waiting for the end of the run_tasks phase. The
+    follow-ups of a tweet_details task are the tweet tasks of the tweet and
+    the user tasks of its author, unless the author is in the user ignore
+    list. The follow-ups of a user_details task are user tasks of the user.
+    - The user_ignore_list holds the users whose followers, followees and
+    timeline are not fetched, and is shared by all the workers. Users with
+    more followers or followees than max_follow_count are added to it.
+    The ignore_thresholds map each user task type to the maximum value of
+    user fields (such as followers_count) above which the task is skipped,
+    and default to max_follow_count for the follower and followee counts.
+    The get_* methods skip the users in the ignore list and the cached
+    users above the thresholds, and run_tasks fetches the other users in
+    bulk through users/lookup to skip them before they are queued. With
+    ignore_list_bloom_capacity set, the ignore list is held in a Bloom
+    filter sized for that many users.
+    - The key_health tracks the outcomes, API calls and latency of the
+    tasks of every API key, shared by all the workers. A key whose call is
+    rejected (revoked, suspended or locked) is quarantined and its task is
+    handed over to another key. Other errors, such as Twitter outages, do
+    not count against a key. The worker of a key which is quarantined or
+    removed exits. The quarantined keys are verified again every
+    KEY_RECHECK_INTERVAL seconds while tasks run, and reinstated with a new
+    worker once they are accepted. The apis given to run_tasks can be a
+    KeyPool, whose keys are reloaded from its settings file while the tasks
+    run: workers are started for the keys added, and the keys removed are
+    retired. If no key is left, the remaining tasks are failed.
+    - The metrics store aggregates the metrics recorded by all the workers:
+    the time each task spent waiting in the queue, calling the API and
+    writing its output, the API calls made per method and key, the time
+    spent sleeping on rate limits and the errors per kind. They are written
+    to the run folder after every run_tasks call, as metrics.prom in the
+    Prometheus text format or as metrics.json. With quiet set, the per-task
+    messages and progress bars are not printed.
     - The folder paths corresponding to where the different types of
     information will be stored are also defined.
     """
 
     def __init__(self, base_folder_path, twitter_folder_path,
-                 ignore_list=True, **args):
+                 ignore_list=True, user_cache_ttl=3600,
+                 user_cache_size=100000, checkpoint_interval=10,
+                 compact_ids=False, max_follow_count=20000,
+                 tweet_format='json', tweet_compression=None,
+                 engine='process', engine_shards=1, durable=False,
+                 max_retries=3, skip_dead_letters=True, quiet=False,
+                 metrics_format='prometheus', follow_ups=None,
+                 ignore_thresholds=None, ignore_list_bloom_capacity=None,
+                 shard_output=False, backfill_source=None,
+                 change_detection=False, **args):
         self.base_folder_path = base_folder_path
         self.twitter_folder_path = twitter_folder_path
 
+        self.shard_output = shard_output
+        self.output_folders = {}
+        for task_type, (folder_name, _) in OUTPUT_FOLDERS.items():
+            folder_path = twitter_folder_path + folder_name
+            os.makedirs(folder_path, exist_ok=True)
+            self.output_folders[task_type] = OutputFolder(folder_path,
+                                                          shard_output)
         self.timeline_folder_path = twitter_folder_path + 'timelines/'
-        if not os.path.exists(self.timeline_folder_path):
-            os.makedirs(self.timeline_folder_path)
-
         self.follower_folder_path = twitter_folder_path + 'followers/'
-        if not os.path.exists(self.follower_folder_path):
-            os.makedirs(self.follower_folder_path)
-
         self.followee_folder_path = twitter_folder_path + 'followees/'
-        if not os.path.exists(self.followee_folder_path):
-            os.makedirs(self.followee_folder_path)
-
         self.tweet_details_folder_path = twitter_folder_path + 'tweet_details/'
-        if not os.path.exists(self.tweet_details_folder_path):
-            os.makedirs(self.tweet_details_folder_path)
-
         self.retweets_folder_path = twitter_folder_path + 'retweets/'
-        if not os.path.exists(self.retweets_folder_path):
-            os.makedirs(self.retweets_folder_path)
-
         self.user_details_folder_path = twitter_folder_path + 'user_details/'
-        if not os.path.exists(self.user_details_folder_path):
-            os.makedirs(self.user_details_folder_path)
 
-        self.tasks_pending = Queue()
-        self.tasks_pending_dict = defaultdict(set)
+        self.dead_letters_file_path = twitter_folder_path + \
+            'dead_letters.txt'
+
         self.ignore_list = ignore_list
 
-    def do_task(self, api):
+        self.checkpoints = CheckpointStore(base_folder_path + 'checkpoints/')
+        self.tweet_file_ext = tweet_file_ext(tweet_format, tweet_compression)
+        self.tweet_compression = tweet_compression
+        self.compact_ids = compact_ids
+        self.max_follow_count = max_follow_count
+        self.snapshots = SnapshotStore(base_folder_path + 'snapshots/',
+                                       compact=compact_ids)
+        self.coverage = CoverageIndex(base_folder_path + 'snapshots/coverage/')
+        self.backfill_source = backfill_source
+        self.last_tweet_index = LastTweetIndex(
+            base_folder_path + 'snapshots/last_tweet/')
+        self.change_detection = change_detection
+        self.fingerprints = FingerprintIndex(
+            base_folder_path + 'snapshots/fingerprints/')
+        # The manager process is started before the base folder is locked,
+        # so that it does not inherit the lock file when it is forked
+        self.manager = TaskQueueManager()
+        self.manager.start()
+        # Held until close, so that the base folder is not compacted while
+        # the TaskManager reads and writes it
+        try:
+            self.base_lock = lock_folder(base_folder_path)
+        except BlockingIOError:
+            self.manager.shutdown()
+            raise
+        self.compacted_through = load_manifest(
+            base_folder_path)['compacted_through']
+        self.run_folders = self.list_run_folders()
+        self.dead_letters = self.load_dead_letters() if skip_dead_letters \
+            else set()
+        self.current_run = os.path.relpath(
+            twitter_folder_path, base_folder_path).split(os.sep)[0]
+        self.checkpoint_interval = checkpoint_interval
+        self.max_retries = max_retries
+        self.quiet = quiet
+        self.follow_ups = follow_ups or {}
+        if ignore_thresholds is None:
+            ignore_thresholds = {
+                task_type: {'followers_count': max_follow_count,
+                            'friends_count': max_follow_count}
+                for task_type in USER_TASK_TYPES}
+        self.ignore_thresholds = ignore_thresholds
+        self.metrics_format = metrics_format
+        self.metrics_file_path = twitter_folder_path + \
+            ('metrics.json' if metrics_format == 'json' else 'metrics.prom')
+
+        self.user_cache = self.manager.UserCache(user_cache_ttl,
+                                                 user_cache_size)
+        self.user_cache_size = user_cache_size
+        self.metrics = self.manager.MetricsStore()
+        self.key_health = self.manager.KeyHealth()
+        self.worker_keys = set()
+        self.worker_restarts = {}
+        self.keys_checked_at = time.time()
+        self.user_ignore_list = self.manager.IgnoreList(
+            base_folder_path + 'user_ignore_list.txt',
+            ignore_list_bloom_capacity)
+        self.rate_limits = RateLimitTracker(
+            self.manager, set(TASK_ENDPOINTS.values()) |
+            set(LOOKUP_ENDPOINTS.values()) |
+            {getattr(backfill_source, 'endpoint', BackfillSource.endpoint)})
+
+        self.tasks_staged = []
+        self.task_priorities = {}
+        self.tasks_pending = self.manager.TaskQueue()
+        if durable:
+            self.task_registry = self.manager.DurableTaskRegistry(
+                twitter_folder_path + 'tasks.db', max_retries)
+        else:
+            self.task_registry = self.manager.TaskRegistry(max_retries)
+        if engine == 'thread':
+            self.engine = create_engine(engine, shards=engine_shards)
+        else:
+            self.engine = create_engine(engine)
+
+    def do_task(self, api, key_idx=0):
         """
-        Queries the tasks_pending queue to fetch a new task if available,
-        and executes the tasks based on the TaskType.
+        The main loop of a worker process. Blocks on the tasks_pending queue
+        for a task whose endpoint the API key still has budget for, and
+        executes it based on the TaskType, until the shutdown sentinel is
+        received or the parent process exits.
         """
+        api = InstrumentedAPI(api, key_idx)
+        recorder = MetricsRecorder(self.metrics)
+        set_recorder(recorder)
+        install_rate_limit_handler(key_idx)
+
+        try:
+            self.rate_limits.update_from_status(key_idx,
+                                                api.rate_limit_status())
+        except Exception as e:
+            print("Error while fetching rate limit status: " + str(e))
+            if classify_error(e) == ErrorKind.key:
+                self._quarantine_key(key_idx, error_description(e))
+
         while True:
+            status = self.key_health.status(key_idx)
+            if status != ACTIVE:
+                print("\n" + worker_name() + " stopped: API key " +
+                      str(key_idx) + " is " + status + '\n')
+                recorder.flush()
+                break
+
+            wait_start_time = time.time()
             try:
-                object_id, task_type = self.tasks_pending.get_nowait()
+                task = self.tasks_pending.get(
+                    self.rate_limits.exhausted_endpoints(key_idx),
+                    WORKER_GET_TIMEOUT, key_idx)
             except queue.Empty:
+                recorder.count('worker_idle_seconds_total',
+                               time.time() - wait_start_time,
+                               key=str(key_idx))
+                recorder.flush()
+                # Thread workers run in the main process, which has no parent
+                parent = parent_process()
+                if parent is not None and not parent.is_alive():
+                    break
+                continue
+            recorder.count('worker_idle_seconds_total',
+                           time.time() - wait_start_time, key=str(key_idx))
+
+            if task is None:
+                recorder.flush()
+                self.tasks_pending.task_done(key_idx)
                 break
-            else:
-                try:
-                    if task_type == TaskType.tweet_details:
-                        self._get_tweet_details(object_id, api)
-                    elif task_type == TaskType.retweets:
-                        self._get_retweets(object_id, api)
-                    elif task_type == TaskType.followers:
-                        self._get_followers(object_id, api)
-                    elif task_type == TaskType.followees:
-                        self._get_followees(object_id, api)
-                    elif task_type == TaskType.timeline:
-                        self._get_timelines(object_id, api)
-                    elif task_type == TaskType.user_details:
-                        self._get_user_details(object_id, api)
-                except Exception as e:
-                    print("\nError: Unable to complete " + str(task_type) +
-                          " for id: " + str(object_id) + " - " + str(e) + '\n')
-                    continue
-                finally:
-                    print("\nProcessed: " + str(task_type) + " for id " +
-                          str(object_id) + " is processed by " +
-                          current_process().name + ".\nTasks left: " +
-                          str(self.tasks_pending.qsize()) + '\n')
-                    if object_id in self.tasks_pending_dict[task_type]:
-                        self.tasks_pending_dict[task_type].remove(object_id)
+
+            try:
+                self._execute_task(task, api, key_idx, recorder)
+            except Exception:
+                # The worker dies, but its task must not stay in flight,
+                # which a durable task_registry would keep it as for good
+                self._abandon_task(task)
+                raise
+            finally:
+                # Flushed before task_done, so that the metrics are complete
+                # when run_tasks returns.
+                recorder.flush()
+                self.tasks_pending.task_done(key_idx)
         return True
 
-    def run_tasks(self, apis):
+    def _execute_task(self, task, api, key_idx=0, recorder=None):
+        object_id, task_type = task[:2]
+        if isinstance(object_id, tuple):
+            object_ids = object_id
+            object_desc = "batch of {} ids".format(len(object_id))
+        else:
+            object_ids = (object_id,)
+            object_desc = "id " + str(object_id)
+        endpoint = self._task_endpoint(object_id, task_type)
+        self.task_registry.start(task_type, object_ids)
+        start_time = time.time()
+        start_api_time = getattr(api, 'api_time', 0.0)
+        start_num_calls = getattr(api, 'num_calls', 0)
+        outcome = 'done'
+        result = None
+        try:
+            if isinstance(object_id, tuple):
+                result = self._do_lookup_task(object_id, task_type, api)
+            elif task_type == TaskType.tweet_details:
+                result = self._get_tweet_details(object_id, api)
+            elif task_type == TaskType.retweets:
+                result = self._get_retweets(object_id, api)
+            elif task_type == TaskType.followers:
+                result = self._get_followers(object_id, api)
+            elif task_type == TaskType.followees:
+                result = self._get_followees(object_id, api)
+            elif task_type == TaskType.timeline:
+                result = self._get_timelines(object_id, api)
+            elif task_type == TaskType.user_details:
+                result = self._get_user_details(object_id, api)
+            elif task_type in (TaskType.timeline_backfill,
+                               TaskType.retweets_backfill):
+                result = self._backfill(object_id, task_type, api)
+        except Exception as e:
+            error_kind = classify_error(e)
+            if recorder is not None:
+                recorder.count('errors_total', task_type=task_type.name,
+                               kind=error_kind.name)
+            if error_kind == ErrorKind.rate_limit:
+                outcome = 'rate_limited'
+                # Hand the task over to a key which still has budget left
+                self._log("\nRate limit reached on " + endpoint + " by " +
+                          worker_name() + ", requeueing " + object_desc)
+                self.rate_limits.mark_exhausted(
+                    key_idx, endpoint,
+                    self._reset_time(getattr(e, 'response', None)))
+                self.task_registry.requeue(task_type, object_ids)
+                self._put_task(task)
+                return
+            elif error_kind == ErrorKind.key:
+                outcome = 'key_error'
+                # The object is fine, so the task is handed over as is
+                self._quarantine_key(key_idx, error_description(e))
+                self.task_registry.requeue(task_type, object_ids)
+                self._put_task(task)
+                return
+            elif error_kind == ErrorKind.transient:
+                outcome = 'retried'
+                self._retry_task(task, object_ids, endpoint, key_idx, e)
+                return
+            elif error_kind == ErrorKind.permanent:
+                outcome = 'dead_letter'
+                self._record_dead_letters(object_ids, task_type,
+                                          error_description(e))
+            else:
+                outcome = 'failed'
+                print("\nError: Unable to complete " + str(task_type) +
+                      " for " + object_desc + " - " + str(e) + '\n')
+                self.task_registry.fail(task_type, object_ids)
+        else:
+            # A task whose results cannot be handed over fails like any
+            # other, rather than taking its worker down with it
+            try:
+                self._emit_follow_ups(task_type, result, task[2])
+                self.task_registry.finish(task_type, object_ids)
+            except Exception as e:
+                outcome = 'failed'
+                print("\nError: Unable to finish " + str(task_type) +
+                      " for " + object_desc + " - " + str(e) + '\n')
+                self.task_registry.fail(task_type, object_ids)
+        finally:
+            num_calls = getattr(api, 'num_calls', 0) - start_num_calls
+            # last_response is left over from an earlier task if this one
+            # made no calls, and may come from another endpoint than the
+            # task's one, e.g. users/show for the followers of a screen name
+            if num_calls > 0:
+                self.rate_limits.update_from_response(
+                    key_idx, getattr(api, 'last_response', None))
+            api_time = getattr(api, 'api_time', 0.0) - start_api_time
+            self.key_health.record(key_idx, outcome, num_calls, api_time)
+            if recorder is not None:
+                task_time = time.time() - start_time
+                recorder.count('tasks_total', task_type=task_type.name,
+                               outcome=outcome)
+                recorder.observe('task_seconds', task_time,
+                                 task_type=task_type.name)
+                recorder.observe('task_write_seconds',
+                                 max(task_time - api_time, 0),
+                                 task_type=task_type.name)
+        if not self.quiet:
+            print("\nProcessed: " + str(task_type) + " for " +
+                  object_desc + " is processed by " +
+                  worker_name() + ".\nTasks left: " +
+                  str(self.task_registry.remaining()) + '\n')
+
+    def _quarantine_key(self, key_idx, reason):
+        if self.key_health.quarantine(key_idx, reason):
+            print("\nError: API key " + str(key_idx) + " was rejected (" +
+                  reason + "), quarantining it\n")
+            recorder = current_recorder()
+            if recorder is not None:
+                recorder.count('keys_quarantined_total', key=str(key_idx))
+
+    def _log(self, message):
         """
-        Create processes for parallel execution - each process will use
-        one API key to accomplish one task at a time.
+        Prints a progress message, unless the TaskManager is quiet.
         """
-        processes = []
-        for idx in range(len(apis)):
-            current_api = apis[idx]
-            # api_object = dill.dumps(current_api)
-            p = Process(target=self.do_task, args=(current_api,))
-            processes.append(p)
-            p.start()
+        if not self.quiet:
+            print(message)
 
-        # Avoiding deadlock
-        for idx, p in enumerate(processes):
-            while True:
-                running = p.is_alive()
-                if not self.tasks_pending.empty():
-                    self.do_task(apis[idx])
+    def _emit_follow_ups(self, task_type, result, priority=0):
+        """
+        Enqueues the follow-up tasks of a task which is done, given the
+        tweet or user objects it returned. Called by the workers, which put
+        the follow-up tasks in the tasks_pending queue directly, before the
+        task itself is marked as done, so that tasks_pending.join also waits
+        for them.
+        """
+        follow_up_types = self.follow_ups.get(task_type)
+        if not follow_up_types or result is None:
+            return
+
+        tasks = []
+        for follow_up_type, object_id in self._follow_up_tasks(
+                task_type, result, follow_up_types):
+            tasks.append((object_id, follow_up_type))
+        tasks = self.batch_lookup_tasks(tasks)
+        self._put_tasks(
+            [(object_id, follow_up_type, priority, cost)
+             for (object_id, follow_up_type), cost
+             in zip(tasks, self._estimate_costs(tasks))])
+
+    def _follow_up_tasks(self, task_type, result, follow_up_types):
+        """
+        Returns the (task type, object id) of the follow-up tasks of a task
+        which returned the given tweet or user objects, or their JSON,
+        skipping the tasks which are already tracked or complete.
+        """
+        if not isinstance(result, (list, tuple)):
+            result = [result]
+        objects = [getattr(obj, '_json', obj) for obj in result]
+
+        if task_type in TWEET_TASK_TYPES:
+            # The tweets embed their author, which spares the user tasks a
+            # users/show call
+            self.user_cache.put_many([tweet['user'] for tweet in objects])
+            authors = set(self.user_ignore_list.filter(
+                {tweet['user']['id_str'] for tweet in objects}))
+            objects = [tweet for tweet in objects
+                       if tweet['user']['id_str'] in authors]
+            tweet_ids = [tweet['id_str'] for tweet in objects]
+            user_ids = [tweet['user']['id_str'] for tweet in objects]
+        else:
+            tweet_ids = []
+            user_ids = [user['id_str'] for user in objects]
+        user_ids = list(dict.fromkeys(user_ids))
+
+        follow_up_tasks = []
+        for follow_up_type in follow_up_types:
+            object_ids = tweet_ids if follow_up_type in TWEET_TASK_TYPES \
+                else user_ids
+            follow_up_tasks.extend(
+                (follow_up_type, object_id) for object_id in
+                self._register_tasks(object_ids, follow_up_type))
+        return follow_up_tasks
+
+    def stage_follow_ups(self, task_type, objects):
+        """
+        Stages the follow-up tasks of the given tweet or user JSON objects,
+        e.g. of tweets fetched before a resumed run was interrupted.
+        """
+        for follow_up_type, object_id in self._follow_up_tasks(
+                task_type, objects, self.follow_ups.get(task_type, ())):
+            self.tasks_staged.append((object_id, follow_up_type))
+
+    def _retry_task(self, task, object_ids, endpoint, key_idx, e):
+        """
+        Queues a task which failed with a transient error again after a
+        jittered exponential backoff, to be picked up by another key if
+        possible. Marks it as failed once it has run out of retries.
+        """
+        num_retries = self.task_registry.retry(task[1], object_ids)
+        if num_retries is None:
+            print("\nError: Giving up on " + str(task[1]) + " for " +
+                  str(len(object_ids)) + " ids after " +
+                  str(self.max_retries) + " retries - " + str(e) + '\n')
+            return
+
+        delay = backoff_delay(num_retries)
+        self._log("\nTransient error on {} by {} ({}), retry {} in {:.1f}s"
+                  .format(endpoint, worker_name(), error_description(e),
+                          num_retries, delay))
+        self._put_task(task, delay, key_idx)
+
+    def _put_task(self, task, delay=0, avoid_key=None):
+        """
+        Puts an (object_id, task_type, priority, cost) task in the
+        tasks_pending queue.
+        """
+        object_id, task_type, priority, cost = task
+        self.tasks_pending.put(task, self._task_endpoint(object_id, task_type),
+                               delay, avoid_key, priority, cost)
+
+    def _put_tasks(self, tasks):
+        """
+        Puts a list of (object_id, task_type, priority, cost) tasks in the
+        tasks_pending queue with a single call to the manager.
+        """
+        if tasks:
+            self.tasks_pending.put_many(
+                [(task, self._task_endpoint(task[0], task[1]), task[2],
+                  task[3]) for task in tasks])
+
+    def _task_priority(self, object_id, task_type):
+        object_ids = object_id if isinstance(object_id, tuple) else \
+            (object_id,)
+        return max(self.task_priorities.pop((task_type, str(object_id)), 0)
+                   for object_id in object_ids)
+
+    def _estimate_cost(self, object_id, task_type):
+        return self._estimate_costs([(object_id, task_type)])[0]
+
+    def _estimate_costs(self, tasks):
+        """
+        Returns the estimated costs of a list of (object_id, task_type)
+        tasks, looking up the users of the tasks in the user_cache at once.
+        """
+        user_ids = [object_id for object_id, task_type in tasks
+                    if task_type in USER_TASK_TYPES]
+        user_jsons = iter(self.user_cache.lookup(user_ids) if user_ids
+                          else ())
+        return [self._task_cost(object_id, task_type,
+                                next(user_jsons)
+                                if task_type in USER_TASK_TYPES else None)
+                for object_id, task_type in tasks]
+
+    def _task_cost(self, object_id, task_type, user_json):
+        """
+        Returns the estimated cost of a task, as the number of rate limit
+        windows its calls take up. The cost of followers, followees and
+        timeline tasks is estimated from the cached user JSON of the user,
+        and is 0 for users that will be ignored.
+        """
+        endpoint = self._task_endpoint(object_id, task_type)
+        num_calls = 1
+        if task_type in USER_TASK_TYPES:
+            if user_json is not None:
+                if self.exceeds_threshold(user_json, task_type):
+                    return 0
+                if task_type == TaskType.followers:
+                    num_items = user_json['followers_count']
+                    page_size = IDS_PAGE_SIZE
+                elif task_type == TaskType.followees:
+                    num_items = user_json['friends_count']
+                    page_size = IDS_PAGE_SIZE
                 else:
-                    if not running:
-                        break
+                    num_items = min(user_json['statuses_count'],
+                                    MAX_TIMELINE_TWEETS)
+                    page_size = TIMELINE_PAGE_SIZE
+                num_calls = max(1, -(-num_items // page_size))
+        # The endpoints of custom backfill sources are assumed to allow as
+        # many calls as search/tweets
+        return num_calls / ENDPOINT_WINDOW_CALLS.get(
+            endpoint, ENDPOINT_WINDOW_CALLS['/search/tweets'])
+
+    def _task_endpoint(self, object_id, task_type):
+        if isinstance(object_id, tuple):
+            return LOOKUP_ENDPOINTS[task_type]
+        if task_type in (TaskType.timeline_backfill,
+                         TaskType.retweets_backfill) and \
+                self.backfill_source is not None:
+            return self.backfill_source.endpoint
+        return TASK_ENDPOINTS[task_type]
+
+    def _reset_time(self, response):
+        if response is None:
+            return None
+        reset = response.headers.get('x-rate-limit-reset')
+        return int(reset) if reset is not None else None
+
+    def _do_lookup_task(self, object_ids, task_type, api):
+        if task_type == TaskType.tweet_details:
+            return self._lookup_tweet_details(object_ids, api)
+        elif task_type == TaskType.user_details:
+            return self._lookup_user_details(object_ids, api)
+        else:
+            raise ValueError("Batched lookups are not supported for " +
+                             str(task_type))
+
+    def batch_lookup_tasks(self, tasks):
+        """
+        Regroups the tweet_details and user_details tasks in the given list
+        into batches of up to LOOKUP_BATCH_SIZE ids. Every other task is
+        returned in its original order, ahead of the batches.
+        """
+        lookup_ids = defaultdict(list)
+        batched_tasks = []
+        for object_id, task_type in tasks:
+            if task_type in (TaskType.tweet_details, TaskType.user_details):
+                if isinstance(object_id, tuple):
+                    lookup_ids[task_type].extend(object_id)
+                else:
+                    lookup_ids[task_type].append(object_id)
+            else:
+                batched_tasks.append((object_id, task_type))
+
+        for task_type, object_ids in lookup_ids.items():
+            for idx in range(0, len(object_ids), LOOKUP_BATCH_SIZE):
+                batch = tuple(object_ids[idx:idx + LOOKUP_BATCH_SIZE])
+                batched_tasks.append((batch, task_type))
+        return batched_tasks
+
+    def _keyed_apis(self, apis, status=ACTIVE):
+        """
+        Returns the (key_idx, api) of the keys of a list of API objects or a
+        KeyPool which have the given status.
+        """
+        statuses = self.key_health.statuses()
+        if isinstance(apis, KeyPool):
+            keyed_apis = apis.keyed_apis()
+            for key_idx, _ in keyed_apis:
+                if key_idx not in statuses:
+                    self.key_health.register(key_idx, apis.name(key_idx))
+        else:
+            keyed_apis = list(enumerate(apis))
+        return [(key_idx, api) for key_idx, api in keyed_apis
+                if statuses.get(key_idx, ACTIVE) == status]
 
-        # Completing processes
-        print("Waiting for processes to finish...")
-        for p in processes:
-            p.join()
+    def recheck_keys(self, apis, force=False):
+        """
+        Verifies the quarantined keys again, at most every
+        KEY_RECHECK_INTERVAL seconds unless force is set, and reinstates the
+        ones which are accepted. Returns the number of keys reinstated.
+        """
+        if not force and \
+                time.time() - self.keys_checked_at < KEY_RECHECK_INTERVAL:
+            return 0
+        self.keys_checked_at = time.time()
+        num_reinstated = 0
+        for key_idx, api in self._keyed_apis(apis, QUARANTINED):
+            error = verify_api(api)
+            if error is not None:
+                self._log("API key {} is still rejected ({})".format(
+                    key_idx, error))
+            elif self.key_health.reinstate(key_idx):
+                print("Reinstated API key " + str(key_idx))
+                # Its worker exited when it was quarantined
+                self.worker_keys.discard(key_idx)
+                num_reinstated += 1
+        return num_reinstated
+
+    def start_workers(self, apis):
+        """
+        Starts one long-lived worker per active API key on the execution
+        engine, for the keys which have none yet. The keys removed from a
+        KeyPool are marked as removed, so that their workers exit. The
+        workers stay alive across consecutive run_tasks calls until close is
+        called. Returns the number of active keys.
+        """
+        self.recheck_keys(apis)
+        if isinstance(apis, KeyPool):
+            apis.refresh()
+            pool_keys = {key_idx for key_idx, _ in apis.keyed_apis()}
+            for key_idx in self.worker_keys - pool_keys:
+                self.key_health.remove(key_idx)
+                print("Removed API key " + str(key_idx))
+
+        keyed_apis = self._keyed_apis(apis)
+        active_keys = {key_idx for key_idx, _ in keyed_apis}
+        # The workers of the other keys have exited, or are about to
+        self.worker_keys &= active_keys
+        new_keyed_apis = [(key_idx, api) for key_idx, api in keyed_apis
+                          if key_idx not in self.worker_keys]
+        if new_keyed_apis:
+            if self.engine.is_running():
+                print("Starting workers for {} API keys".format(
+                    len(new_keyed_apis)))
+            self.engine.start(self.do_task, new_keyed_apis)
+            self.worker_keys.update(key_idx for key_idx, _ in new_keyed_apis)
+        return len(active_keys)
+
+    def _check_workers(self):
+        """
+        Forgets the workers which have exited, so that start_workers starts
+        new ones for their keys. Workers only exit by themselves once their
+        key is no longer active, so the exit of any other worker is a crash.
+        Once the worker of a key has crashed more than MAX_WORKER_RESTARTS
+        times, the remaining tasks are failed and a RuntimeError is raised.
+        """
+        for key_idx in self.engine.exited_keys():
+            self.worker_keys.discard(key_idx)
+            # A worker process which was killed never called task_done
+            task = self.tasks_pending.abandon(key_idx)
+            if task is not None:
+                self._abandon_task(task)
+            if not self.key_health.is_active(key_idx):
+                continue
+            self.worker_restarts[key_idx] = \
+                self.worker_restarts.get(key_idx, 0) + 1
+            print("\nError: The worker of API key " + str(key_idx) +
+                  " exited unexpectedly\n")
+            if self.worker_restarts[key_idx] > MAX_WORKER_RESTARTS:
+                self._fail_pending_tasks(
+                    "The worker of API key {} keeps exiting".format(key_idx))
+                raise RuntimeError(
+                    "The worker of API key {} exited unexpectedly {} "
+                    "times".format(key_idx, self.worker_restarts[key_idx]))
+
+    def _fail_pending_tasks(self, reason):
+        tasks = self.tasks_pending.drain()
+        if tasks:
+            print("\nError: {}, failing {} tasks\n".format(
+                reason, len(tasks)))
+        for object_id, task_type, _, _ in tasks:
+            self.task_registry.fail(
+                task_type, object_id if isinstance(object_id, tuple)
+                else (object_id,))
+
+    def _abandon_task(self, task):
+        object_id, task_type = task[:2]
+        print("\nError: " + str(task_type) + " for " + str(object_id) +
+              " was abandoned by its worker\n")
+        self.task_registry.abandon(
+            task_type, object_id if isinstance(object_id, tuple)
+            else (object_id,))
+
+    def _wait_for_tasks(self, apis):
+        """
+        Blocks until all the tasks in tasks_pending are processed, checking
+        the workers and the API keys every KEY_POLL_INTERVAL seconds. If no
+        key is left, even after verifying the quarantined keys again, the
+        remaining tasks are failed.
+        """
+        while not self.tasks_pending.join(KEY_POLL_INTERVAL):
+            self._check_workers()
+            if self.start_workers(apis) > 0:
+                continue
+            if self.recheck_keys(apis, force=True) > 0 and \
+                    self.start_workers(apis) > 0:
+                continue
+            self._fail_pending_tasks("No API key is left")
+
+    def key_stats(self):
+        """
+        Returns the health of every API key, see KeyHealth.stats.
+        """
+        return self.key_health.stats()
+
+    def run_tasks(self, apis):
+        """
+        Dispatches the tasks enqueued since the last call to the workers -
+        each worker uses one API key to accomplish one task at a time - and
+        blocks until all of them are processed. The metrics are exported
+        once they are.
+        """
+        start_time = time.time()
+        tasks = self.batch_lookup_tasks(self.tasks_staged)
+        self.tasks_staged = []
+
+        self.prefetch_users(
+            [object_id for object_id, task_type in tasks
+             if task_type in USER_TASK_TYPES], apis)
+        tasks = self._prefilter_user_tasks(tasks)
+
+        self.start_workers(apis)
+        self._put_tasks(
+            [(object_id, task_type, self._task_priority(object_id, task_type),
+              cost) for (object_id, task_type), cost
+             in zip(tasks, self._estimate_costs(tasks))])
+
+        print("Waiting for {} tasks to finish...".format(len(tasks)))
+        self._wait_for_tasks(apis)
+        for key_idx, stats in sorted(self.key_stats().items()):
+            if stats['status'] != ACTIVE:
+                print("API key {} ({}) is {}: {}".format(
+                    key_idx, stats['name'], stats['status'],
+                    stats['reason']))
+
+        recorder = MetricsRecorder(self.metrics)
+        recorder.count('run_tasks_dispatched_total', len(tasks))
+        recorder.observe('run_tasks_seconds', time.time() - start_time)
+        recorder.flush()
+        if self.metrics_format is not None:
+            self.export_metrics()
+
+    def _prefilter_user_tasks(self, tasks):
+        """
+        Drops the user tasks of the users in the ignore list and of the
+        cached users above the ignore_thresholds of the task type. The
+        dropped tasks are marked as done, as they would be by a worker.
+        """
+        skipped = defaultdict(list)
+        for task_type in USER_TASK_TYPES:
+            user_ids = [object_id for object_id, object_type in tasks
+                        if object_type == task_type]
+            if user_ids:
+                kept_ids = set(self._filter_users(user_ids, task_type))
+                skipped[task_type] = [user_id for user_id in user_ids
+                                      if user_id not in kept_ids]
+        if not any(skipped.values()):
+            return tasks
+
+        for task_type, user_ids in skipped.items():
+            self.task_registry.mark_done(task_type, user_ids)
+        self._log("Skipping {} tasks of ignored users".format(
+            sum(len(user_ids) for user_ids in skipped.values())))
+        skipped = {(task_type, str(user_id))
+                   for task_type, user_ids in skipped.items()
+                   for user_id in user_ids}
+        return [(object_id, task_type) for object_id, task_type in tasks
+                if (task_type, str(object_id)) not in skipped]
+
+    def _filter_users(self, user_ids, task_type):
+        """
+        Returns the given user ids and screen names which are not in the
+        ignore list and, when cached, are not above the ignore_thresholds
+        of the task type.
+        """
+        if not self.ignore_list:
+            return user_ids
+        user_ids = self.user_ignore_list.filter(user_ids)
+        if task_type not in self.ignore_thresholds:
+            return user_ids
+        return [user_id for user_id, user_json
+                in zip(user_ids, self.user_cache.lookup(user_ids))
+                if not self.should_skip_user(user_json, task_type)]
+
+    def metrics_snapshot(self):
+        """
+        Returns the metrics aggregated so far, as lists of counters and
+        summaries, including the time tasks waited in the queue.
+        """
+        counters, summaries = self.metrics.snapshot()
+        for endpoint, count, total, maximum in \
+                self.tasks_pending.get_wait_stats():
+            summaries.append(('queue_wait_seconds',
+                              (('endpoint', endpoint),), count, total,
+                              maximum))
+        return counters, summaries
+
+    def export_metrics(self):
+        counters, summaries = self.metrics_snapshot()
+        write_metrics(self.metrics_file_path, counters, summaries,
+                      self.metrics_format)
+
+    def close(self):
+        """
+        Shuts down the workers by sending one sentinel per worker, waits for
+        them to exit, and then shuts down the manager process and releases
+        the lock on the base folder.
+        """
+        for _ in range(self.engine.num_workers):
+            self.tasks_pending.put(None)
+        self.engine.join()
+        self.manager.shutdown()
+        self.base_lock.close()
+
+    def __getstate__(self):
+        # The workers only use the proxies of the manager, so the manager
+        # itself, the lock on the base folder and the engine holding the
+        # worker processes are left out when the TaskManager is pickled for
+        # a worker process (with the spawn start method)
+        state = self.__dict__.copy()
+        for name in ('manager', 'base_lock', 'engine'):
+            state.pop(name, None)
+        return state
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
     def _get_tweet_details(self, tweet_id, api):
-        print("Getting tweet details of tweet {}".format(tweet_id))
+        self._log("Getting tweet details of tweet {}".format(tweet_id))
 
         tweet_details = api.get_status(tweet_id, tweet_mode='extended')
 
-        print("Writing the details of {} to file...".format(tweet_id))
+        self._log("Writing the details of {} to file...".format(tweet_id))
 
-        with open(self.tweet_details_folder_path + '/' + str(tweet_id) +
-                  '.json', 'w') as fw:
-            json.dump(tweet_details._json, fw)
+        self._write_details(TaskType.tweet_details, tweet_details.id_str,
+                            tweet_details._json)
         return tweet_details
 
-    def _get_retweets(self, tweet_id, api):
-        print("Getting retweets of tweet {}".format(tweet_id))
+    def _lookup_tweet_details(self, tweet_ids, api):
+        self._log("Looking up details of {} tweets".format(len(tweet_ids)))
 
-        retweets = api.retweets(tweet_id, 200, tweet_mode='extended')
+        tweets = api.statuses_lookup(list(tweet_ids), tweet_mode='extended')
 
-        print("Writing the {0} retweets of {1} to file".format(
-            len(retweets), tweet_id))
+        self._log("Writing the details of {} tweets to file...".format(
+                len(tweets)))
 
-        retweets_arr = []
-        for retweet in retweets:
-            retweets_arr.append(json.dumps(retweet._json))
+        found_ids = set()
+        for tweet_details in tweets:
+            found_ids.add(tweet_details.id_str)
+            self._write_details(TaskType.tweet_details, tweet_details.id_str,
+                                tweet_details._json)
 
-        with open(self.retweets_folder_path + str(tweet_id) +
-                  '.json', 'w') as fw:
-            json.dump(retweets_arr, fw)
+        missing_ids = [tweet_id for tweet_id in tweet_ids
+                       if str(tweet_id) not in found_ids]
+        self._record_failed_lookups(missing_ids, TaskType.tweet_details)
+        return tweets
+
+    def _get_retweets(self, tweet_id, api):
+        self._log("Getting retweets of tweet {}".format(tweet_id))
+
+        retweets = api.retweets(tweet_id, RETWEETS_PAGE_SIZE,
+                                tweet_mode='extended')
+
+        self._log("Writing the {0} retweets of {1} to file".format(
+                len(retweets), tweet_id))
+
+        writer = TweetWriter(self._output_path(TaskType.retweets, tweet_id,
+                                               self.tweet_file_ext),
+                             self.tweet_compression)
+        try:
+            for retweet in retweets:
+                writer.write(retweet._json)
+        except Exception:
+            writer.abort(keep_part=False)
+            raise
+        writer.commit()
+
+        if len(retweets) == 0:
+            return
+        # statuses/retweets only returns the newest retweets, so the older
+        # ones are a gap if the tweet has more
+        tweet = retweets[0].retweeted_status
+        oldest_retweet_id = min(retweet.id for retweet in retweets)
+        gap = None
+        if len(retweets) >= RETWEETS_PAGE_SIZE and \
+                tweet.retweet_count > len(retweets):
+            gap = (int(tweet_id) + 1, oldest_retweet_id - 1)
+        self._record_coverage(TaskType.retweets, tweet_id, oldest_retweet_id,
+                              max(retweet.id for retweet in retweets), gap,
+                              tweet.retweet_count, tweet.user.screen_name)
 
     def _get_followers(self, user_id, api):
-        user_obj = api.get_user(user_id)
+        user_obj = self._get_user_obj(user_id, api)
 
-        if self.add_user_to_ignore_list(user_obj):
+        if self.add_user_to_ignore_list(user_obj, TaskType.followers):
             return
+        self._check_accessible(user_obj)
 
         user_id = user_obj.id_str
         all_followers = self.get_all_followers(user_id)
 
         followers_added = []
         followers_subtracted = []
-        followers_current = set()
 
-        print("Getting followers of user {}".format(user_id))
+        self._log("Getting followers of user {}".format(user_id))
 
         try:
-            for follower in tqdm(tweepy.Cursor(
-                    api.followers_ids, id=user_id).items(), unit="followers"):
-                followers_current.add(follower)
+            followers_current = self._get_ids(api.followers_ids, 'followers',
+                                              user_id)
         except Exception as e:
             print("Error while fetching user followers: " + str(e))
+            raise
         else:
-            followers_added = [item for item in followers_current
-                               if item not in all_followers]
-            followers_subtracted = [item for item in all_followers
-                                    if item not in followers_current]
+            followers_added, followers_subtracted = diff_ids(
+                followers_current, all_followers)
             followers = {'followers_added': followers_added,
                          'followers_subtracted': followers_subtracted}
 
-            print("Writing followers for user {}. Added: {}, Subtracted: {}"
-                  .format(user_id, len(followers_added),
-                          len(followers_subtracted)))
+            self._log("Writing {} for user {}. Added: {}, Subtracted: {}"
+                      .format('followers', user_id, len(followers_added),
+                              len(followers_subtracted)))
 
-            with open(self.follower_folder_path + str(user_id) +
-                      '.json', 'w') as fw:
-                json.dump(followers, fw)
+            self._write_delta(TaskType.followers, user_id, followers)
+            self.snapshots.save('followers', user_id, self.current_run,
+                                followers_current)
 
     def _get_followees(self, user_id, api):
-        user_obj = api.get_user(user_id)
+        user_obj = self._get_user_obj(user_id, api)
 
-        if self.add_user_to_ignore_list(user_obj):
+        if self.add_user_to_ignore_list(user_obj, TaskType.followees):
             return
+        self._check_accessible(user_obj)
 
         user_id = user_obj.id_str
         all_followees = self.get_all_followees(user_id)
 
         followees_added = []
         followees_subtracted = []
-        followees_current = set()
 
-        print("Getting followees of user {}".format(user_id))
+        self._log("Getting followees of user {}".format(user_id))
 
         try:
-            for followee in tqdm(tweepy.Cursor(
-                    api.friends_ids, id=user_id).items(), unit="followees"):
-                followees_current.add(followee)
+            followees_current = self._get_ids(api.friends_ids, 'followees',
+                                              user_id)
         except Exception as e:
             print("Error while fetching user followees: " + str(e))
+            raise
         else:
-            followees_added = [item for item in followees_current
-                               if item not in all_followees]
-            followees_subtracted = [item for item in all_followees
-                                    if item not in followees_current]
+            followees_added, followees_subtracted = diff_ids(
+                followees_current, all_followees)
             followees = {'followees_added': followees_added,
                          'followees_subtracted': followees_subtracted}
 
-            print("Writing followees for user {}. Added: {}, Subtracted: {}"
-                  .format(user_id, len(followees_added),
-                          len(followees_subtracted)))
+            self._log("Writing {} for user {}. Added: {}, Subtracted: {}"
+                      .format('followees', user_id, len(followees_added),
+                              len(followees_subtracted)))
 
-            with open(self.followee_folder_path + str(user_id) +
-                      '.json', 'w') as fw:
-                json.dump(followees, fw)
+            self._write_delta(TaskType.followees, user_id, followees)
+            self.snapshots.save('followees', user_id, self.current_run,
+                                followees_current)
 
     def _get_timelines(self, user_id, api):
-        user_obj = api.get_user(user_id)
+        user_obj = self._get_user_obj(user_id, api)
 
-        if self.add_user_to_ignore_list(user_obj):
+        if self.add_user_to_ignore_list(user_obj, TaskType.timeline):
             return
+        self._check_accessible(user_obj)
 
         user_id = user_obj.id_str
-        last_tweet_id = self.get_last_tweet_id(user_id)
 
-        tweets_arr = []
+        # The timeline is paged through with max_id, and the tweets are
+        # streamed to a .part file. The max_id and the size of the .part
+        # file are checkpointed so that a retried task resumes from the last
+        # checkpointed page.
+        timeline_path = self._output_path(TaskType.timeline, user_id,
+                                          self.tweet_file_ext)
+        checkpoint = self.checkpoints.load('timeline', user_id)
+        if checkpoint is not None and \
+                checkpoint['tweet_file_ext'] == self.tweet_file_ext and \
+                os.path.exists(checkpoint['part_path']):
+            self._log("Resuming timeline of user {} from max_id {}".format(
+                    user_id, checkpoint['max_id']))
+            last_tweet_id = checkpoint['since_id']
+            max_id = checkpoint['max_id']
+            newest_tweet_id = checkpoint['newest_tweet_id']
+            num_tweets = checkpoint['num_tweets']
+            writer = TweetWriter(timeline_path, self.tweet_compression,
+                                 part_path=checkpoint['part_path'],
+                                 resume_size=checkpoint['part_size'])
+        else:
+            last_tweet_id = self.get_last_tweet_id(user_id)
+            max_id = None
+            newest_tweet_id = None
+            num_tweets = 0
+            writer = TweetWriter(timeline_path, self.tweet_compression)
 
-        print("Fetching timelines for user {}".format(user_id))
+        self._log("Fetching timelines for user {}".format(user_id))
 
+        progress = tqdm(unit="tweets", initial=num_tweets,
+                        disable=self.quiet)
+        num_pages = 0
         try:
-            if last_tweet_id != -1:
-                for tweet in tqdm(tweepy.Cursor(
-                        api.user_timeline, id=user_id,
-                        since_id=int(last_tweet_id),
-                        tweet_mode='extended')
-                        .items(), unit="tweets"):
-                    tweets_arr.append(json.dumps(tweet._json))
-            else:
-                for tweet in tweepy.Cursor(
-                        api.user_timeline, id=user_id,
-                        tweet_mode='extended').items():
-                    tweets_arr.append(json.dumps(tweet._json))
+            while True:
+                tweets = api.user_timeline(
+                    id=user_id, count=TIMELINE_PAGE_SIZE, max_id=max_id,
+                    since_id=int(last_tweet_id) if last_tweet_id != -1
+                    else None, tweet_mode='extended')
+                if len(tweets) == 0:
+                    break
+
+                if newest_tweet_id is None:
+                    newest_tweet_id = tweets[0].id
+                for tweet in tweets:
+                    writer.write(tweet._json)
+                num_tweets += len(tweets)
+                progress.update(len(tweets))
+                max_id = tweets[-1].id - 1
+
+                num_pages += 1
+                if num_pages % self.checkpoint_interval == 0:
+                    self._save_timeline_checkpoint(
+                        user_id, writer, last_tweet_id, max_id,
+                        newest_tweet_id, num_tweets)
         except Exception as e:
             print("Error while fetching user timeline: " + str(e))
+            if max_id is not None:
+                self._save_timeline_checkpoint(
+                    user_id, writer, last_tweet_id, max_id,
+                    newest_tweet_id, num_tweets)
+            writer.abort(keep_part=max_id is not None)
+            raise
+        else:
+            self._log("Writing {} tweets of user {}"
+                      .format(num_tweets, user_id))
+            if num_tweets != 0:
+                writer.commit()
+                self.last_tweet_index.save(user_id, self.current_run,
+                                           newest_tweet_id)
+            else:
+                writer.abort(keep_part=False)
+            self.checkpoints.remove('timeline', user_id)
+            self._record_timeline_coverage(user_obj, last_tweet_id,
+                                           max_id, newest_tweet_id,
+                                           num_tweets)
+        finally:
+            progress.close()
+
+    def _record_timeline_coverage(self, user_obj, last_tweet_id, max_id,
+                                  newest_tweet_id, num_tweets):
+        """
+        Records the range of tweets fetched from a user's timeline, and a
+        gap between the since_id of the fetch and the oldest tweet it
+        returned if the fetch hit the cap on the number of tweets, or
+        returned fewer tweets than the user posted since the last fetch.
+        """
+        user_id = user_obj.id_str
+        oldest_tweet_id = max_id + 1 if num_tweets else None
+        gap = None
+        if num_tweets and last_tweet_id != -1 and \
+                oldest_tweet_id > int(last_tweet_id) + 1:
+            previous_count = self.coverage.load('timelines', user_id)['count']
+            if num_tweets >= MAX_TIMELINE_TWEETS - TIMELINE_PAGE_SIZE or \
+                    (previous_count is not None and num_tweets <
+                     user_obj.statuses_count - previous_count):
+                gap = (int(last_tweet_id) + 1, oldest_tweet_id - 1)
+        self._record_coverage(TaskType.timeline, user_id, oldest_tweet_id,
+                              newest_tweet_id, gap, user_obj.statuses_count,
+                              user_obj.screen_name)
+
+    def _record_coverage(self, task_type, object_id, low, high, gap, count,
+                         screen_name):
+        """
+        Records a fetch in the coverage index, and enqueues a backfill task
+        for the object if it has gaps which were not found unreachable by an
+        earlier backfill, and a backfill_source is set. Only fetches which
+        returned tweets enqueue one, as the backfilled tweets are merged
+        into the output file written by the fetch. Called by the workers
+        before the task is marked as done, like follow-ups.
+        """
+        backfill_type, kind = BACKFILL_TASK_TYPES[task_type]
+        entry = self.coverage.record(kind, object_id, low, high, gap, count,
+                                     screen_name)
+        # Gaps which are already covered or unreachable are not new
+        if gap is not None and any(
+                gap_low <= gap[1] and gap[0] <= gap_high
+                for gap_low, gap_high in entry['gaps']):
+            self._log("Gap of tweet ids {} to {} in the {} of {}".format(
+                gap[0], gap[1], kind, object_id))
+            recorder = current_recorder()
+            if recorder is not None:
+                recorder.count('coverage_gaps_total', kind=kind)
+        if low is None or not entry['gaps'] or self.backfill_source is None:
+            return
+        for object_id in self._register_tasks([object_id], backfill_type):
+            self._put_task((object_id, backfill_type, 0,
+                            self._estimate_cost(object_id, backfill_type)))
+
+    def _backfill(self, object_id, task_type, api):
+        """
+        Fills the gaps recorded for the timeline of a user or the retweets
+        of a tweet from the backfill_source, merging the tweets it returns
+        into the output file of this run, deduplicated by tweet id. Only the
+        part of each gap which the source returned tweets for is recorded as
+        covered, and the rest as unreachable. Nothing is backfilled if this
+        run wrote no output file for the object, so that no file of this run
+        holds only older tweets.
+        """
+        if self.backfill_source is None:
+            return
+        output_type = TaskType.timeline \
+            if task_type == TaskType.timeline_backfill else TaskType.retweets
+        kind = BACKFILL_TASK_TYPES[output_type][1]
+        existing_path = self.output_folders[output_type].find(
+            object_id, OUTPUT_FOLDERS[output_type][1])
+        if existing_path is None:
+            self._log("No {} of {} in this run, skipping the backfill".format(
+                kind, object_id))
+            return
+        entry = self.coverage.load(kind, object_id)
+        for gap in entry['gaps']:
+            self._log("Backfilling tweet ids {} to {} in the {} of {}".format(
+                gap[0], gap[1], kind, object_id))
+            if output_type == TaskType.timeline:
+                tweets = self.backfill_source.fetch_timeline(
+                    api, entry['screen_name'], gap[0], gap[1])
+            else:
+                tweets = self.backfill_source.fetch_retweets(
+                    api, entry['screen_name'], object_id, gap[1])
+            tweets = list(tweets)
+            path = self._output_path(output_type, object_id,
+                                     self.tweet_file_ext)
+            num_added = merge_tweets(path, tweets, self.tweet_compression,
+                                     existing_path)
+            existing_path = path
+            self._log("Backfilled {} tweets in the {} of {}".format(
+                num_added, kind, object_id))
+            self.coverage.fill(
+                kind, object_id, gap,
+                min(int(tweet['id']) for tweet in tweets) if tweets else None)
+
+    def _save_timeline_checkpoint(self, user_id, writer, last_tweet_id,
+                                  max_id, newest_tweet_id, num_tweets):
+        self.checkpoints.save('timeline', user_id, {
+            'since_id': last_tweet_id, 'max_id': max_id,
+            'newest_tweet_id': newest_tweet_id, 'num_tweets': num_tweets,
+            'tweet_file_ext': self.tweet_file_ext,
+            'part_path': writer.part_path, 'part_size': writer.checkpoint()})
+
+    def _get_ids(self, api_method, task_name, user_id):
+        """
+        Pages through followers/ids or friends/ids of a user. The cursor and
+        the ids fetched so far are checkpointed every checkpoint_interval
+        pages and when a page fails, and the task resumes from the last
+        checkpoint when it is retried. In compact mode the ids are saved to
+        an .ids file next to the checkpoint, which only stores its path.
+        """
+        checkpoint = self.checkpoints.load(task_name, user_id)
+        if checkpoint is not None and 'ids_path' in checkpoint and \
+                not os.path.exists(checkpoint['ids_path']):
+            checkpoint = None
+        if checkpoint is not None:
+            self._log("Resuming {} of user {} from cursor {}".format(
+                    task_name, user_id, checkpoint['cursor']))
+            cursor = checkpoint['cursor']
+            if 'ids_path' in checkpoint:
+                ids = load_ids(checkpoint['ids_path'])[1]['ids']
+            else:
+                ids = checkpoint['ids']
+        else:
+            cursor = -1
+            ids = []
+        # Pages are accumulated in an int64 array in compact mode, and
+        # deduplicated once all of them are fetched.
+        ids = array('q', ids) if self.compact_ids else set(ids)
+
+        pages = tweepy.Cursor(api_method, id=user_id, cursor=cursor).pages()
+        progress = tqdm(unit=task_name, initial=len(ids),
+                        disable=self.quiet)
+        try:
+            for num_pages, page in enumerate(pages, 1):
+                if self.compact_ids:
+                    ids.extend(page)
+                else:
+                    ids.update(page)
+                progress.update(len(page))
+                if num_pages % self.checkpoint_interval == 0 and \
+                        pages.next_cursor != 0:
+                    self._save_ids_checkpoint(task_name, user_id,
+                                              pages.next_cursor, ids)
+        except Exception:
+            if pages.next_cursor not in (-1, 0):
+                self._save_ids_checkpoint(task_name, user_id,
+                                          pages.next_cursor, ids)
+            raise
+        finally:
+            progress.close()
+
+        self.checkpoints.remove(task_name, user_id)
+        ids_path = self._ids_checkpoint_path(task_name, user_id)
+        if os.path.exists(ids_path):
+            os.remove(ids_path)
+        return compact_ids(ids) if self.compact_ids else ids
+
+    def _ids_checkpoint_path(self, task_name, user_id):
+        return self.checkpoints.folder_path + task_name + '_' + \
+            str(user_id) + IDS_FILE_EXT
+
+    def _save_ids_checkpoint(self, task_name, user_id, cursor, ids):
+        if not self.compact_ids:
+            self.checkpoints.save(task_name, user_id,
+                                  {'cursor': cursor, 'ids': list(ids)})
+            return
+        # The .ids file is written first, so that the checkpoint never
+        # points to ids older than its cursor. Newer ones only add
+        # duplicates, which are dropped once all the pages are fetched.
+        ids_path = self._ids_checkpoint_path(task_name, user_id)
+        save_ids(ids_path, {'ids': ids})
+        self.checkpoints.save(task_name, user_id,
+                              {'cursor': cursor, 'ids_path': ids_path})
+
+    def _write_delta(self, task_type, user_id, delta):
+        """
+        Writes the ids added and subtracted for a user, as an .ids file in
+        compact mode and as a JSON file otherwise.
+        """
+        if self.compact_ids:
+            save_ids(self._output_path(task_type, user_id, IDS_FILE_EXT),
+                     delta)
         else:
-            print("Writing {} tweets of user {}"
-                  .format(len(tweets_arr), user_id))
-            if (len(tweets_arr) != 0):
-                with open(self.timeline_folder_path + str(user_id) +
-                          '.json', 'w') as fw:
-                    json.dump(tweets_arr, fw)
+            write_json_atomic(self._output_path(task_type, user_id, '.json'),
+                              {name: [int(item) for item in ids]
+                               for name, ids in delta.items()})
 
     def _get_user_details(self, user_id, api):
-        print("Getting user details of user {}".format(user_id))
+        self._log("Getting user details of user {}".format(user_id))
 
-        user_obj = api.get_user(user_id)
+        user_obj = self._get_user_obj(user_id, api)
         user_id = user_obj.id_str
 
-        if os.path.exists(self.user_details_folder_path +
-                          str(user_id) + '.json'):
-            print("Already fetched user details for user {}".format(user_id))
-            with open(self.user_details_folder_path + '/' + str(user_id) +
-                      '.json') as f:
+        user_details_path = self.output_folders[
+            TaskType.user_details].find(user_id, ('.json',))
+        if user_details_path is not None:
+            self._log("Already fetched user details for user {}".format(
+                user_id))
+            with open(user_details_path) as f:
                 return json.load(f)
 
-        print("Writing the user object of {} to file...".format(user_id))
+        self._log("Writing the user object of {} to file...".format(user_id))
 
-        with open(self.user_details_folder_path + '/' + str(user_id) +
-                  '.json', 'w') as fw:
-            json.dump(user_obj._json, fw)
+        self._write_details(TaskType.user_details, user_id, user_obj._json)
         return user_obj
 
-    def get_tweet_details(self, tweet_ids):
-        for tweet_id in tweet_ids:
-            if not os.path.exists(self.tweet_details_folder_path +
-                                  str(tweet_id) + '.json') \
-                    and tweet_id not in \
-                    self.tasks_pending_dict[TaskType.tweet_details]:
-                self.tasks_pending_dict[TaskType.tweet_details].add(tweet_id)
-                self.tasks_pending.put((tweet_id, TaskType.tweet_details))
-
-    def get_retweets(self, tweet_ids):
-        for tweet_id in tweet_ids:
-            if not os.path.exists(self.retweets_folder_path +
-                                  str(tweet_id) + ".json") \
-                    and tweet_id not in \
-                    self.tasks_pending_dict[TaskType.retweets]:
-                self.tasks_pending_dict[TaskType.retweets].add(tweet_id)
-                self.tasks_pending.put((tweet_id, TaskType.retweets))
-
-    def get_followers(self, user_ids):
-        for user_id in user_ids:
-            if not os.path.exists(self.follower_folder_path +
-                                  str(user_id) + ".json") \
-                    and user_id not in \
-                    self.tasks_pending_dict[TaskType.followers]:
-                self.tasks_pending_dict[TaskType.followers].add(user_id)
-                self.tasks_pending.put((user_id, TaskType.followers))
-
-    def get_followees(self, user_ids):
-        for user_id in user_ids:
-            if not os.path.exists(self.followee_folder_path +
-                                  str(user_id) + ".json") \
-                    and user_id not in \
-                    self.tasks_pending_dict[TaskType.followees]:
-                self.tasks_pending_dict[TaskType.followees].add(user_id)
-                self.tasks_pending.put((user_id, TaskType.followees))
-
-    def get_timelines(self, user_ids):
-        for user_id in user_ids:
-            if not os.path.exists(self.timeline_folder_path +
-                                  str(user_id) + ".json") \
-                    and user_id not in \
-                    self.tasks_pending_dict[TaskType.timeline]:
-                self.tasks_pending_dict[TaskType.timeline].add(user_id)
-                self.tasks_pending.put((user_id, TaskType.timeline))
-
-    def get_user_details(self, user_ids):
-        for user_id in user_ids:
-            if not os.path.exists(self.user_details_folder_path +
-                                  str(user_id) + '.json') \
-                    and user_id not in \
-                    self.tasks_pending_dict[TaskType.user_details]:
-                self.tasks_pending_dict[TaskType.user_details].add(user_id)
-                self.tasks_pending.put((user_id, TaskType.user_details))
+    def _lookup_user_details(self, user_ids, api):
+        self._log("Looking up details of {} users".format(len(user_ids)))
+
+        user_jsons = self.user_cache.lookup(user_ids)
+        users = [tweepy.models.User.parse(api, user_json)
+                 for user_json in user_jsons if user_json is not None]
+        uncached_ids = [user_id for user_id, user_json
+                        in zip(user_ids, user_jsons) if user_json is None]
+        if uncached_ids:
+            users.extend(self._lookup_users(uncached_ids, api))
+
+        found_ids = set()
+        for user_obj in users:
+            found_ids.add(user_obj.id_str)
+            found_ids.add(user_obj.screen_name.lower())
+
+            if self._is_complete(TaskType.user_details, user_obj.id_str):
+                self._log("Already fetched user details for user {}".format(
+                        user_obj.id_str))
+                continue
 
-    def get_all_followers(self, user_id):
+            self._log("Writing the user object of {} to file...".format(
+                    user_obj.id_str))
+
+            self._write_details(TaskType.user_details, user_obj.id_str,
+                                user_obj._json)
+
+        missing_ids = [user_id for user_id in user_ids
+                       if str(user_id).lower() not in found_ids]
+        self._record_failed_lookups(missing_ids, TaskType.user_details)
+        return users
+
+    def _write_details(self, task_type, object_id, obj_json):
+        """
+        Writes the tweet_details or user_details of an object. With
+        change_detection set, only the fields which changed since the latest
+        version of the object are written, as a delta, and nothing is
+        written if none did.
+        """
+        if not self.change_detection:
+            write_json_atomic(self._output_path(task_type, object_id,
+                                                '.json'), obj_json)
+            return
+
+        kind = task_type.name
+        entry, changed, removed, fingerprints = self.fingerprints.diff(
+            kind, object_id, obj_json)
+        recorder = current_recorder()
+        if entry is None:
+            write_json_atomic(self._output_path(task_type, object_id,
+                                                '.json'), obj_json)
+        elif entry['run'] == self.current_run:
+            # Already written by an earlier session of this run
+            return
+        elif not changed and not removed:
+            if recorder is not None:
+                recorder.count('details_unchanged_total', task_type=kind)
+            return
+        else:
+            write_json_atomic(
+                self._output_path(task_type, object_id, DETAILS_DELTA_EXT),
+                {'id_str': str(object_id), 'run': self.current_run,
+                 'previous_run': entry['run'], 'changed': changed,
+                 'removed': removed})
+        if recorder is not None:
+            recorder.count('details_changed_total', task_type=kind)
+        self.fingerprints.save(kind, object_id, self.current_run, obj_json,
+                               fingerprints)
+
+    def get_tweet_authors(self, tweet_ids):
+        """
+        Returns the (tweet id, author id) of the tweets whose details were
+        fetched in the current run. With change_detection set, the tweets
+        among tweet_ids which were fetched but did not change have no file
+        in the run, and their author is taken from the fingerprints index.
+        """
+        authors = {record['id_str']: record['user.id_str'] for record in
+                   self.reader().records('tweet_details',
+                                         ['id_str', 'user.id_str'])}
+        if self.change_detection:
+            for tweet_id in map(str, tweet_ids):
+                if tweet_id in authors or self.task_registry.state(
+                        TaskType.tweet_details, tweet_id) != TaskState.done:
+                    continue
+                entry = self.fingerprints.load('tweet_details', tweet_id)
+                if entry is not None:
+                    authors[tweet_id] = entry['values']['user.id_str']
+        return list(authors.items())
+
+    def changed_since(self, run, task_type=TaskType.user_details):
+        """
+        Returns the ids of the users (or tweets, for tweet_details) which
+        were fetched for the first time or changed in a run after the given
+        run, from the full and delta files of those runs. This requires
+        change_detection, as every object fetched is written otherwise. The
+        runs compacted into the baseline are answered from the fingerprints
+        index, which only knows the run of the latest change of each object.
+        """
+        folder_name, exts = OUTPUT_FOLDERS[task_type]
+        object_ids = set()
+        if self.compacted_through is not None and \
+                run < self.compacted_through:
+            object_ids.update(self.fingerprints.changed_since(task_type.name,
+                                                              run))
+        for time_folder in self.run_folders:
+            if time_folder > run:
+                object_ids.update(object_id for object_id, _ in OutputFolder(
+                    self.base_folder_path + time_folder + '/twitter/' +
+                    folder_name).files(exts))
+        return object_ids
+
+    def _check_accessible(self, user_obj):
+        """
+        Raises a PermanentTaskError for a protected user whose followers,
+        followees and timeline cannot be fetched.
+        """
+        if getattr(user_obj, 'protected', False) and \
+                not getattr(user_obj, 'following', False):
+            raise PermanentTaskError(
+                "User {} is protected".format(user_obj.id_str))
+
+    def _get_user_obj(self, user_id, api):
+        """
+        Returns the user object of a user id or screen name from the shared
+        user_cache, falling back to a users/show call on a cache miss.
         """
-        Parses through the already fetched followers at previous timesteps
-        to find the complete list of followers of a user.
+        user_json = self.user_cache.get(user_id)
+        if user_json is not None:
+            return tweepy.models.User.parse(api, user_json)
+
+        user_obj = api.get_user(user_id)
+        self.user_cache.put(user_obj._json)
+        return user_obj
+
+    def prefetch_users(self, user_ids, apis):
         """
-        all_followers = set()
+        Fills the user_cache in bulk through users/lookup for the user ids
+        and screen names that are not cached yet. The lookups are spread
+        across the given API objects in a round-robin manner.
+        """
+        uncached_ids = self.user_cache.missing(dict.fromkeys(user_ids))
+        keyed_apis = self._keyed_apis(apis)
+        if not uncached_ids or not keyed_apis:
+            return
+
+        self._log("Prefetching {} user objects".format(len(uncached_ids)))
+
+        recorder = MetricsRecorder(self.metrics)
+        set_recorder(recorder)
+        for batch_idx, idx in enumerate(
+                range(0, len(uncached_ids), LOOKUP_BATCH_SIZE)):
+            batch = uncached_ids[idx:idx + LOOKUP_BATCH_SIZE]
+            key_idx, api = keyed_apis[batch_idx % len(keyed_apis)]
+            instrumented_api = InstrumentedAPI(api, key_idx)
+            try:
+                self._lookup_users(batch, instrumented_api)
+            except Exception as e:
+                print("Error while prefetching user objects: " + str(e))
+                if classify_error(e) == ErrorKind.key:
+                    self._quarantine_key(key_idx, error_description(e))
+                    keyed_apis = self._keyed_apis(apis)
+                    if not keyed_apis:
+                        break
+            finally:
+                if instrumented_api.num_calls > 0:
+                    self.rate_limits.update_from_response(
+                        key_idx, getattr(api, 'last_response', None))
+        set_recorder(None)
+        recorder.flush()
+
+    def _lookup_users(self, user_ids, api):
+        """
+        Fetches up to LOOKUP_BATCH_SIZE users with a single users/lookup call
+        and adds them to the user_cache.
+        """
+        # users/lookup takes numeric ids and screen names separately
+        users = api.lookup_users(
+            user_ids=[user_id for user_id in user_ids
+                      if str(user_id).isdigit()] or None,
+            screen_names=[user_id for user_id in user_ids
+                          if not str(user_id).isdigit()] or None)
+        self.user_cache.put_many([user_obj._json for user_obj in users])
+        return users
+
+    def _record_failed_lookups(self, object_ids, task_type):
+        """
+        Dead-letters the ids which were not returned by a batched lookup
+        (deleted, suspended or protected objects).
+        """
+        if not object_ids:
+            return
 
-        time_folder_list = sorted(os.listdir(self.base_folder_path),
-                                  reverse=True)
+        self._log("Lookup failed for {} ids of {}".format(
+                len(object_ids), str(task_type)))
+        self._record_dead_letters(object_ids, task_type,
+                                  'not returned by lookup')
 
-        for time_folder in time_folder_list:
-            if '.txt' in time_folder:
+    def _record_dead_letters(self, object_ids, task_type, reason):
+        """
+        Appends tasks which failed permanently to the dead letters of this
+        run, so that they are not enqueued again in this or later runs. The
+        tasks are keyed by the id_str of their object (see _id_strs), so
+        that a user is dead-lettered whether it is given by screen name or
+        by id.
+        """
+        self._log("\nDead-lettering " + str(task_type) + " for " +
+                  str(len(object_ids)) + " ids - " + reason + '\n')
+        id_strs = self._id_strs(task_type, object_ids)
+        with open(self.dead_letters_file_path, 'a+') as fw:
+            for id_str in id_strs:
+                fw.write(task_type.name + '\t' + id_str + '\t' + reason +
+                         '\n')
+        self.task_registry.dead_letter(
+            task_type, list(dict.fromkeys(
+                [str(object_id) for object_id in object_ids] + id_strs)))
+
+    def _id_strs(self, task_type, object_ids):
+        """
+        Returns the id_str of the object of each of the given tasks. The
+        screen names of the users are resolved through the user_cache, and
+        are kept as they are if the user is not cached.
+        """
+        object_ids = [str(object_id) for object_id in object_ids]
+        if task_type not in USER_TASK_TYPES and \
+                task_type != TaskType.user_details:
+            return object_ids
+        screen_names = [object_id for object_id in object_ids
+                        if not object_id.isdigit()]
+        if not screen_names:
+            return object_ids
+        users = dict(zip(screen_names, self.user_cache.lookup(screen_names)))
+        return [users[object_id]['id_str']
+                if users.get(object_id) is not None else object_id
+                for object_id in object_ids]
+
+    def load_dead_letters(self):
+        """
+        Returns the (task type name, object id) of the tasks dead-lettered
+        in all the runs in the base folder, including the compacted ones.
+        """
+        dead_letters = set()
+        for path in [self.base_folder_path + BASELINE_FOLDER +
+                     'dead_letters.txt'] + \
+                [self.base_folder_path + folder + '/twitter/' +
+                 'dead_letters.txt' for folder in self.run_folders]:
+            if not os.path.exists(path):
                 continue
-            followers_folder = self.base_folder_path + time_folder + \
-                '/twitter/followers/'
-            followers_file = followers_folder + str(user_id) + '.json'
-            if os.path.exists(followers_file):
-                print("Existing file found for user" + str(user_id) +
-                      "in folder " + str(time_folder))
-                with open(followers_file) as f:
-                    data = json.load(f)
-                    all_followers.update(data['followers_added'])
-                    for item in data['followers_subtracted']:
-                        if item in all_followers:
-                            all_followers.remove(item)
-
-        return all_followers
+            with open(path) as f:
+                for line in f:
+                    fields = line.rstrip('\n').split('\t')
+                    if len(fields) >= 2:
+                        dead_letters.add((fields[0], fields[1]))
+        return dead_letters
+
+    def _is_complete(self, task_type, object_id):
+        """
+        Returns whether the output file of a task exists, from the index of
+        its output folder. Output files are renamed into place once
+        complete, so they are never partial.
+        """
+        if task_type not in OUTPUT_FOLDERS:
+            return False
+        return self.output_folders[task_type].contains(
+            object_id, OUTPUT_FOLDERS[task_type][1])
+
+    def _output_path(self, task_type, object_id, ext):
+        """
+        Returns the path to write the output file of a task to.
+        """
+        return self.output_folders[task_type].path(object_id, ext)
+
+    def _stage_tasks(self, object_ids, task_type, priority=0):
+        """
+        Stages a task for each of the given ids, unless it is already
+        queued, in flight or done in this run, was dead-lettered in any run,
+        or its output file exists.
+
+        The priority is either a number, which applies to all the tasks, or
+        a dict mapping object ids to numbers. Tasks with a higher priority
+        are executed first, and the default priority is 0.
+        """
+        for object_id in self._register_tasks(object_ids, task_type):
+            self.tasks_staged.append((object_id, task_type))
+            task_priority = priority.get(object_id, 0) \
+                if isinstance(priority, dict) else priority
+            if task_priority:
+                self.task_priorities[(task_type, str(object_id))] = \
+                    task_priority
+
+    def _register_tasks(self, object_ids, task_type):
+        """
+        Marks the tasks of the given ids as queued in the task_registry,
+        unless they are already tracked, were dead-lettered in any run, their
+        output file exists, or their user is ignored. Returns the ids of the
+        tasks registered.
+        """
+        if task_type in USER_TASK_TYPES:
+            object_ids = self._filter_users(object_ids, task_type)
+        object_ids = self.task_registry.untracked(task_type, object_ids)
+        id_strs = self._id_strs(task_type, object_ids)
+        object_ids = [
+            object_id for object_id, id_str, state in zip(
+                object_ids, id_strs,
+                self.task_registry.state_many(task_type, id_strs))
+            if (task_type.name, id_str) not in self.dead_letters and
+            state != TaskState.dead_letter and
+            not self._is_complete(task_type, object_id)]
+        return self.task_registry.add(task_type, object_ids)
+
+    def resume(self):
+        """
+        Stages the tasks which were queued or in flight when a previous
+        session on the same run folder stopped, and returns their number.
+        Tasks whose output file was written before the interruption are
+        marked as done instead.
+        """
+        completed = defaultdict(list)
+        num_staged = 0
+        for task_type_name, object_id in self.task_registry.queued():
+            task_type = TaskType[task_type_name]
+            if self._is_complete(task_type, object_id):
+                completed[task_type].append(object_id)
+            else:
+                self.tasks_staged.append((object_id, task_type))
+                num_staged += 1
+
+        for task_type, object_ids in completed.items():
+            self.task_registry.mark_done(task_type, object_ids)
+        self._log("Resuming {} unfinished tasks".format(num_staged))
+        return num_staged
+
+    def get_tweet_details(self, tweet_ids, priority=0):
+        self._stage_tasks(tweet_ids, TaskType.tweet_details, priority)
+
+    def get_retweets(self, tweet_ids, priority=0):
+        self._stage_tasks(tweet_ids, TaskType.retweets, priority)
+
+    def get_followers(self, user_ids, priority=0):
+        self._stage_tasks(user_ids, TaskType.followers, priority)
+
+    def get_followees(self, user_ids, priority=0):
+        self._stage_tasks(user_ids, TaskType.followees, priority)
+
+    def get_timelines(self, user_ids, priority=0):
+        self._stage_tasks(user_ids, TaskType.timeline, priority)
+
+    def get_user_details(self, user_ids, priority=0):
+        self._stage_tasks(user_ids, TaskType.user_details, priority)
+
+    def list_run_folders(self):
+        """
+        Returns the names of the timestamp folders of the runs in the base
+        folder which were not compacted into the baseline, oldest first.
+        """
+        return sorted(
+            folder for folder in os.listdir(self.base_folder_path)
+            if os.path.isdir(self.base_folder_path + folder + '/twitter') and
+            (self.compacted_through is None or
+             folder > self.compacted_through))
+
+    def reader(self, runs=None):
+        """
+        Returns an OutputReader over the given runs of the base folder, or
+        over the current run.
+        """
+        return OutputReader(self.base_folder_path,
+                            runs=runs or [self.current_run])
+
+    def crawl_followers(self, seed_ids, apis, depth=2, chunk_size=10000):
+        """
+        Fetches the followers of the given users up to depth hops away, and
+        returns the compact id set of all the users reached. See
+        FollowerCrawl.
+        """
+        return FollowerCrawl(self, TaskType.followers, seed_ids,
+                             depth=depth, chunk_size=chunk_size).run(apis)
+
+    def get_all_followers(self, user_id):
+        """
+        Finds the complete list of followers of a user from their latest
+        snapshot, replaying the deltas of any later runs on top of it.
+        """
+        return self._get_all_ids('followers', user_id)
 
     def get_all_followees(self, user_id):
         """
-        Parses through the already fetched followees at previous timesteps
-        to find the complete list of followees of a user.
+        Finds the complete list of followees of a user from their latest
+        snapshot, replaying the deltas of any later runs on top of it.
         """
-        all_followees = set()
+        return self._get_all_ids('followees', user_id)
 
-        time_folder_list = sorted(os.listdir(self.base_folder_path),
-                                  reverse=True)
+    def _get_all_ids(self, kind, user_id):
+        snapshot_run, all_ids = self.snapshots.load(kind, user_id)
 
-        for time_folder in time_folder_list:
-            if '.txt' in time_folder:
+        # Deltas are replayed in chronological order. Users without a
+        # snapshot have their whole history replayed once, and get a
+        # snapshot when their next delta is written.
+        for time_folder in self.run_folders:
+            if snapshot_run is not None and time_folder <= snapshot_run:
+                continue
+            data = load_delta(self.base_folder_path + time_folder +
+                              '/twitter/' + kind + '/', user_id,
+                              self.shard_output)
+            if data is None:
                 continue
-            followees_folder = self.base_folder_path + time_folder + \
-                '/twitter/followees/'
-            followees_file = followees_folder + str(user_id) + '.json'
-            if os.path.exists(followees_file):
-                print("Existing file found for user" + str(user_id) +
-                      "in folder " + str(time_folder))
-                with open(followees_file) as f:
-                    data = json.load(f)
-                    all_followees.update(data['followees_added'])
-                    for item in data['followees_subtracted']:
-                        if item in all_followees:
-                            all_followees.remove(item)
-
-        return all_followees
+            self._log("Existing file found for user " + str(user_id) +
+                      " in folder " + str(time_folder))
+            all_ids = apply_delta(all_ids, data[kind + '_added'],
+                                  data[kind + '_subtracted'])
+
+        return all_ids
 
     def get_last_tweet_id(self, user_id):
         """
-        Parses through the already fetched timelines at previous timesteps
-        to find the last tweet_id fetched from a user's timeline.
+        Finds the last tweet_id fetched from a user's timeline from the
+        last_tweet_index. Only the timeline files of runs newer than the
+        indexed one (e.g. a run which crashed before updating the index) are
+        checked, and the index is repaired from them. The last tweet_id never
+        moves back to an older tweet.
         """
-        time_folder_list = sorted(os.listdir(self.base_folder_path),
-                                  reverse=True)
+        indexed_run, last_tweet_id = self.last_tweet_index.load(user_id)
 
-        for time_folder in time_folder_list:
-            if '.txt' in time_folder:
-                continue
-            timelines_folder = self.base_folder_path + time_folder + \
-                '/twitter/timelines/'
-            timelines_file = timelines_folder + str(user_id) + '.json'
-            if os.path.exists(timelines_file):
-                print("Timeline file found for user" + str(user_id) +
-                      "in folder " + str(time_folder))
-                with open(timelines_file) as f:
-                    data = json.load(f)
-                    last_tweet = json.loads(data[0])
-                    last_tweet_id = int(last_tweet["id"])
-                    return last_tweet_id
-
-        return -1
-
-    def add_user_to_ignore_list(self, user_obj):
+        for time_folder in reversed(self.run_folders):
+            if indexed_run is not None and time_folder <= indexed_run:
+                break
+            timelines_file = find_tweet_file(
+                self.base_folder_path + time_folder + '/twitter/timelines/',
+                user_id)
+            if timelines_file is not None:
+                self._log("Timeline file found for user " + str(user_id) +
+                          " in folder " + str(time_folder))
+                last_tweet = next(read_tweets(timelines_file))
+                last_tweet_id = max(int(last_tweet["id"]),
+                                    int(last_tweet_id))
+                self.last_tweet_index.save(user_id, time_folder,
+                                           last_tweet_id)
+                return last_tweet_id
+
+        return last_tweet_id
+
+    def add_user_to_ignore_list(self, user_obj, task_type=None):
         """
         An user-level ignore list is maintined so that celebrity like users
         are not processed, thereby avoiding exceedance of Twitter API rate
-        limits quickly.
+        limits quickly. Returns whether the task of the given type should be
+        skipped for the user.
         """
-        if not self.ignore_list:
+        if not self.should_skip_user(user_obj._json, task_type):
             return False
+        self._log("IgnoreList: User {} is above the thresholds of {} "
+                  "tasks, ignoring.".format(
+                      user_obj.id_str, getattr(task_type, 'name', 'all')))
+        return True
+
+    def exceeds_follow_count(self, user_json):
+        """
+        Returns whether a user, given as JSON, has more followers or
+        followees than the ignore list allows.
+        """
+        return self.ignore_list and \
+            (user_json['followers_count'] > self.max_follow_count or
+             user_json['friends_count'] > self.max_follow_count)
+
+    def exceeds_threshold(self, user_json, task_type):
+        """
+        Returns whether a user, given as JSON, is above the ignore_thresholds
+        of the task type, or has more followers or followees than the
+        ignore list allows when no task type is given.
+        """
+        if task_type is None:
+            return self.exceeds_follow_count(user_json)
+        return self.ignore_list and any(
+            user_json.get(field, 0) > threshold for field, threshold
+            in self.ignore_thresholds.get(task_type, {}).items())
 
-        if user_obj.followers_count > 20000 or user_obj.friends_count > 20000:
-            print("IgnoreList: The user has more than 20000 " +
-                  "followers/followees, ignoring.")
-            with open(self.base_folder_path +
-                      'user_ignore_list.txt', 'a+') as fw:
-                fw.write(str(user_obj.id_str) + '\n')
+    def should_skip_user(self, user_json, task_type=None):
+        """
+        Returns whether the task of the given type should be skipped for a
+        user given as JSON, adding the user to the ignore list if they have
+        more followers or followees than it allows. Users which are not
+        cached (None) are not skipped.
+        """
+        if user_json is None:
+            return False
+        if self.exceeds_follow_count(user_json):
+            self.extend_user_ignore_list([user_json['id_str']])
             return True
-        return False
+        return self.exceeds_threshold(user_json, task_type)
+
+    def extend_user_ignore_list(self, user_ids):
+        """
+        Adds the given user ids to the shared user ignore list, which
+        appends the ones it did not contain yet to the user_ignore_list.txt
+        file of the base folder.
+        """
+        if user_ids:
+            self.user_ignore_list.add(user_ids)
@@ -0,0 +1,253 @@
+from multiprocessing.managers import SyncManager
+from ignore_list import IgnoreList
+from key_pool import KeyHealth
+from metrics import MetricsStore
+from task_registry import DurableTaskRegistry, TaskRegistry
+from user_cache import UserCache
+import heapq
+import itertools
+import threading
+import queue
+import time
+
+
+class TaskQueue:
+    """
+    A priority queue of tasks partitioned by the API endpoint each task
+    calls.
+
+    The queue lives in a manager process and is shared by all the worker
+    processes through a proxy. A worker can exclude the endpoints its API key
+    has no budget left for, in which case it is handed the next task among
+    the remaining endpoints. Tasks put without an endpoint (such as the
+    shutdown sentinels) can be taken by any worker.
+
+    Tasks are handed out by decreasing priority, then by decreasing
+    estimated cost, so that the longest tasks are started first and do not
+    hold up the end of a phase, and then in FIFO order.
+
+    A task can also be put with a delay, e.g. to retry it with backoff, in
+    which case it is only handed out once the delay has passed. A delayed
+    task can avoid the key of the worker it failed on: that worker is only
+    handed the task if no other worker has taken it after twice the delay.
+
+    Like multiprocessing.JoinableQueue, every get must be followed by a call
+    to task_done, and join blocks until all the tasks put are done. The
+    task handed out to each key is kept until its task_done, so that the
+    task of a worker which died can be abandoned.
+
+    The time each task waits in the queue, from the time it is put (or its
+    delay passes) to the time it is handed out, is summarized per endpoint
+    in wait_stats.
+    """
+
+    def __init__(self):
+        self.queues = {}
+        self.delayed = []
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+        self.num_queued = 0
+        self.unfinished_tasks = 0
+        self.in_progress = {}
+        self.wait_stats = {}
+
+    def put(self, task, endpoint=None, delay=0, avoid_key=None, priority=0,
+            cost=0):
+        with self.condition:
+            if delay > 0:
+                now = time.time()
+                self.delayed.append((now + delay, now + 2 * delay, avoid_key,
+                                     next(self.counter), endpoint, task))
+            else:
+                heapq.heappush(self.queues.setdefault(endpoint, []),
+                               (-priority, -cost, next(self.counter), task,
+                                time.time()))
+            self.num_queued += 1
+            self.unfinished_tasks += 1
+            self.condition.notify_all()
+
+    def put_many(self, entries):
+        """
+        Puts a list of (task, endpoint, priority, cost) entries without
+        delay, in a single call.
+        """
+        with self.condition:
+            now = time.time()
+            for task, endpoint, priority, cost in entries:
+                heapq.heappush(self.queues.setdefault(endpoint, []),
+                               (-priority, -cost, next(self.counter), task,
+                                now))
+            self.num_queued += len(entries)
+            self.unfinished_tasks += len(entries)
+            self.condition.notify_all()
+
+    def get(self, excluded_endpoints=(), timeout=None, key=None):
+        """
+        Removes and returns the next task whose endpoint is not excluded,
+        blocking for up to timeout seconds. Delayed tasks which are due are
+        handed out first. Raises queue.Empty if no such task becomes
+        available in time.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self.condition:
+            while True:
+                entry, next_due = self._next_delayed(excluded_endpoints, key)
+                if entry is not None:
+                    self.num_queued -= 1
+                    self._record_wait(entry[4], entry[0])
+                    return self._hand_out(entry[5], key)
+
+                endpoint, rank = self._next_endpoint(excluded_endpoints)
+                if rank is not None:
+                    task_queue = self.queues[endpoint]
+                    _, _, _, task, put_time = heapq.heappop(task_queue)
+                    if not task_queue:
+                        del self.queues[endpoint]
+                    self.num_queued -= 1
+                    self._record_wait(endpoint, put_time)
+                    return self._hand_out(task, key)
+
+                wait_time = None
+                if deadline is not None:
+                    wait_time = deadline - time.time()
+                    if wait_time <= 0:
+                        raise queue.Empty
+                if next_due is not None:
+                    due_in = max(next_due - time.time(), 0.01)
+                    wait_time = due_in if wait_time is None else \
+                        min(wait_time, due_in)
+                self.condition.wait(wait_time)
+
+    def _hand_out(self, task, key):
+        if key is not None:
+            self.in_progress[key] = task
+        return task
+
+    def _next_delayed(self, excluded_endpoints, key):
+        """
+        Removes and returns the entry of the oldest delayed task which is
+        due for the given key, along with the time at which the next delayed
+        task becomes due for it.
+        """
+        now = time.time()
+        next_idx = None
+        next_due = None
+        for idx, entry in enumerate(self.delayed):
+            due, avoid_due, avoid_key, seq, endpoint, task = entry
+            if endpoint is not None and endpoint in excluded_endpoints:
+                continue
+            if key is not None and key == avoid_key:
+                due = avoid_due
+            if due <= now:
+                if next_idx is None or seq < self.delayed[next_idx][3]:
+                    next_idx = idx
+            elif next_due is None or due < next_due:
+                next_due = due
+
+        if next_idx is None:
+            return None, next_due
+        return self.delayed.pop(next_idx), next_due
+
+    def _record_wait(self, endpoint, since):
+        if endpoint is None:
+            return
+        wait = max(time.time() - since, 0)
+        stats = self.wait_stats.setdefault(endpoint, [0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += wait
+        stats[2] = max(stats[2], wait)
+
+    def get_wait_stats(self):
+        """
+        Returns the (endpoint, count, sum, max) summary of the time tasks
+        waited in the queue for each endpoint.
+        """
+        with self.condition:
+            return [(endpoint,) + tuple(stats)
+                    for endpoint, stats in self.wait_stats.items()]
+
+    def _next_endpoint(self, excluded_endpoints):
+        next_endpoint = None
+        next_rank = None
+        for endpoint, task_queue in self.queues.items():
+            if endpoint is not None and endpoint in excluded_endpoints:
+                continue
+            rank = task_queue[0][:3]
+            if next_rank is None or rank < next_rank:
+                next_endpoint, next_rank = endpoint, rank
+        return next_endpoint, next_rank
+
+    def task_done(self, key=None):
+        with self.condition:
+            self.in_progress.pop(key, None)
+            self.unfinished_tasks -= 1
+            if self.unfinished_tasks <= 0:
+                self.condition.notify_all()
+
+    def abandon(self, key):
+        """
+        Returns the task handed out to a key whose worker died before
+        calling task_done, if any, and counts it as done.
+        """
+        with self.condition:
+            if key not in self.in_progress:
+                return None
+            task = self.in_progress.pop(key)
+            self.unfinished_tasks -= 1
+            if self.unfinished_tasks <= 0:
+                self.condition.notify_all()
+            return task
+
+    def join(self, timeout=None):
+        """
+        Blocks until all the tasks put are done, or for up to timeout
+        seconds. Returns whether they are all done.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self.condition:
+            while self.unfinished_tasks > 0:
+                wait_time = None
+                if deadline is not None:
+                    wait_time = deadline - time.time()
+                    if wait_time <= 0:
+                        return False
+                self.condition.wait(wait_time)
+            return True
+
+    def drain(self):
+        """
+        Removes all the queued tasks, including the delayed ones, and
+        returns them. They no longer count as unfinished.
+        """
+        with self.condition:
+            tasks = [entry[3] for task_queue in self.queues.values()
+                     for entry in task_queue] + \
+                [entry[5] for entry in self.delayed]
+            self.queues = {}
+            self.delayed = []
+            self.num_queued -= len(tasks)
+            self.unfinished_tasks -= len(tasks)
+            self.condition.notify_all()
+            return tasks
+
+    def qsize(self):
+        return self.num_queued
+
+
+class TaskQueueManager(SyncManager):
+    """
+    A SyncManager which can also host a shared TaskQueue, TaskRegistry,
+    MetricsStore, IgnoreList, KeyHealth and UserCache.
+    """
+    pass
+
+
+TaskQueueManager.register('TaskQueue', TaskQueue)
+TaskQueueManager.register('TaskRegistry', TaskRegistry)
+TaskQueueManager.register('DurableTaskRegistry', DurableTaskRegistry)
+TaskQueueManager.register('MetricsStore', MetricsStore)
+TaskQueueManager.register('KeyHealth', KeyHealth)
+TaskQueueManager.register('UserCache', UserCache)
+TaskQueueManager.register('IgnoreList', IgnoreList,
+                          exposed=('__contains__', '__len__', 'filter',
+                                   'exclude', 'add'))
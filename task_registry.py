@@ -0,0 +1,265 @@
+from enum import Enum
+import sqlite3
+import threading
+import time
+
+
+class TaskState(Enum):
+    """
+    The states a task goes through in the TaskRegistry.
+    """
+    queued = 0
+    in_flight = 1
+    done = 2
+    failed = 3
+    dead_letter = 4
+
+
+# Tasks in these states are not enqueued again. Failed tasks can be retried
+# by enqueueing them again, while dead-lettered tasks failed permanently.
+TRACKED_STATES = (TaskState.queued, TaskState.in_flight, TaskState.done,
+                  TaskState.dead_letter)
+
+
+class TaskRegistry:
+    """
+    Tracks the state of every task of a TaskManager, keyed by its task type
+    and object id.
+
+    The registry lives in a manager process and is shared by the parent and
+    all the workers through a proxy, so that every one of them sees which
+    tasks are queued, in flight, done, failed or dead-lettered. Object ids
+    are compared as strings, so the same user or tweet is deduplicated
+    whether its id was given as an int or a str. Every method handles a
+    list of ids at once, to keep the number of round trips to the manager
+    low.
+
+    The number of failed attempts of each task, whether it was failed or
+    retried after them, is counted, and failed tasks are not enqueued again
+    once they reach max_retries.
+    """
+
+    def __init__(self, max_retries=None):
+        self.max_retries = max_retries
+        self.states = {}
+        self.retries = {}
+        self.num_tasks = dict.fromkeys(TaskState, 0)
+        self.lock = threading.Lock()
+        self.changed_keys = []
+
+    def _key(self, task_type, object_id):
+        return task_type.name, str(object_id)
+
+    def _transition(self, key, state, failed_attempt=False):
+        previous_state = self.states.get(key)
+        if previous_state is not None:
+            self.num_tasks[previous_state] -= 1
+        self.states[key] = state
+        self.num_tasks[state] += 1
+        if failed_attempt:
+            self.retries[key] = self.retries.get(key, 0) + 1
+        self.changed_keys.append(key)
+
+    def _flush(self):
+        """
+        Called with the lock held after every change of state. The changed
+        keys are in changed_keys.
+        """
+        self.changed_keys = []
+
+    def _is_tracked(self, key):
+        state = self.states.get(key)
+        if state in TRACKED_STATES:
+            return True
+        return state == TaskState.failed and self.max_retries is not None \
+            and self.retries.get(key, 0) >= self.max_retries
+
+    def untracked(self, task_type, object_ids):
+        """
+        Returns the ids of the given tasks which are not queued, in flight,
+        done or dead-lettered, and have not run out of retries.
+        """
+        with self.lock:
+            return [object_id for object_id in object_ids
+                    if not self._is_tracked(self._key(task_type, object_id))]
+
+    def add(self, task_type, object_ids):
+        """
+        Marks the given tasks as queued, unless they are already queued, in
+        flight, done or dead-lettered, or have run out of retries. Returns
+        the ids of the tasks which were added.
+        """
+        added = []
+        with self.lock:
+            for object_id in object_ids:
+                key = self._key(task_type, object_id)
+                if not self._is_tracked(key):
+                    self._transition(key, TaskState.queued)
+                    added.append(object_id)
+            self._flush()
+        return added
+
+    def _set_state(self, task_type, object_ids, state, from_state=None,
+                   failed_attempt=False):
+        with self.lock:
+            for object_id in object_ids:
+                key = self._key(task_type, object_id)
+                if from_state is None or self.states.get(key) == from_state:
+                    self._transition(key, state, failed_attempt)
+            self._flush()
+
+    def start(self, task_type, object_ids):
+        self._set_state(task_type, object_ids, TaskState.in_flight)
+
+    def requeue(self, task_type, object_ids):
+        self._set_state(task_type, object_ids, TaskState.queued)
+
+    def finish(self, task_type, object_ids):
+        """
+        Marks the given in flight tasks as done. Tasks which were already
+        marked as failed while in flight are left as they are.
+        """
+        self._set_state(task_type, object_ids, TaskState.done,
+                        from_state=TaskState.in_flight)
+
+    def fail(self, task_type, object_ids):
+        self._set_state(task_type, object_ids, TaskState.failed,
+                        failed_attempt=True)
+
+    def abandon(self, task_type, object_ids):
+        """
+        Marks the given tasks as failed unless they already ended, e.g. the
+        task of a worker which died while running it.
+        """
+        with self.lock:
+            for object_id in object_ids:
+                key = self._key(task_type, object_id)
+                if self.states.get(key) in (TaskState.queued,
+                                            TaskState.in_flight):
+                    self._transition(key, TaskState.failed,
+                                     failed_attempt=True)
+            self._flush()
+
+    def dead_letter(self, task_type, object_ids):
+        self._set_state(task_type, object_ids, TaskState.dead_letter)
+
+    def retry(self, task_type, object_ids):
+        """
+        Queues the given tasks again after a transient error and counts the
+        retry. Returns the highest number of retries among the tasks, or
+        None if any of them has run out of retries, in which case all of
+        them are marked as failed instead.
+        """
+        with self.lock:
+            keys = [self._key(task_type, object_id)
+                    for object_id in object_ids]
+            num_retries = max(self.retries.get(key, 0) for key in keys) + 1
+            if self.max_retries is not None and \
+                    num_retries > self.max_retries:
+                for key in keys:
+                    self._transition(key, TaskState.failed,
+                                     failed_attempt=True)
+                self._flush()
+                return None
+
+            for key in keys:
+                self._transition(key, TaskState.queued, failed_attempt=True)
+            self._flush()
+        return num_retries
+
+    def mark_done(self, task_type, object_ids):
+        self._set_state(task_type, object_ids, TaskState.done)
+
+    def state(self, task_type, object_id):
+        return self.states.get(self._key(task_type, object_id))
+
+    def state_many(self, task_type, object_ids):
+        """
+        Returns the state of each of the given tasks, None for the tasks
+        which are not tracked.
+        """
+        with self.lock:
+            return [self.states.get(self._key(task_type, object_id))
+                    for object_id in object_ids]
+
+    def queued(self):
+        """
+        Returns the (task type name, object id) of all the queued tasks.
+        """
+        with self.lock:
+            return [key for key, state in self.states.items()
+                    if state == TaskState.queued]
+
+    def counts(self):
+        """
+        Returns the number of tasks in each state, keyed by state name.
+        """
+        with self.lock:
+            return {state.name: num for state, num in self.num_tasks.items()}
+
+    def remaining(self):
+        """
+        Returns the number of tasks which are queued or in flight.
+        """
+        with self.lock:
+            return self.num_tasks[TaskState.queued] + \
+                self.num_tasks[TaskState.in_flight]
+
+
+class DurableTaskRegistry(TaskRegistry):
+    """
+    A TaskRegistry which also stores the state and retry count of every
+    task in an SQLite database, so that an interrupted run can be reopened
+    and continued.
+
+    Every change of state is committed before the call returns. A worker
+    only marks a task as done after its output file has been renamed into
+    place, so a task recorded as done always has a complete output file.
+    When the database is reopened, the tasks which were in flight when the
+    run stopped are queued again, along with the tasks which were queued.
+    """
+
+    def __init__(self, db_path, max_retries=3):
+        super().__init__(max_retries)
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS tasks ("
+            "task_type TEXT NOT NULL, object_id TEXT NOT NULL, "
+            "state INTEGER NOT NULL, retries INTEGER NOT NULL DEFAULT 0, "
+            "updated_at REAL NOT NULL, PRIMARY KEY (task_type, object_id))")
+        self.db.commit()
+
+        with self.lock:
+            for task_type, object_id, state, retries in self.db.execute(
+                    "SELECT task_type, object_id, state, retries "
+                    "FROM tasks"):
+                key = (task_type, object_id)
+                state = TaskState(state)
+                if state == TaskState.in_flight:
+                    self._transition(key, TaskState.queued)
+                else:
+                    self.states[key] = state
+                    self.num_tasks[state] += 1
+                if retries:
+                    self.retries[key] = retries
+            self._flush()
+
+    def _flush(self):
+        if not self.changed_keys:
+            return
+        now = time.time()
+        self.db.executemany(
+            "INSERT OR REPLACE INTO tasks "
+            "(task_type, object_id, state, retries, updated_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            [(key[0], key[1], self.states[key].value,
+              self.retries.get(key, 0), now)
+             for key in dict.fromkeys(self.changed_keys)])
+        self.db.commit()
+        self.changed_keys = []
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,39 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def base_folder(tmp_path):
+    """
+    An empty base folder, as a path ending in a slash like the TaskManager
+    expects.
+    """
+    return str(tmp_path) + '/'
+
+
+@pytest.fixture
+def make_task_manager(base_folder):
+    """
+    Returns a function creating a TaskManager on the given run of the base
+    folder, with workers in threads. The TaskManagers created are closed at
+    the end of the test.
+    """
+    from task_manager import TaskManager
+    task_managers = []
+
+    def make(run='20200101000000', **kwargs):
+        kwargs.setdefault('engine', 'thread')
+        kwargs.setdefault('quiet', True)
+        kwargs.setdefault('metrics_format', None)
+        task_manager = TaskManager(base_folder,
+                                   base_folder + run + '/twitter/', **kwargs)
+        task_managers.append(task_manager)
+        return task_manager
+
+    yield make
+    for task_manager in task_managers:
+        task_manager.close()
@@ -0,0 +1,151 @@
+from backfill import BackfillSource
+from snapshots import CoverageIndex
+from storage import TweetWriter, read_tweets
+from task_manager import TaskType
+import pytest
+
+
+class ListBackfillSource(BackfillSource):
+    """
+    Returns the tweets of a list which fall in the requested range, newest
+    first, down to the oldest reachable tweet id.
+    """
+
+    def __init__(self, tweet_ids, oldest_reachable=0):
+        self.tweet_ids = sorted(tweet_ids, reverse=True)
+        self.oldest_reachable = oldest_reachable
+
+    def fetch_timeline(self, api, screen_name, since_id, max_id):
+        for tweet_id in self.tweet_ids:
+            if since_id <= tweet_id <= max_id and \
+                    tweet_id >= self.oldest_reachable:
+                yield {'id': tweet_id, 'id_str': str(tweet_id)}
+
+
+@pytest.fixture
+def coverage(tmp_path):
+    return CoverageIndex(str(tmp_path) + '/')
+
+
+def test_record_merges_ranges_and_gaps(coverage):
+    coverage.record('timelines', '12', 500, 900, gap=(100, 499), count=10,
+                    screen_name='a')
+    entry = coverage.record('timelines', '12', 901, 1000, gap=(50, 120))
+    assert entry == {'ranges': [[500, 1000]], 'gaps': [[50, 499]],
+                     'unreachable': [], 'count': 10, 'screen_name': 'a'}
+    # Fetches which returned nothing and empty gaps change nothing
+    assert coverage.record('timelines', '12', None, None, gap=(7, 6)) == \
+        entry
+
+
+@pytest.mark.parametrize('low,ranges,unreachable', [
+    (None, [[500, 900]], [[100, 499]]),
+    (300, [[300, 900]], [[100, 299]]),
+    (100, [[100, 900]], []),
+    (50, [[100, 900]], []),
+])
+def test_fill_marks_the_unreached_part_of_a_gap(coverage, low, ranges,
+                                                unreachable):
+    coverage.record('timelines', '12', 500, 900, gap=(100, 499))
+    entry = coverage.fill('timelines', '12', [100, 499], low)
+    assert (entry['ranges'], entry['gaps'], entry['unreachable']) == \
+        (ranges, [], unreachable)
+    assert coverage.load('timelines', '12') == entry
+
+
+def test_unreachable_gaps_are_not_recorded_again(coverage):
+    coverage.record('retweets', '20', 500, 900, gap=(21, 499))
+    coverage.fill('retweets', '20', [21, 499], None)
+    # The next fetch of the retweets misses the same older ones, and a few
+    # more which the previous fetch covered
+    entry = coverage.record('retweets', '20', 600, 950, gap=(21, 599))
+    assert entry['gaps'] == []
+
+
+def write_timeline(task_manager, user_id, tweet_ids):
+    writer = TweetWriter(task_manager._output_path(
+        TaskType.timeline, user_id, task_manager.tweet_file_ext))
+    for tweet_id in sorted(tweet_ids, reverse=True):
+        writer.write({'id': tweet_id, 'id_str': str(tweet_id)})
+    writer.commit()
+
+
+def test_backfill_merges_what_the_source_returns(make_task_manager):
+    task_manager = make_task_manager(
+        backfill_source=ListBackfillSource([150, 300, 400],
+                                           oldest_reachable=200))
+    write_timeline(task_manager, '12', [500, 900])
+    task_manager.coverage.record('timelines', '12', 500, 900,
+                                 gap=(100, 499), screen_name='a')
+
+    task_manager._backfill('12', TaskType.timeline_backfill, None)
+    path = task_manager.output_folders[TaskType.timeline].find(
+        '12', (task_manager.tweet_file_ext,))
+    assert [tweet['id'] for tweet in read_tweets(path)] == \
+        [900, 500, 400, 300]
+    entry = task_manager.coverage.load('timelines', '12')
+    assert entry['ranges'] == [[300, 900]]
+    assert entry['gaps'] == []
+    assert entry['unreachable'] == [[100, 299]]
+
+
+def test_backfill_needs_a_file_of_this_run(make_task_manager):
+    task_manager = make_task_manager(
+        backfill_source=ListBackfillSource([300]))
+    task_manager.coverage.record('timelines', '12', 500, 900,
+                                 gap=(100, 499), screen_name='a')
+
+    task_manager._backfill('12', TaskType.timeline_backfill, None)
+    assert task_manager.output_folders[TaskType.timeline].find(
+        '12', (task_manager.tweet_file_ext,)) is None
+    assert task_manager.coverage.load('timelines', '12')['gaps'] == \
+        [[100, 499]]
+
+
+def test_backfill_is_only_queued_after_a_fetch(make_task_manager):
+    task_manager = make_task_manager(
+        backfill_source=ListBackfillSource([300]))
+    task_manager.coverage.record('timelines', '12', 500, 900,
+                                 gap=(100, 499), screen_name='a')
+
+    task_manager._record_coverage(TaskType.timeline, '12', None, None, None,
+                                  10, 'a')
+    assert task_manager.task_registry.state(
+        TaskType.timeline_backfill, '12') is None
+    task_manager._record_coverage(TaskType.timeline, '12', 901, 950, None,
+                                  12, 'a')
+    assert task_manager.task_registry.state(
+        TaskType.timeline_backfill, '12') is not None
+
+
+def test_failed_backfill_is_not_queued_again(make_task_manager):
+    task_manager = make_task_manager(
+        backfill_source=ListBackfillSource([300], oldest_reachable=400))
+    write_timeline(task_manager, '12', [500, 900])
+    task_manager._record_coverage(TaskType.timeline, '12', 500, 900,
+                                  (100, 499), 10, 'a')
+    task_manager._backfill('12', TaskType.timeline_backfill, None)
+    task_manager.close()
+
+    # The next run fetches newer tweets only
+    task_manager = make_task_manager(
+        '20200102000000',
+        backfill_source=ListBackfillSource([300], oldest_reachable=400))
+    task_manager._record_coverage(TaskType.timeline, '12', 901, 950, None,
+                                  12, 'a')
+    assert task_manager.task_registry.state(
+        TaskType.timeline_backfill, '12') is None
+
+
+def test_since_id_never_moves_back(make_task_manager):
+    task_manager = make_task_manager('20200101000000')
+    task_manager.last_tweet_index.save('12', '20200101000000', 900)
+    task_manager.close()
+
+    # A file of a later run which only holds older tweets
+    task_manager = make_task_manager('20200102000000')
+    write_timeline(task_manager, '12', [300])
+    task_manager.close()
+
+    task_manager = make_task_manager('20200103000000')
+    assert task_manager.get_last_tweet_id('12') == 900
@@ -0,0 +1,104 @@
+from benchmarks.fake_api import FakeResponse, FakeTwitter
+from id_sets import compact_ids
+from task_manager import TaskType
+from task_registry import TaskState
+from tweepy import TweepError
+import os
+import pytest
+
+
+def recording_ids(method, fail_after=None):
+    """
+    Wraps followers_ids, recording the cursor of each call and failing the
+    call after the first fail_after ones with a transient error.
+    """
+    cursors = []
+    failures = []
+
+    def followers_ids(**kwargs):
+        if fail_after is not None and len(cursors) == fail_after and \
+                not failures:
+            failures.append(kwargs.get('cursor'))
+            raise TweepError('Internal error', FakeResponse(503, {}),
+                             api_code=131)
+        cursors.append(kwargs.get('cursor'))
+        return method(**kwargs)
+    followers_ids.pagination_mode = 'cursor'
+    return followers_ids, cursors
+
+
+def all_ids(twitter, user_id):
+    ids, page, next_cursor = [], 0, None
+    while next_cursor != 0:
+        page_ids, next_cursor = twitter.ids_page('followers', user_id, page)
+        ids.extend(page_ids)
+        page += 1
+    return ids
+
+
+def user_with_pages(twitter, min_ids):
+    return next(str(user_id) for user_id in range(1, 100)
+                if twitter.user_json(user_id)['followers_count'] > min_ids)
+
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_get_ids_resumes_from_checkpoint(make_task_manager, compact):
+    twitter = FakeTwitter(1, window=100, ids_page_size=10, max_followers=100)
+    user_id = user_with_pages(twitter, 30)
+    api = twitter.apis()[0]
+    task_manager = make_task_manager(compact_ids=compact,
+                                     checkpoint_interval=1)
+
+    failing, _ = recording_ids(api.followers_ids, fail_after=2)
+    with pytest.raises(TweepError):
+        task_manager._get_ids(failing, 'followers', user_id)
+    checkpoint = task_manager.checkpoints.load('followers', user_id)
+    assert checkpoint['cursor'] == 2
+    if compact:
+        # The ids are kept out of the JSON checkpoint
+        assert 'ids' not in checkpoint
+        assert os.path.exists(checkpoint['ids_path'])
+    else:
+        assert len(checkpoint['ids']) == 20
+
+    resumed, cursors = recording_ids(api.followers_ids)
+    ids = task_manager._get_ids(resumed, 'followers', user_id)
+    assert cursors[0] == 2
+    assert sorted(int(user_id) for user_id in ids) == \
+        list(compact_ids(all_ids(twitter, user_id)))
+    assert task_manager.checkpoints.load('followers', user_id) is None
+    assert os.listdir(task_manager.checkpoints.folder_path) == []
+
+
+class FlakyAPI:
+    """
+    A FakeAPI whose followers_ids fails once, after the given number of
+    pages.
+    """
+
+    def __init__(self, api, fail_after):
+        self.api = api
+        self.followers_ids, self.cursors = recording_ids(api.followers_ids,
+                                                         fail_after)
+
+    def __getattr__(self, name):
+        return getattr(self.api, name)
+
+
+def test_retried_task_resumes_from_checkpoint(make_task_manager,
+                                              monkeypatch):
+    monkeypatch.setattr('task_manager.backoff_delay',
+                        lambda num_retries: 0.01)
+    twitter = FakeTwitter(1, window=100, ids_page_size=10, max_followers=100)
+    user_id = user_with_pages(twitter, 30)
+    api = FlakyAPI(twitter.apis()[0], fail_after=2)
+    task_manager = make_task_manager(checkpoint_interval=1)
+
+    task_manager.get_followers([user_id])
+    task_manager.run_tasks([api])
+    assert task_manager.task_registry.state(TaskType.followers, user_id) == \
+        TaskState.done
+    # The retry starts from the page that failed, not from the first one
+    assert api.cursors[:3] == [-1, 1, 2]
+    assert sorted(task_manager.get_all_followers(user_id)) == \
+        list(compact_ids(all_ids(twitter, user_id)))
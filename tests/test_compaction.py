@@ -0,0 +1,95 @@
+from benchmarks.fake_api import FakeTwitter
+from compaction import ARCHIVE_FOLDER, BASELINE_FOLDER, PACKED_EXT, \
+    Compactor, load_manifest, load_packed_objects
+from task_manager import TaskType
+import json
+import main
+import os
+import pytest
+
+RUNS = ['20200101000000', '20200102000000', '20200103000000']
+USER_IDS = ['12', '34']
+
+
+@pytest.fixture
+def collected(make_task_manager):
+    """
+    Collects the details, followers, followees and timelines of a few users
+    in each of RUNS, and returns the followers of each user.
+    """
+    twitter = FakeTwitter(2, window=5, max_followers=200)
+    for run in RUNS:
+        task_manager = make_task_manager(run)
+        task_manager.get_user_details(USER_IDS)
+        main.process_users(USER_IDS, set(), task_manager, twitter.apis())
+        task_manager.close()
+    task_manager = make_task_manager(RUNS[-1])
+    followers = {user_id: task_manager.get_all_followers(user_id)
+                 for user_id in USER_IDS}
+    task_manager.close()
+    return followers
+
+
+def baseline_files(base_folder):
+    files = {}
+    for folder_path, _, names in os.walk(base_folder + BASELINE_FOLDER):
+        for name in names:
+            with open(os.path.join(folder_path, name), 'rb') as f:
+                files[os.path.join(folder_path, name)] = f.read()
+    return files
+
+
+def test_compaction_is_idempotent(collected, base_folder):
+    assert Compactor(base_folder, keep_runs=1).run() == RUNS[:-1]
+    manifest = load_manifest(base_folder)
+    assert manifest == {'compacted_through': RUNS[-2], 'runs': RUNS[:-1]}
+    files = baseline_files(base_folder)
+    assert set(load_packed_objects(
+        base_folder + BASELINE_FOLDER + 'user_details' + PACKED_EXT)) == \
+        set(USER_IDS)
+
+    assert Compactor(base_folder, keep_runs=1).run() == []
+    assert load_manifest(base_folder) == manifest
+    assert baseline_files(base_folder) == files
+
+
+def test_compacted_history_is_unchanged(collected, base_folder,
+                                        make_task_manager):
+    Compactor(base_folder, keep_runs=1, archive=True).run()
+    assert sorted(os.listdir(base_folder + ARCHIVE_FOLDER)) == \
+        [run + '.tar.gz' for run in RUNS[:-1]]
+    assert not os.path.exists(base_folder + RUNS[0])
+
+    task_manager = make_task_manager(RUNS[-1])
+    assert task_manager.run_folders == RUNS[-1:]
+    for user_id in USER_IDS:
+        assert task_manager.get_all_followers(user_id) == collected[user_id]
+
+
+def test_compaction_waits_for_the_task_manager(collected, base_folder,
+                                               make_task_manager):
+    task_manager = make_task_manager('20200104000000')
+    with pytest.raises(RuntimeError):
+        Compactor(base_folder).run()
+    task_manager.close()
+    assert Compactor(base_folder).run() == RUNS
+
+
+def test_at_least_one_run_is_kept(base_folder):
+    with pytest.raises(ValueError):
+        Compactor(base_folder, keep_runs=0)
+
+
+def test_details_deltas_are_applied(base_folder, make_task_manager):
+    user = {'id_str': '12', 'screen_name': 'a', 'followers_count': 5}
+    for run, followers_count in zip(RUNS, [5, 6, 7]):
+        task_manager = make_task_manager(run, change_detection=True)
+        task_manager._write_details(
+            TaskType.user_details, '12',
+            dict(user, followers_count=followers_count))
+        task_manager.close()
+
+    Compactor(base_folder, keep_runs=1).run()
+    packed = load_packed_objects(
+        base_folder + BASELINE_FOLDER + 'user_details' + PACKED_EXT)
+    assert json.loads(packed['12']) == dict(user, followers_count=6)
@@ -0,0 +1,51 @@
+from benchmarks.fake_api import FakeTwitter
+from crawl import FollowerCrawl
+from id_sets import union_ids
+from task_manager import TaskType
+import pytest
+
+SEEDS = ['12', '34']
+
+
+def crawl(make_task_manager, twitter, run='20200101000000', **kwargs):
+    task_manager = make_task_manager(run, max_follow_count=10 ** 6,
+                                     **kwargs)
+    visited = FollowerCrawl(task_manager, TaskType.followers, SEEDS,
+                            depth=2, chunk_size=4).run(twitter.apis())
+    return task_manager, [int(user_id) for user_id in visited]
+
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_crawl_reaches_two_hops(make_task_manager, compact):
+    twitter = FakeTwitter(4, window=5, max_followers=60)
+    task_manager, visited = crawl(make_task_manager, twitter,
+                                  compact_ids=compact)
+    assert visited == sorted(visited)
+
+    hop1 = union_ids([task_manager.get_all_followers(user_id)
+                      for user_id in SEEDS])
+    hop2 = union_ids([task_manager.get_all_followers(str(user_id))
+                      for user_id in hop1])
+    expected = union_ids([[int(user_id) for user_id in SEEDS], hop1, hop2])
+    assert visited == [int(user_id) for user_id in expected]
+
+
+def test_crawl_modes_agree(make_task_manager):
+    twitter = FakeTwitter(4, window=5, max_followers=60)
+    task_manager, visited = crawl(make_task_manager, twitter)
+    task_manager.close()
+    _, compact_visited = crawl(make_task_manager, twitter,
+                               run='20200102000000', compact_ids=True)
+    assert compact_visited == visited
+
+
+def test_finished_crawl_is_not_redone(make_task_manager):
+    twitter = FakeTwitter(4, window=5, max_followers=60)
+    task_manager, visited = crawl(make_task_manager, twitter)
+    num_calls = twitter.stats()['total_calls']
+    task_manager.close()
+
+    # The checkpoint of the same run is at the last hop
+    _, resumed = crawl(make_task_manager, twitter)
+    assert resumed == visited
+    assert twitter.stats()['total_calls'] == num_calls
@@ -0,0 +1,68 @@
+from array import array
+from id_sets import apply_delta, compact_ids, diff_ids, load_ids, save_ids, \
+    union_ids
+import id_sets
+import pytest
+
+
+@pytest.fixture(params=['numpy', 'array'])
+def backend(request, monkeypatch):
+    """
+    Runs a test with NumPy arrays and with the array('q') fallback.
+    """
+    if request.param == 'array':
+        monkeypatch.setattr(id_sets, 'np', None)
+    elif id_sets.np is None:
+        pytest.skip("NumPy is not installed")
+    return request.param
+
+
+def as_list(ids):
+    return [int(item) for item in ids]
+
+
+def test_compact_ids_are_sorted_and_unique(backend):
+    ids = compact_ids([5, 1, 3, 1, 2 ** 62])
+    assert as_list(ids) == [1, 3, 5, 2 ** 62]
+    if backend == 'array':
+        assert isinstance(ids, array)
+
+
+def test_diff_and_apply_delta(backend):
+    previous = compact_ids([1, 2, 3, 4])
+    current = compact_ids([2, 4, 5, 6])
+    added, subtracted = diff_ids(current, previous)
+    assert as_list(added) == [5, 6]
+    assert as_list(subtracted) == [1, 3]
+    assert as_list(apply_delta(previous, added, subtracted)) == \
+        as_list(current)
+
+
+def test_diff_and_apply_delta_on_sets():
+    previous = {1, 2, 3}
+    added, subtracted = diff_ids({2, 3, 4}, previous)
+    assert (sorted(added), sorted(subtracted)) == ([4], [1])
+    assert apply_delta(previous, ['4'], ['1']) == {2, 3, 4}
+
+
+def test_union_ids(backend):
+    assert as_list(union_ids([compact_ids([1, 3]), {3, 2}, [5, 1]])) == \
+        [1, 2, 3, 5]
+    assert as_list(union_ids([])) == []
+
+
+def test_save_and_load_ids(tmp_path, backend):
+    path = str(tmp_path / 'user.ids')
+    save_ids(path, {'ids': compact_ids([3, 1]), 'empty': compact_ids(())},
+             {'run': 'run1'})
+    meta, arrays = load_ids(path)
+    assert meta == {'run': 'run1'}
+    assert as_list(arrays['ids']) == [1, 3]
+    assert as_list(arrays['empty']) == []
+
+
+def test_load_ids_rejects_other_files(tmp_path):
+    path = tmp_path / 'user.ids'
+    path.write_bytes(b'{"ids": []}')
+    with pytest.raises(ValueError):
+        load_ids(str(path))
@@ -0,0 +1,162 @@
+from benchmarks.fake_api import FakeTwitter
+from key_pool import ACTIVE, QUARANTINED, REMOVED, KeyHealth, KeyPool, \
+    verify_api
+import main
+import os
+
+
+KEY_SECTION = """[API Keys {0}]
+API_KEY=key{0}
+API_SECRET=secret{0}
+ACCESS_TOKEN=token{0}
+ACCESS_TOKEN_SECRET=token_secret{0}
+"""
+
+
+def write_settings(path, key_numbers):
+    with open(path, 'w') as f:
+        f.write('\n'.join(KEY_SECTION.format(n) for n in key_numbers))
+
+
+def test_unregistered_keys_are_active():
+    health = KeyHealth()
+    assert health.status(3) == ACTIVE
+    assert health.is_active(3)
+    assert health.statuses() == {}
+
+
+def test_only_key_errors_count_against_a_key():
+    health = KeyHealth()
+    for _ in range(50):
+        health.record(0, 'retried')
+        health.record(0, 'failed')
+    health.record(0, 'done')
+    assert health.is_active(0)
+    assert health.stats()[0]['success_rate'] == 1.0
+
+    health.record(0, 'key_error')
+    assert health.stats()[0]['success_rate'] == 0.5
+    # Recording outcomes never quarantines a key by itself
+    assert health.is_active(0)
+
+
+def test_stats_count_outcomes_and_calls():
+    health = KeyHealth()
+    health.register(0, 'API Keys 1')
+    health.record(0, 'done', num_calls=3, api_seconds=0.6)
+    health.record(0, 'rate_limited', num_calls=1, api_seconds=0.2)
+    stats = health.stats()[0]
+    assert stats['name'] == 'API Keys 1'
+    assert stats['outcomes'] == {'done': 1, 'rate_limited': 1}
+    assert abs(stats['mean_call_seconds'] - 0.2) < 1e-9
+
+
+def test_quarantine_and_reinstate():
+    health = KeyHealth()
+    assert health.quarantine(0, "revoked")
+    assert not health.quarantine(0, "revoked again")
+    assert health.status(0) == QUARANTINED
+    assert health.stats()[0]['reason'] == "revoked"
+
+    assert health.reinstate(0)
+    assert not health.reinstate(0)
+    assert health.status(0) == ACTIVE
+    assert health.stats()[0]['reason'] is None
+
+
+def test_removed_keys_are_not_reinstated():
+    health = KeyHealth()
+    health.remove(0)
+    assert not health.reinstate(0)
+    assert health.status(0) == REMOVED
+
+
+def test_verify_api():
+    twitter = FakeTwitter(2)
+    apis = twitter.apis()
+    twitter.revoke(1)
+    assert verify_api(apis[0]) is None
+    assert verify_api(apis[1]) is not None
+
+
+def test_key_pool_refresh_adds_and_removes_keys(tmp_path):
+    settings_file = str(tmp_path / 'apikeys.txt')
+    write_settings(settings_file, [1, 2])
+    pool = KeyPool(settings_file, verify=False)
+    assert len(pool) == 2
+    assert [pool.name(key_idx) for key_idx, _ in pool.keyed_apis()] == \
+        ['API Keys 1', 'API Keys 2']
+
+    # Unchanged files are not read again
+    assert pool.refresh() == ([], [])
+
+    write_settings(settings_file, [2, 3])
+    mtime = os.path.getmtime(settings_file) + 10
+    os.utime(settings_file, (mtime, mtime))
+    added, removed = pool.refresh()
+    assert removed == [0]
+    assert added == [2]
+    assert [pool.name(key_idx) for key_idx, _ in pool.keyed_apis()] == \
+        ['API Keys 2', 'API Keys 3']
+
+
+def test_key_pool_without_settings_file():
+    pool = KeyPool(None)
+    assert len(pool) == 0
+    key_idx = pool.add('fake', object())
+    assert pool.keyed_apis()[0][0] == key_idx
+    assert pool.remove('fake') == [key_idx]
+    assert len(pool) == 0
+
+
+def test_recheck_reinstates_keys_accepted_again(make_task_manager):
+    twitter = FakeTwitter(2)
+    apis = twitter.apis()
+    task_manager = make_task_manager()
+    twitter.revoke(1)
+    task_manager.key_health.quarantine(1, "revoked")
+
+    assert task_manager.recheck_keys(apis, force=True) == 0
+    assert task_manager.key_health.status(1) == QUARANTINED
+
+    twitter.revoked[1] = 0
+    # Rechecks are throttled unless forced
+    assert task_manager.recheck_keys(apis) == 0
+    assert task_manager.recheck_keys(apis, force=True) == 1
+    assert task_manager.key_health.status(1) == ACTIVE
+
+
+def test_revoked_keys_are_quarantined_and_tasks_complete(make_task_manager):
+    twitter = FakeTwitter(3, window=5)
+    apis = twitter.apis()
+    twitter.revoke(2)
+    task_manager = make_task_manager()
+    main.process_users(['12', '34', '56'], set(), task_manager, apis)
+
+    assert task_manager.key_health.status(2) == QUARANTINED
+    counts = task_manager.task_registry.counts()
+    assert counts['failed'] == 0
+    assert counts['queued'] == counts['in_flight'] == 0
+
+
+def test_transient_errors_do_not_quarantine_keys(make_task_manager):
+    twitter = FakeTwitter(2, window=5, error_rate=0.8)
+    apis = twitter.apis()
+    task_manager = make_task_manager()
+    main.process_users(['12', '34'], set(), task_manager, apis)
+
+    assert all(stats['status'] == ACTIVE
+               for stats in task_manager.key_stats().values())
+
+
+def test_tasks_fail_when_no_key_is_left(make_task_manager):
+    twitter = FakeTwitter(2, window=5)
+    apis = twitter.apis()
+    twitter.revoke(0)
+    twitter.revoke(1)
+    task_manager = make_task_manager()
+    main.process_users(['12', '34'], set(), task_manager, apis)
+
+    counts = task_manager.task_registry.counts()
+    assert counts['queued'] == counts['in_flight'] == 0
+    assert counts['done'] == 0
@@ -0,0 +1,102 @@
+from benchmarks.fake_api import FakeTwitter
+from metrics import InstrumentedAPI
+from rate_limits import RateLimitTracker, response_endpoint
+from task_manager import TaskType
+from task_registry import TaskState
+from test_backfill import ListBackfillSource
+from types import SimpleNamespace
+import pytest
+import time
+
+ENDPOINTS = ['/followers/ids', '/statuses/user_timeline']
+
+
+@pytest.fixture
+def tracker():
+    # The limits are a plain dict instead of a manager dict
+    return RateLimitTracker(SimpleNamespace(dict=dict), ENDPOINTS)
+
+
+class Response:
+    def __init__(self, url):
+        self.url = url
+        self.headers = {'x-rate-limit-remaining': '7',
+                        'x-rate-limit-reset': '1600000000'}
+
+
+@pytest.mark.parametrize('url, endpoint', [
+    ('https://api.twitter.com/1.1/followers/ids.json?cursor=-1',
+     '/followers/ids'),
+    ('https://api.twitter.com/1.1/statuses/show.json?id=20',
+     '/statuses/show/:id'),
+    ('https://api.twitter.com/1.1/statuses/retweets/20.json',
+     '/statuses/retweets/:id'),
+    ('https://api.twitter.com/1.1/users/show.json?user_id=12',
+     '/users/show/:id'),
+    ('https://api.twitter.com/1.1/users/lookup.json', '/users/lookup'),
+    (None, None),
+])
+def test_response_endpoint(url, endpoint):
+    assert response_endpoint(Response(url)) == endpoint
+
+
+def test_headers_go_to_the_endpoint_of_the_response(make_task_manager):
+    task_manager = make_task_manager()
+    task_manager.rate_limits.update_from_response(
+        0, Response('https://api.twitter.com/1.1/users/show.json'))
+    task_manager.rate_limits.update_from_response(1, None)
+    assert dict(task_manager.rate_limits.limits) == \
+        {(0, '/users/show/:id'): (7, 1600000000)}
+
+
+def test_task_without_calls_leaves_limits_alone(make_task_manager):
+    task_manager = make_task_manager(
+        backfill_source=ListBackfillSource([300]))
+    twitter = FakeTwitter(1, window=5)
+    api = InstrumentedAPI(twitter.apis()[0], 0)
+    api.get_user(user_id='12')
+
+    # The backfill is skipped without a timeline of this run, so the
+    # users/show response is still the last one of the API object
+    task_manager._execute_task(('12', TaskType.timeline_backfill, 0, 1), api)
+    assert dict(task_manager.rate_limits.limits) == {}
+
+    task_manager._execute_task(('12', TaskType.followers, 0, 1), api)
+    assert set(task_manager.rate_limits.limits.keys()) == \
+        {(0, '/followers/ids')}
+
+
+def test_status_updates_the_tracked_endpoints_only(tracker):
+    reset = int(time.time()) + 60
+    tracker.update_from_status(1, {'resources': {
+        'followers': {'/followers/ids': {'remaining': 0, 'reset': reset}},
+        'users': {'/users/lookup': {'remaining': 0, 'reset': reset}},
+    }})
+    assert tracker.limits == {(1, '/followers/ids'): (0, reset)}
+    assert tracker.exhausted_endpoints(1) == ['/followers/ids']
+    assert tracker.exhausted_endpoints(0) == []
+
+
+def test_exhausted_endpoints_reset(tracker):
+    now = int(time.time())
+    tracker.mark_exhausted(0, '/followers/ids')
+    tracker.mark_exhausted(0, '/statuses/user_timeline', now - 1)
+    assert tracker.limits[(0, '/followers/ids')][1] >= now + 15 * 60
+    # Windows which have reset no longer exclude their endpoint
+    assert tracker.exhausted_endpoints(0) == ['/followers/ids']
+
+
+def test_rate_limited_task_is_handed_over(make_task_manager):
+    task_manager = make_task_manager()
+    twitter = FakeTwitter(1, window=60)
+    api = InstrumentedAPI(twitter.apis(wait_on_rate_limit=False)[0], 0)
+    for _ in range(15):
+        api.followers_ids(id='34')
+
+    task_manager.task_registry.add(TaskType.followers, ['12'])
+    task_manager._execute_task(('12', TaskType.followers, 0, 1), api)
+    assert task_manager.rate_limits.exhausted_endpoints(0) == \
+        ['/followers/ids']
+    assert task_manager.task_registry.state(TaskType.followers, '12') == \
+        TaskState.queued
+    assert task_manager.tasks_pending.qsize() == 1
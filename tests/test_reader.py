@@ -0,0 +1,78 @@
+from benchmarks.fake_api import FakeTwitter
+from compaction import Compactor
+from reader import OutputReader, load_columns, project
+import main
+import pytest
+import reader
+
+RUNS = ['20200101000000', '20200102000000']
+USER_IDS = ['12', '34', '56']
+
+
+@pytest.fixture
+def collected(base_folder, make_task_manager):
+    twitter = FakeTwitter(2, window=5, max_followers=100)
+    for run in RUNS:
+        task_manager = make_task_manager(run)
+        task_manager.get_user_details(USER_IDS)
+        main.process_users(USER_IDS, set(), task_manager, twitter.apis())
+        task_manager.close()
+    return base_folder
+
+
+def test_project():
+    obj = {'id_str': '1', 'user': {'id_str': '2'}, 'text': 'a'}
+    fields = [(field, field.split('.'))
+              for field in ('id_str', 'user.id_str', 'user.name', 'text.x')]
+    assert project(obj, fields) == {'id_str': '1', 'user.id_str': '2',
+                                    'user.name': None, 'text.x': None}
+
+
+def test_records(collected):
+    output = OutputReader(collected)
+    assert output.runs == RUNS
+    users = list(output.records('user_details', ['id_str', 'screen_name']))
+    assert sorted(user['id_str'] for user in users) == sorted(USER_IDS * 2)
+    assert set(users[0]) == {'id_str', 'screen_name'}
+
+    tweets = list(output.records('timelines', ['id_str', 'user.id_str']))
+    assert tweets
+    assert all(tweet['user.id_str'] in USER_IDS for tweet in tweets)
+    assert len(list(OutputReader(collected, since=RUNS[1]).records(
+        'user_details'))) == len(USER_IDS)
+
+
+def test_parallel_records_match_serial_records(collected, monkeypatch):
+    monkeypatch.setattr(reader, 'FILES_PER_TASK', 1)
+    output = OutputReader(collected)
+    fields = ['id_str', 'user.id_str']
+    assert list(output.records('timelines', fields, processes=2)) == \
+        list(output.records('timelines', fields))
+
+
+def test_baseline_replaces_compacted_runs(collected):
+    before = sorted(tweet['id_str'] for tweet in OutputReader(
+        collected).records('timelines', ['id_str']))
+    Compactor(collected, keep_runs=1).run()
+
+    output = OutputReader(collected, include_baseline=True)
+    assert output.runs == RUNS[1:]
+    after = [tweet['id_str'] for tweet in output.records('timelines',
+                                                         ['id_str'])]
+    assert set(after) == set(before)
+
+
+@pytest.mark.skipif(reader.numpy is None, reason="NumPy is not installed")
+def test_export_columns(collected, tmp_path):
+    path = str(tmp_path / 'users')
+    output = OutputReader(collected)
+    assert output.export_columns('user_details',
+                                 ['id', 'followers_count'], path) == 6
+    columns = load_columns(path)
+    assert sorted(columns['id'].tolist()) == sorted(
+        int(user_id) for user_id in USER_IDS * 2)
+    assert not columns['id'].flags.writeable
+
+    with pytest.raises(ValueError):
+        output.export_columns('user_details', ['screen_name'],
+                              str(tmp_path / 'names'))
@@ -0,0 +1,98 @@
+from snapshots import DETAILS_DELTA_EXT, FingerprintIndex, SnapshotStore, \
+    apply_details_delta, flatten_fields
+from task_manager import TaskType
+import json
+import pytest
+
+TWEET = {
+    'id_str': '100', 'full_text': 'Hello', 'retweet_count': 1,
+    'entities': {'hashtags': [], 'urls': []},
+    'user': {'id_str': '12', 'followers_count': 5, 'screen_name': 'a'},
+}
+
+
+def copy(obj):
+    return json.loads(json.dumps(obj))
+
+
+def test_flatten_fields():
+    assert flatten_fields({'a': 1, 'b': {'c': 2, 'd': {'e': 3}}, 'f': {}}) \
+        == {'a': 1, 'b.c': 2, 'b.d': {'e': 3}, 'f': {}}
+
+
+@pytest.mark.parametrize('change', [
+    lambda tweet: tweet.update(retweet_count=2),
+    lambda tweet: tweet['entities'].update(urls=['https://example.com']),
+    lambda tweet: tweet['entities'].pop('hashtags'),
+    lambda tweet: tweet.pop('entities'),
+    lambda tweet: tweet.update(place={'name': 'Paris'}),
+    lambda tweet: tweet.update(place={}),
+])
+def test_delta_round_trip(tmp_path, change):
+    index = FingerprintIndex(str(tmp_path) + '/')
+    entry, changed, removed, fingerprints = index.diff('tweet_details',
+                                                       '100', TWEET)
+    assert entry is None
+    index.save('tweet_details', '100', 'run1', TWEET, fingerprints)
+
+    tweet = copy(TWEET)
+    change(tweet)
+    entry, changed, removed, _ = index.diff('tweet_details', '100', tweet)
+    assert entry['run'] == 'run1'
+    assert changed or removed
+    assert apply_details_delta(TWEET, {'changed': changed,
+                                       'removed': removed}) == tweet
+
+
+def test_embedded_users_are_not_fingerprinted(tmp_path):
+    index = FingerprintIndex(str(tmp_path) + '/')
+    tweet = copy(TWEET)
+    tweet['retweeted_status'] = {'id_str': '99', 'user': {'id_str': '7'}}
+    _, _, _, fingerprints = index.diff('tweet_details', '100', tweet)
+    index.save('tweet_details', '100', 'run1', tweet, fingerprints)
+    assert not any(path.startswith('user') or path == 'retweeted_status.user'
+                   for path in fingerprints)
+    assert index.load('tweet_details', '100')['values'] == \
+        {'user.id_str': '12'}
+
+    tweet['user']['followers_count'] += 1
+    tweet['retweeted_status']['user']['followers_count'] = 3
+    _, changed, removed, _ = index.diff('tweet_details', '100', tweet)
+    assert changed == {} and removed == []
+
+
+def test_unchanged_objects_are_not_written(make_task_manager):
+    user = {'id_str': '12', 'screen_name': 'a', 'followers_count': 5,
+            'status': {'id_str': '100', 'retweet_count': 1}}
+    runs = ['20200101000000', '20200102000000', '20200103000000']
+    for run, followers_count in zip(runs, [5, 6, 6]):
+        task_manager = make_task_manager(run, change_detection=True)
+        user = dict(user, followers_count=followers_count)
+        task_manager._write_details(TaskType.user_details, '12', user)
+        task_manager.close()
+
+    task_manager = make_task_manager(runs[-1], change_detection=True)
+    folder = task_manager.base_folder_path + '{}/twitter/user_details/12'
+    with open(folder.format(runs[0]) + '.json') as f:
+        first = json.load(f)
+    with open(folder.format(runs[1]) + DETAILS_DELTA_EXT) as f:
+        delta = json.load(f)
+    assert delta['previous_run'] == runs[0]
+    assert delta['changed'] == {'followers_count': 6}
+    assert apply_details_delta(first, delta) == user
+    # Nothing is written in the last run, where the user did not change
+    assert task_manager.output_folders[TaskType.user_details].find(
+        '12', ('.json', DETAILS_DELTA_EXT)) is None
+
+    assert task_manager.changed_since(runs[0]) == {'12'}
+    assert task_manager.changed_since(runs[1]) == set()
+
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_snapshot_store_round_trip(tmp_path, compact):
+    store = SnapshotStore(str(tmp_path) + '/', compact=compact)
+    assert store.load('followers', '12')[0] is None
+    store.save('followers', '12', 'run1', {3, 1, 2})
+    run, ids = store.load('followers', '12')
+    assert run == 'run1'
+    assert sorted(int(item) for item in ids) == [1, 2, 3]
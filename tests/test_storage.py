@@ -0,0 +1,106 @@
+from storage import TWEET_FILE_EXTS, OutputFolder, TweetWriter, \
+    lock_folder, merge_tweets, read_tweets
+import json
+import pytest
+import storage
+
+TWEETS = [{'id': 3, 'full_text': 'Ünïcode "quoted"\n'},
+          {'id': 2, 'full_text': 'two'},
+          {'id': 1, 'full_text': 'one'}]
+
+
+def tweet_formats():
+    formats = []
+    for (tweet_format, compression), ext in TWEET_FILE_EXTS.items():
+        marks = []
+        if compression == 'zstd' and storage.zstandard is None:
+            marks.append(pytest.mark.skip("zstandard is not installed"))
+        formats.append(pytest.param(compression, ext, marks=marks,
+                                    id=tweet_format + ext))
+    return formats
+
+
+@pytest.mark.parametrize('compression,ext', tweet_formats())
+def test_tweet_writer_round_trip(tmp_path, compression, ext):
+    path = str(tmp_path / ('1' + ext))
+    writer = TweetWriter(path, compression)
+    for tweet in TWEETS:
+        writer.write(tweet)
+    writer.commit()
+    assert list(read_tweets(path)) == TWEETS
+    assert [p.name for p in tmp_path.iterdir()] == ['1' + ext]
+
+
+def test_json_format_matches_the_original_encoding(tmp_path):
+    path = str(tmp_path / '1.json')
+    writer = TweetWriter(path)
+    for tweet in TWEETS:
+        writer.write(tweet)
+    writer.commit()
+    with open(path) as f:
+        assert f.read() == json.dumps([json.dumps(tweet)
+                                       for tweet in TWEETS])
+
+    path = str(tmp_path / '2.json')
+    TweetWriter(path).commit()
+    with open(path) as f:
+        assert json.load(f) == []
+
+
+@pytest.mark.parametrize('compression,ext', tweet_formats())
+def test_tweet_writer_resumes_from_a_checkpoint(tmp_path, compression, ext):
+    path = str(tmp_path / ('1' + ext))
+    writer = TweetWriter(path, compression)
+    writer.write(TWEETS[0])
+    size = writer.checkpoint()
+    writer.write(TWEETS[1])
+    writer.abort()
+
+    # The tweets written after the checkpoint are dropped
+    writer = TweetWriter(path, compression, resume_size=size)
+    writer.write(TWEETS[2])
+    writer.commit()
+    assert list(read_tweets(path)) == [TWEETS[0], TWEETS[2]]
+
+
+def test_merge_tweets(tmp_path):
+    old_path = str(tmp_path / '1.json')
+    writer = TweetWriter(old_path)
+    writer.write(TWEETS[1])
+    writer.commit()
+
+    new_path = str(tmp_path / '1.jsonl.gz')
+    assert merge_tweets(new_path, [TWEETS[2], TWEETS[1], TWEETS[0]], 'gzip',
+                        old_path) == 2
+    assert list(read_tweets(new_path)) == TWEETS
+    assert [p.name for p in tmp_path.iterdir()] == ['1.jsonl.gz']
+    # Nothing is written when every tweet is already stored
+    assert merge_tweets(new_path, TWEETS[:1], 'gzip', new_path) == 0
+
+
+@pytest.mark.parametrize('sharded', [False, True])
+def test_output_folder_finds_files_in_either_layout(tmp_path, sharded):
+    folder = OutputFolder(str(tmp_path) + '/', sharded)
+    other = OutputFolder(str(tmp_path) + '/', not sharded)
+    for object_id in ('1', '2'):
+        with open(folder.path(object_id, '.json'), 'w') as f:
+            f.write('{}')
+    with open(folder.path('3', '.json') + '.part', 'w') as f:
+        f.write('{}')
+
+    assert other.find('1', ('.jsonl', '.json')) == folder.path('1', '.json')
+    assert other.find('3', ('.json',)) is None
+    assert other.contains('2', ('.json',))
+    assert not other.contains('3', ('.json',))
+    assert sorted(object_id for object_id, _ in other.files(('.json',))) \
+        == ['1', '2']
+
+
+def test_lock_folder(tmp_path):
+    folder_path = str(tmp_path) + '/'
+    shared = lock_folder(folder_path)
+    lock_folder(folder_path).close()
+    with pytest.raises(BlockingIOError):
+        lock_folder(folder_path, exclusive=True)
+    shared.close()
+    lock_folder(folder_path, exclusive=True).close()
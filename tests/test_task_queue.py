@@ -0,0 +1,85 @@
+from task_queue import TaskQueue
+import pytest
+import queue
+import time
+
+
+def get_all(task_queue, excluded_endpoints=(), key=None):
+    tasks = []
+    while True:
+        try:
+            tasks.append(task_queue.get(excluded_endpoints, 0, key))
+        except queue.Empty:
+            return tasks
+        task_queue.task_done(key)
+
+
+def test_longest_tasks_are_handed_out_first():
+    task_queue = TaskQueue()
+    task_queue.put_many([('a', '/followers/ids', 0, 10),
+                         ('b', '/followers/ids', 0, 500),
+                         ('c', '/statuses/user_timeline', 0, 100),
+                         ('d', '/followers/ids', 0, 10)])
+    # By decreasing cost across endpoints, then in FIFO order
+    assert get_all(task_queue) == ['b', 'c', 'a', 'd']
+
+
+def test_priority_comes_before_cost():
+    task_queue = TaskQueue()
+    task_queue.put('a', '/followers/ids', cost=1000)
+    task_queue.put('b', '/followers/ids', priority=1, cost=1)
+    task_queue.put('c', '/friends/ids', priority=1, cost=5)
+    assert get_all(task_queue) == ['c', 'b', 'a']
+
+
+def test_excluded_endpoints_are_skipped():
+    task_queue = TaskQueue()
+    task_queue.put_many([('a', '/followers/ids', 0, 500),
+                         ('b', '/statuses/user_timeline', 0, 1),
+                         ('sentinel', None, 0, 0)])
+    assert get_all(task_queue, ['/followers/ids']) == ['b', 'sentinel']
+    assert get_all(task_queue) == ['a']
+
+
+def test_delayed_task_avoids_the_key_it_failed_on():
+    task_queue = TaskQueue()
+    task_queue.put('a', '/followers/ids', delay=0.5, avoid_key=0)
+    time.sleep(0.6)
+    assert get_all(task_queue, key=0) == []
+    assert get_all(task_queue, key=1) == ['a']
+
+    # The key it failed on gets it once no other key took it for a while
+    task_queue.put('b', '/followers/ids', delay=0.05, avoid_key=0)
+    time.sleep(0.15)
+    assert get_all(task_queue, key=0) == ['b']
+
+
+def test_join_waits_for_task_done():
+    task_queue = TaskQueue()
+    task_queue.put('a', '/followers/ids')
+    assert task_queue.get(key=0) == 'a'
+    assert not task_queue.join(0.05)
+    task_queue.task_done(0)
+    assert task_queue.join(0.05)
+
+
+@pytest.mark.parametrize('delay', [0, 10])
+def test_drained_tasks_no_longer_count(delay):
+    task_queue = TaskQueue()
+    task_queue.put('a', '/followers/ids', delay=delay)
+    assert task_queue.drain() == ['a']
+    assert task_queue.qsize() == 0
+    assert task_queue.join(0)
+
+
+def test_task_of_a_dead_worker_is_abandoned():
+    task_queue = TaskQueue()
+    task_queue.put_many([('a', '/followers/ids', 0, 2),
+                         ('b', '/followers/ids', 0, 1)])
+    assert task_queue.get(key=0) == 'a'
+    assert task_queue.get(key=1) == 'b'
+    task_queue.task_done(1)
+
+    assert task_queue.abandon(1) is None
+    assert task_queue.abandon(0) == 'a'
+    assert task_queue.join(0)
@@ -0,0 +1,94 @@
+from task_manager import TaskType
+from task_registry import DurableTaskRegistry, TaskRegistry, TaskState
+import main
+
+USER = {'id_str': '12', 'screen_name': 'Someone', 'followers_count': 10,
+        'friends_count': 10, 'statuses_count': 10}
+
+
+def test_ids_are_deduplicated_as_strings():
+    registry = TaskRegistry()
+    assert registry.add(TaskType.timeline, [1, '1', 2]) == [1, 2]
+    assert registry.untracked(TaskType.timeline, ['1', 3]) == [3]
+    assert registry.counts()['queued'] == 2
+
+
+def test_each_retry_is_counted_once():
+    registry = TaskRegistry(max_retries=2)
+    registry.add(TaskType.timeline, ['1'])
+    registry.start(TaskType.timeline, ['1'])
+
+    assert registry.retry(TaskType.timeline, ['1']) == 1
+    assert registry.state(TaskType.timeline, '1') == TaskState.queued
+    assert registry.retry(TaskType.timeline, ['1']) == 2
+    # Out of retries: the task is failed, and the attempt counted once
+    assert registry.retry(TaskType.timeline, ['1']) is None
+    assert registry.state(TaskType.timeline, '1') == TaskState.failed
+    assert registry.retries[('timeline', '1')] == 3
+
+
+def test_failed_tasks_are_enqueued_again_until_max_retries():
+    registry = TaskRegistry(max_retries=2)
+    registry.add(TaskType.timeline, ['1'])
+    registry.fail(TaskType.timeline, ['1'])
+    assert registry.add(TaskType.timeline, ['1']) == ['1']
+    registry.fail(TaskType.timeline, ['1'])
+    assert registry.add(TaskType.timeline, ['1']) == []
+
+
+def test_finish_keeps_tasks_failed_while_in_flight():
+    registry = TaskRegistry()
+    registry.add(TaskType.timeline, ['1', '2'])
+    registry.start(TaskType.timeline, ['1', '2'])
+    registry.fail(TaskType.timeline, ['2'])
+    registry.finish(TaskType.timeline, ['1', '2'])
+    assert registry.state_many(TaskType.timeline, ['1', '2', '3']) == \
+        [TaskState.done, TaskState.failed, None]
+    assert registry.remaining() == 0
+
+
+def test_durable_registry_requeues_in_flight_tasks(tmp_path):
+    db_path = str(tmp_path / 'tasks.db')
+    registry = DurableTaskRegistry(db_path, max_retries=3)
+    registry.add(TaskType.timeline, ['1', '2', '3'])
+    registry.start(TaskType.timeline, ['1', '2'])
+    registry.finish(TaskType.timeline, ['1'])
+    registry.retry(TaskType.timeline, ['3'])
+    registry.close()
+
+    registry = DurableTaskRegistry(db_path, max_retries=3)
+    assert registry.state(TaskType.timeline, '1') == TaskState.done
+    assert sorted(registry.queued()) == [('timeline', '2'),
+                                         ('timeline', '3')]
+    assert registry.retries[('timeline', '3')] == 1
+    registry.close()
+
+
+def test_dead_letters_match_screen_names_and_ids(make_task_manager,
+                                                 base_folder):
+    task_manager = make_task_manager()
+    task_manager.user_cache.put(USER)
+    task_manager._record_dead_letters(['someone'], TaskType.timeline,
+                                      'protected')
+
+    with open(task_manager.dead_letters_file_path) as f:
+        assert f.read() == 'timeline\t12\tprotected\n'
+    assert task_manager._register_tasks(['12'], TaskType.timeline) == []
+    task_manager.close()
+
+    # Later runs skip the user under either name
+    task_manager = make_task_manager('20200102000000')
+    task_manager.user_cache.put(USER)
+    assert task_manager._register_tasks(['Someone', '12', '34'],
+                                        TaskType.timeline) == ['34']
+
+
+def test_run_completes_with_missing_objects(make_task_manager):
+    from benchmarks.fake_api import FakeTwitter
+    twitter = FakeTwitter(2, window=5, missing_rate=0.3, seed=1)
+    task_manager = make_task_manager()
+    main.process_users([str(n) for n in range(10, 30)], set(), task_manager,
+                       twitter.apis())
+    counts = task_manager.task_registry.counts()
+    assert counts['dead_letter'] > 0
+    assert counts['queued'] == counts['in_flight'] == counts['failed'] == 0
@@ -0,0 +1,144 @@
+from benchmarks.fake_api import FakeTwitter
+from task_manager import TaskType
+from task_registry import DurableTaskRegistry, TaskState
+import os
+import pytest
+import signal
+import threading
+import time
+
+USER_IDS = ['12', '34', '56', '78', '90']
+
+
+@pytest.fixture(autouse=True)
+def fast_polling(monkeypatch):
+    monkeypatch.setattr('task_manager.KEY_POLL_INTERVAL', 0.1)
+
+
+@pytest.fixture
+def twitter():
+    return FakeTwitter(1, window=5, max_followers=100)
+
+
+def crash_first(task_manager, num_crashes):
+    """
+    Makes the worker crash on the first num_crashes tasks it gets.
+    """
+    execute_task = task_manager._execute_task
+    crashes = []
+
+    def crashing_execute_task(task, *args):
+        if len(crashes) < num_crashes:
+            crashes.append(task)
+            raise RuntimeError('Worker crash')
+        return execute_task(task, *args)
+    task_manager._execute_task = crashing_execute_task
+
+
+def test_failing_follow_ups_fail_the_task(make_task_manager, twitter):
+    task_manager = make_task_manager()
+
+    def failing_emit_follow_ups(*args):
+        raise ValueError('Broken follow-ups')
+    task_manager._emit_follow_ups = failing_emit_follow_ups
+
+    task_manager.get_followers(USER_IDS[:2])
+    task_manager.run_tasks(twitter.apis())
+    for user_id in USER_IDS[:2]:
+        assert task_manager.task_registry.state(
+            TaskType.followers, user_id) == TaskState.failed
+    assert all(worker.is_alive() for worker in task_manager.engine.workers)
+
+
+@pytest.mark.filterwarnings(
+    'ignore::pytest.PytestUnhandledThreadExceptionWarning')
+def test_crashed_worker_is_restarted(make_task_manager, twitter):
+    task_manager = make_task_manager()
+    crash_first(task_manager, 1)
+
+    task_manager.get_followers(USER_IDS)
+    task_manager.run_tasks(twitter.apis())
+    assert task_manager.worker_restarts == {0: 1}
+    states = [task_manager.task_registry.state(TaskType.followers, user_id)
+              for user_id in USER_IDS]
+    assert states.count(TaskState.done) == len(USER_IDS) - 1
+    # The task the worker crashed on is failed rather than left queued
+    assert states.count(TaskState.failed) == 1
+
+
+@pytest.mark.filterwarnings(
+    'ignore::pytest.PytestUnhandledThreadExceptionWarning')
+def test_crashing_worker_fails_the_run(make_task_manager, twitter):
+    task_manager = make_task_manager()
+    crash_first(task_manager, len(USER_IDS))
+
+    task_manager.get_followers(USER_IDS)
+    with pytest.raises(RuntimeError):
+        task_manager.run_tasks(twitter.apis())
+    # The tasks the worker crashed on, and the one left after that
+    assert all(task_manager.task_registry.state(TaskType.followers, user_id)
+               == TaskState.failed for user_id in USER_IDS)
+
+
+class FailingFinish:
+    """
+    A task registry whose finish fails, e.g. on a full disk.
+    """
+
+    def __init__(self, task_registry):
+        self.task_registry = task_registry
+
+    def __getattr__(self, name):
+        return getattr(self.task_registry, name)
+
+    def finish(self, task_type, object_ids):
+        raise OSError('No space left on device')
+
+
+def durable_states(task_manager, user_ids):
+    registry = DurableTaskRegistry(task_manager.twitter_folder_path +
+                                   'tasks.db')
+    try:
+        return [registry.state(TaskType.followers, user_id)
+                for user_id in user_ids]
+    finally:
+        registry.close()
+
+
+def test_durable_task_fails_when_finish_fails(make_task_manager, twitter):
+    task_manager = make_task_manager(durable=True)
+    task_manager.task_registry = FailingFinish(task_manager.task_registry)
+
+    task_manager.get_followers(USER_IDS[:2])
+    task_manager.run_tasks(twitter.apis())
+    task_manager.close()
+    assert durable_states(task_manager, USER_IDS[:2]) == \
+        [TaskState.failed, TaskState.failed]
+
+
+def kill_worker_in_flight(task_manager, user_id, timeout=10):
+    deadline = time.time() + timeout
+    while task_manager.task_registry.state(
+            TaskType.followers, user_id) != TaskState.in_flight:
+        if time.time() > deadline:
+            return
+        time.sleep(0.01)
+    os.kill(task_manager.engine.workers[0].pid, signal.SIGKILL)
+
+
+def test_task_of_killed_worker_is_failed(make_task_manager):
+    task_manager = make_task_manager(durable=True, engine='process')
+    twitter = FakeTwitter(1, latency=0.2, window=5, max_followers=100,
+                          ids_page_size=10)
+    user_id = next(str(user_id) for user_id in range(1, 100)
+                   if twitter.user_json(user_id)['followers_count'] > 50)
+
+    task_manager.get_followers([user_id])
+    killer = threading.Thread(target=kill_worker_in_flight,
+                              args=(task_manager, user_id), daemon=True)
+    killer.start()
+    task_manager.run_tasks(twitter.apis())
+    killer.join()
+    assert task_manager.worker_restarts == {0: 1}
+    task_manager.close()
+    assert durable_states(task_manager, [user_id]) == [TaskState.failed]
@@ -0,0 +1,104 @@
+import threading
+import time
+
+
+class UserCache:
+    """
+    A cache of Twitter user objects shared by all the worker processes of a
+    TaskManager. It lives in the manager process, and every method takes
+    and returns whole lists of ids, so that a batch of users costs a single
+    round trip to the manager.
+
+    The raw user JSON is stored in a dict keyed by the user's id_str, along
+    with the time at which it was fetched. A second dict maps the lowercased
+    screen names to ids, so that a user can be found by either of them.
+    Entries older than ttl seconds are treated as missing, and once the
+    cache grows beyond max_size users the oldest entries are evicted.
+    """
+
+    def __init__(self, ttl=3600, max_size=100000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.users = {}
+        self.screen_names = {}
+        self.lock = threading.Lock()
+
+    def _resolve(self, user_id):
+        user_id = str(user_id)
+        if user_id.isdigit():
+            return user_id
+        return self.screen_names.get(user_id.lower())
+
+    def _get(self, user_id, now):
+        id_str = self._resolve(user_id)
+        if id_str is None:
+            return None
+
+        entry = self.users.get(id_str)
+        if entry is None:
+            return None
+
+        fetched_at, user_json = entry
+        if now - fetched_at > self.ttl:
+            self._remove(id_str, user_json)
+            return None
+        return user_json
+
+    def get(self, user_id):
+        """
+        Returns the cached user JSON for a user id or screen name, or None
+        if the user is not cached or the entry has expired.
+        """
+        return self.lookup([user_id])[0]
+
+    def lookup(self, user_ids):
+        """
+        Returns the cached user JSON for each of the given user ids and
+        screen names, or None for the ones that are not cached.
+        """
+        now = time.time()
+        with self.lock:
+            return [self._get(user_id, now) for user_id in user_ids]
+
+    def get_many(self, user_ids):
+        """
+        Returns the cached user JSONs for the given user ids and screen
+        names, skipping the ones that are not cached.
+        """
+        return [user_json for user_json in self.lookup(user_ids)
+                if user_json is not None]
+
+    def missing(self, user_ids):
+        """
+        Returns the user ids and screen names that are not in the cache.
+        """
+        user_ids = list(user_ids)
+        return [user_id for user_id, user_json
+                in zip(user_ids, self.lookup(user_ids)) if user_json is None]
+
+    def put(self, user_json):
+        self.put_many([user_json])
+
+    def put_many(self, user_jsons):
+        now = time.time()
+        with self.lock:
+            for user_json in user_jsons:
+                self.users[user_json['id_str']] = (now, user_json)
+                self.screen_names[user_json['screen_name'].lower()] = \
+                    user_json['id_str']
+            if len(self.users) > self.max_size:
+                self._evict()
+
+    def _remove(self, id_str, user_json):
+        self.users.pop(id_str, None)
+        screen_name = user_json['screen_name'].lower()
+        if self.screen_names.get(screen_name) == id_str:
+            self.screen_names.pop(screen_name, None)
+
+    def _evict(self):
+        # Evict down to 90% of max_size so that eviction, which sorts the
+        # whole cache, does not run on every insert.
+        entries = sorted(self.users.items(), key=lambda item: item[1][0])
+        num_evicted = len(entries) - int(self.max_size * 0.9)
+        for id_str, (_, user_json) in entries[:num_evicted]:
+            self._remove(id_str, user_json)